@@ -0,0 +1,37 @@
+"""add n_task_runs to task
+
+Revision ID: 6f2d9c4e8a1b
+Revises: b51e6c2a4d7f
+Create Date: 2026-10-18 21:02:17.318044
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6f2d9c4e8a1b'
+down_revision = 'b51e6c2a4d7f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('task', sa.Column('n_task_runs', sa.Integer,
+                                    nullable=False, server_default='0'))
+    conn = op.get_bind()
+    max_id = conn.execute(sa.text('SELECT MAX(id) FROM task')).scalar() or 0
+    update = sa.text('''UPDATE task SET n_task_runs=counts.n_task_runs
+                     FROM (SELECT task_id, COUNT(id) AS n_task_runs
+                           FROM task_run
+                           WHERE task_id>:last_id AND task_id<=:next_id
+                           GROUP BY task_id) AS counts
+                     WHERE task.id=counts.task_id''')
+    last_id = 0
+    while last_id < max_id:
+        conn.execute(update, last_id=last_id, next_id=last_id + 10000)
+        last_id += 10000
+    op.create_index('task_project_id_id_idx', 'task', ['project_id', 'id'])
+
+
+def downgrade():
+    op.drop_index('task_project_id_id_idx', 'task')
+    op.drop_column('task', 'n_task_runs')
@@ -0,0 +1,44 @@
+"""add info_hash to task
+
+Revision ID: b51e6c2a4d7f
+Revises: 66ecf0b2aed5
+Create Date: 2026-10-18 19:20:41.712504
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b51e6c2a4d7f'
+down_revision = '66ecf0b2aed5'
+
+import hashlib
+import json
+from alembic import op
+import sqlalchemy as sa
+
+
+def hash_info(info):
+    canonical = json.dumps(info, sort_keys=True, separators=(',', ':'))
+    return hashlib.md5(canonical).hexdigest()
+
+
+def upgrade():
+    op.add_column('task', sa.Column('info_hash', sa.Text))
+    conn = op.get_bind()
+    select = sa.text('''SELECT id, info FROM task WHERE id>:last_id
+                     ORDER BY id LIMIT 1000''')
+    update = sa.text('UPDATE task SET info_hash=:info_hash WHERE id=:id')
+    last_id = 0
+    while True:
+        rows = conn.execute(select, last_id=last_id).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [dict(id=row.id, info_hash=hash_info(row.info))
+                              for row in rows])
+        last_id = rows[-1].id
+    op.create_index('task_project_id_info_hash_idx', 'task',
+                    ['project_id', 'info_hash'])
+
+
+def downgrade():
+    op.drop_index('task_project_id_info_hash_idx', 'task')
+    op.drop_column('task', 'info_hash')
@@ -682,10 +682,12 @@ def update_project_stats():
         db.engine.execute(sql_query)
 
 
-def anonymize_ips():
+def anonymize_ips(batch_size=None):
     """Anonymize all the IPs of the server."""
     from pybossa.core import anonymizer, task_repo
 
+    if batch_size:
+        return _anonymize_ips_in_batches(anonymizer, int(batch_size))
     taskruns = task_repo.filter_task_runs_by(user_id=None)
     for tr in taskruns:
         print "Working on taskrun %s" % tr.id
@@ -693,6 +695,36 @@ def anonymize_ips():
         tr.user_ip = anonymizer.ip(tr.user_ip)
         task_repo.update(tr)
 
+
+def _anonymize_ips_in_batches(anonymizer, batch_size):
+    """Anonymize the IPs of batch_size taskruns at a time.
+
+    The distinct IPs of a batch are anonymized together, reusing the
+    computations of their shared prefixes, and updated with one query each.
+    """
+    select = text('''SELECT id, user_ip FROM task_run
+                  WHERE user_id IS NULL AND user_ip IS NOT NULL
+                  AND id > :last_id ORDER BY id LIMIT :limit;''')
+    update = text('''UPDATE task_run SET user_ip=:user_ip
+                  WHERE id=ANY(:ids);''')
+    with app.app_context():
+        last_id = 0
+        while True:
+            params = dict(last_id=last_id, limit=batch_size)
+            rows = db.session.execute(select, params).fetchall()
+            if not rows:
+                break
+            ids_by_ip = {}
+            for row in rows:
+                ids_by_ip.setdefault(row.user_ip, []).append(row.id)
+            ips = ids_by_ip.keys()
+            for ip, anonymized in zip(ips, anonymizer.ips(ips)):
+                db.session.execute(update, dict(user_ip=anonymized,
+                                                ids=ids_by_ip[ip]))
+            db.session.commit()
+            last_id = rows[-1].id
+            print "Anonymized %s taskruns up to id %s" % (len(rows), last_id)
+
 def clean_project(project_id, skip_tasks=False):
     """Remove everything from a project."""
     from pybossa.core import task_repo
@@ -15,17 +15,126 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
-
+"""IP anonymizer for PYBOSSA."""
+import binascii
+import socket
+import threading
+from collections import OrderedDict
 from yacryptopan import CryptoPAn
 
 
 class Anonymizer(object):
 
+    """Anonymize IPs with CryptoPAn keeping the last ones in memory.
+
+    Every anonymization encrypts one AES block per bit of the address, so
+    the last ANONYMIZER_CACHE_SIZE addresses are kept in a LRU shared by
+    the API, the scheduler and the rate limiter of the worker.
+    """
+
     def __init__(self, app=None):
         self.app = app
+        self.cache_size = 10000
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
         if app is not None:  # pragma: no cover
             self.init_app(app)
 
     def init_app(self, app):
-        cp = CryptoPAn(app.config.get('CRYPTOPAN_KEY'))
-        self.ip = cp.anonymize
+        self._cp = CryptoPAn(app.config.get('CRYPTOPAN_KEY'))
+        self.cache_size = app.config.get('ANONYMIZER_CACHE_SIZE',
+                                         self.cache_size)
+        with self._lock:
+            self._cache.clear()
+
+    def ip(self, addr):
+        """Return the anonymized address."""
+        anonymized = self._get_cached(addr)
+        if anonymized is None:
+            anonymized = self._cp.anonymize(addr)
+            self._set_cached(addr, anonymized)
+        return anonymized
+
+    def ips(self, addrs):
+        """Return the anonymized addresses in the same order.
+
+        The addresses are anonymized sorted, so the bits of the prefix
+        shared with the previous address are not encrypted again.
+        """
+        anonymized = {}
+        parsed = {4: [], 6: []}
+        for addr in set(addrs):
+            cached = self._get_cached(addr)
+            if cached is not None:
+                anonymized[addr] = cached
+                continue
+            value = _parse(addr)
+            if value is None:
+                # Let CryptoPAn deal with the formats it accepts or raise
+                anonymized[addr] = self.ip(addr)
+            else:
+                parsed[value[0]].append((value[1], addr))
+        for version, values in parsed.iteritems():
+            for value, addr in self._anonymize_sorted(version, values):
+                anonymized[addr] = value
+                self._set_cached(addr, value)
+        return [anonymized[addr] for addr in addrs]
+
+    def _anonymize_sorted(self, version, values):
+        pos_max = 32 if version == 4 else 128
+        flips = [0] * pos_max
+        previous = None
+        for value, addr in sorted(values):
+            if previous is None:
+                start = 0
+            else:
+                common = pos_max - (previous ^ value).bit_length()
+                start = min(common + 1, pos_max)
+            self._compute_flips(value << (128 - pos_max), start, flips)
+            previous = value
+            result = int(''.join(str(flip) for flip in flips), 2)
+            yield _format(value ^ result, version), addr
+
+    def _compute_flips(self, ext_addr, start, flips):
+        # Same computation as CryptoPAn.anonymize_bin from bit start on
+        cp = self._cp
+        for pos in range(start, len(flips)):
+            prefix = ext_addr >> (128 - pos) << (128 - pos)
+            padded_addr = prefix | (cp._padding_int & cp._masks[pos])
+            encrypted = cp._cipher.encrypt(
+                cp._to_array(padded_addr, 16).tostring())
+            flips[pos] = ord(encrypted[0]) >> 7
+
+    def _get_cached(self, addr):
+        with self._lock:
+            anonymized = self._cache.pop(addr, None)
+            if anonymized is not None:
+                self._cache[addr] = anonymized
+            return anonymized
+
+    def _set_cached(self, addr, anonymized):
+        with self._lock:
+            self._cache.pop(addr, None)
+            self._cache[addr] = anonymized
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+def _parse(addr):
+    """Return the version and the integer value of an address or None."""
+    for family, version in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+        try:
+            packed = socket.inet_pton(family, addr)
+        except (socket.error, TypeError, ValueError, UnicodeError):
+            continue
+        return version, int(binascii.hexlify(packed), 16)
+    return None
+
+
+def _format(value, version):
+    """Format an address as CryptoPAn does."""
+    if version == 4:
+        return '%d.%d.%d.%d' % (value >> 24, (value >> 16) & 0xff,
+                                (value >> 8) & 0xff, value & 0xff)
+    return ':'.join('%x' % ((value >> shift) & 0xffff)
+                    for shift in range(112, -1, -16))
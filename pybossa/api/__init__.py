@@ -51,7 +51,7 @@ from os.path import join
 import io
 import re
 import requests
-from anno import Anno
+from anno import Anno, ElementIndex
 
 """"""
 import json
@@ -95,6 +95,7 @@ pg = None
 root = None
 annos = []
 tree = None
+index = None
 
 @blueprint.route('/')
 @ratelimit(limit=ratelimits.get('LIMIT'), per=ratelimits.get('PER'))
@@ -173,6 +174,14 @@ def new_task(project_id):
         return error.format_exception(e, target='project', action='GET')
 
 
+@csrf.exempt
+@blueprint.route('/project/<int:project_id>/taskrun/bulk', methods=['POST'])
+@ratelimit(limit=ratelimits.get('LIMIT'), per=ratelimits.get('PER'))
+def bulk_taskrun(project_id):
+    """Submit a list of task runs of a project."""
+    return TaskRunAPI().post_bulk(project_id)
+
+
 def _retrieve_new_task(project_id):
 
     project = project_repo.get(project_id)
@@ -340,7 +349,7 @@ def submittask(project_id=None, short_name=None):
     return "ok", 200
 
 def init(url,short_name):
-    global pg, root, tree
+    global pg, root, tree, index
 
     r = requests.get(url, verify=False)
     try:
@@ -363,26 +372,27 @@ def init(url,short_name):
     tree = etree.parse("result-file/%s/tmp.xml" % short_name, parser)
     root = tree.getroot()
     root = clear_xml(root)
+    index = ElementIndex(root)
 
 def add_anno(r_anno):
-    global annos, root, pg
+    global annos, pg, index
     anno = tranform(pg, r_anno)
-    tag_covered = anno.browse(root)
+    tag_covered = anno.find_covered(index)
     anno.elements = tag_covered
     annos.append(anno)
 
 def finish(url, short_name,current_user):
-    global pg, root, annos, tree
+    global pg, root, annos, tree, index
     filename = url.split('/')[-1].split('.')[0] + '-' + str(current_user.id)
     PATH_XML = 'result-file/%s/%s.xml' % (short_name,filename)
     # print (PATH_XML)
     for anno in annos:
-        add_annotate_tag(anno)
-    merge_annotate_tag(root)
+        add_annotate_tag(anno, index.boxes)
+    merge_annotate_tag(root, index.boxes)
     tree.write(PATH_XML, pretty_print=True)
     os.remove('result-file/%s/tmp.xml' % short_name)
     os.remove('result-file/%s/tmp.pdf' % short_name)
-    pg, root, annos = (None, None, [])
+    pg, root, annos, index = (None, None, [], None)
 
 
 def convert_xml(inf, outf, page_numbers=None, output_type='xml', codec='utf-8', laparams=None,
@@ -441,13 +451,16 @@ def clear_xml(tag):
 
 
 # Search frame of tag, is bottom-left and top-right
-def get_border_of_elements(elements):
+def get_border_of_elements(elements, boxes=None):
     bx1 = 99999
     by1 = 99999
     bx2 = -99999
     by2 = -99999
     for i in elements:
-        x1, y1, x2, y2 = [float(x) for x in i.attrib['bbox'].split(',')]
+        if boxes is not None and i in boxes:
+            x1, y1, x2, y2 = boxes[i]
+        else:
+            x1, y1, x2, y2 = [float(x) for x in i.attrib['bbox'].split(',')]
         if x1 < bx1:
             bx1 = x1
         if y1 < by1:
@@ -460,7 +473,7 @@ def get_border_of_elements(elements):
     return (bbox)
 
 # Add frame anno
-def add_annotate_tag(anno):
+def add_annotate_tag(anno, boxes=None):
     # print anno.elements
     for element in anno.elements:
         parent = element.getparent()
@@ -473,28 +486,33 @@ def add_annotate_tag(anno):
         anno_tag = etree.Element("Annotate")
         anno_tag.set("bbox", bbox)
         anno_tag.set("label", anno.label)
+        if boxes is not None and element in boxes:
+            boxes[anno_tag] = boxes[element]
         anno_tag.insert(len(anno_tag), element)
         parent.insert(index, anno_tag)
 
 
 # Merge nearest annotate tag
-def merge_annotate_tag(tag):
+def merge_annotate_tag(tag, boxes=None):
     index = 0
     while True:
         if index >= len(tag):
             break
         inner_tag = tag[index]
-        merge_annotate_tag(inner_tag)
+        merge_annotate_tag(inner_tag, boxes)
         if inner_tag.tag == "Annotate":
             anno_tag = etree.Element("Annotate")
             label = inner_tag.attrib['label']
             i = index
             while i < len(tag) and tag[i].tag == "Annotate" and tag[i].attrib['label'] == label:
-                merge_annotate_tag(tag[i])
+                merge_annotate_tag(tag[i], boxes)
                 for tg in tag[i]:
                     anno_tag.insert(len(anno_tag), tg)
                 tag.remove(tag[i])
-            anno_tag.set('bbox', get_border_of_elements(anno_tag))
+            bbox = get_border_of_elements(anno_tag, boxes)
+            if boxes is not None:
+                boxes[anno_tag] = tuple(float(x) for x in bbox.split(','))
+            anno_tag.set('bbox', bbox)
             anno_tag.set('label', inner_tag.attrib['label'])
             tag.insert(index, anno_tag)
         index += 1
@@ -1,3 +1,55 @@
+from lxml import etree
+from math import floor
+
+CELL_SIZE = 50
+
+
+def parse_bbox(tag):
+    return tuple(float(x) for x in tag.attrib['bbox'].split(','))
+
+
+class ElementIndex:
+    """Bboxes of a pdfminer XML document, parsed once and laid out in a
+    grid per page, so the elements overlapping an annotation are found by
+    looking up the cells it covers instead of walking the whole tree."""
+    def __init__(self, root, cell_size=CELL_SIZE):
+        self.root = root
+        self.cell_size = cell_size
+        self.boxes = {}
+        self.order = {}
+        self.grids = {}
+        for child in root.iterchildren(tag=etree.Element):
+            page = None
+            if child.tag == "page":
+                page = int(child.attrib["id"])
+            grid = self.grids.setdefault(page, {})
+            for element in child.iter(tag=etree.Element):
+                if "bbox" not in element.attrib:
+                    continue
+                box = parse_bbox(element)
+                self.boxes[element] = box
+                self.order[element] = len(self.order)
+                for cell in self.cells(box):
+                    grid.setdefault(cell, []).append(element)
+
+    def cells(self, box):
+        x1, y1, x2, y2 = [int(floor(v / self.cell_size)) for v in box]
+        for cx in range(x1, x2 + 1):
+            for cy in range(y1, y2 + 1):
+                yield cx, cy
+
+    # elements of the page of the annotation whose cells it covers
+    def candidates(self, box, page):
+        found = set()
+        for key in (page, None):
+            grid = self.grids.get(key)
+            if not grid:
+                continue
+            for cell in self.cells(box):
+                found.update(grid.get(cell, ()))
+        return sorted(found, key=self.order.get)
+
+
 class Anno:
     def __init__(self, x1, y1, x2, y2, page, annotype, label):
         self.x1 = x1
@@ -15,7 +67,10 @@ class Anno:
     def is_covered(self, tag):
         if "bbox" not in tag.attrib:
             return False
-        tagx1, tagy1, tagx2, tagy2 = [float(x) for x in tag.attrib['bbox'].split(',')]
+        return self.covers(parse_bbox(tag))
+
+    def covers(self, box):
+        tagx1, tagy1, tagx2, tagy2 = box
         if self.x1 <= tagx1 and self.y1 <= tagy1 and self.x2 >= tagx2 and self.y2 >= tagy2:
             return True
         else:
@@ -26,15 +81,21 @@ class Anno:
     def is_completely_not_covered(self, tag):
         if "bbox" not in tag.attrib:
             return True
-        tagx1, tagy1, tagx2, tagy2 = [float(x) for x in tag.attrib['bbox'].split(',')]
+        return not self.overlaps(parse_bbox(tag))
+
+    def overlaps(self, box):
+        tagx1, tagy1, tagx2, tagy2 = box
         if self.x1 > tagx2 or self.x2 < tagx1 or self.y1 > tagy2 or self.y2 < tagy1:
-            return True
-        else :
             return False
+        else :
+            return True
 
 
     def is_nearly_covered(self, tag):
-        tagx1, tagy1, tagx2, tagy2 = [float(x) for x in tag.attrib['bbox'].split(',')]
+        return self.nearly_covers(parse_bbox(tag))
+
+    def nearly_covers(self, box):
+        tagx1, tagy1, tagx2, tagy2 = box
         k1 = [self.x1, self.x2, tagx1, tagx2]
         k1.sort()
         subx1, subx2 = k1[1:3]
@@ -76,10 +137,10 @@ class Anno:
             return False
 
     #Check is covered line
-    def isCoveredLine(self, tag):
+    def isCoveredLine(self, tag, box=None):
         if "bbox" and "size" not in tag.attrib:
             return False
-        tagx1, tagy1, tagx2, tagy2 = [float(x) for x in tag.attrib['bbox'].split(',')]
+        tagx1, tagy1, tagx2, tagy2 = box or parse_bbox(tag)
         size = float(tag.attrib['size']) / 2
         newx1 = self.x1
         newx2 = self.x2
@@ -108,3 +169,41 @@ class Anno:
                     tc = self.browse(inner_tag)
                     if len(tc) > 0: tag_covered += tc
         return tag_covered
+
+    # Same elements as browse(index.root), looking up the index
+    def find_covered(self, index):
+        matched = {}
+
+        def is_matched(tag):
+            if tag not in matched:
+                box = index.boxes[tag]
+                matched[tag] = (self.covers(box) or
+                                self.nearly_covers(box) or
+                                self.isCoveredLine(tag, box))
+            return matched[tag]
+
+        def is_browsed(tag):
+            # browse only walks into overlapping tags which are not matched
+            if tag not in index.boxes or not self.overlaps(index.boxes[tag]):
+                return False
+            if tag.tag == "page" and int(tag.attrib["id"]) != self.page:
+                return False
+            return not is_matched(tag)
+
+        box = (self.x1, self.y1, self.x2, self.y2)
+        tag_covered = []
+        for tag in index.candidates(box, self.page):
+            if not self.overlaps(index.boxes[tag]):
+                continue
+            if tag.tag == "page" and int(tag.attrib["id"]) != self.page:
+                continue
+            if not is_matched(tag):
+                continue
+            parent = tag.getparent()
+            while parent is not None and parent is not index.root:
+                if not is_browsed(parent):
+                    break
+                parent = parent.getparent()
+            else:
+                tag_covered.append(tag)
+        return tag_covered
@@ -27,11 +27,14 @@ This package adds GET, POST, PUT and DELETE methods for any class:
 
 """
 import json
+from collections import defaultdict
+from itertools import islice
 from flask import request, abort, Response, current_app
+from flask import stream_with_context
 from flask_login import current_user
 from flask.views import MethodView
 from werkzeug.exceptions import NotFound, Unauthorized, Forbidden
-from werkzeug.exceptions import MethodNotAllowed
+from werkzeug.exceptions import MethodNotAllowed, BadRequest
 from pybossa.util import jsonpify, fuzzyboolean, get_avatar_url
 from pybossa.util import get_user_id_or_ip
 from pybossa.core import ratelimits, uploader
@@ -49,6 +52,9 @@ from pybossa.cache.projects import clean_project
 from pybossa.cache.users import delete_user_summary_id
 from pybossa.cache.categories import reset
 
+# Items expanded and serialized at a time when streaming
+STREAM_CHUNK_SIZE = 100
+
 repos = {'Task': {'repo': task_repo, 'filter': 'filter_tasks_by',
                   'get': 'get_task', 'save': 'save', 'update': 'update',
                   'delete': 'delete'},
@@ -134,6 +140,8 @@ class APIBase(MethodView):
         """
         try:
             ensure_authorized_to('read', self.__class__)
+            if oid is None and self._stream_requested():
+                return self._stream_response()
             query = self._db_query(oid)
             json_response = self._create_json_response(query, oid)
             return Response(json_response, mimetype='application/json')
@@ -146,20 +154,24 @@ class APIBase(MethodView):
     def _create_json_response(self, query_result, oid):
         if len(query_result) == 1 and query_result[0] is None:
             raise abort(404)
-        items = []
+        rows = []
         for result in query_result:
             # This is for n_favs orderby case
             if not isinstance(result, DomainObject):
                 if 'n_favs' in result.keys():
                     result = result[0]
+            if (result.__class__ != self.__class__):
+                (item, headline, rank) = result
+            else:
+                item = result
+                headline = None
+                rank = None
+            rows.append((item, headline, rank))
+        expanded = self._expand([row[0] for row in rows])
+        items = []
+        for item, headline, rank in rows:
             try:
-                if (result.__class__ != self.__class__):
-                    (item, headline, rank) = result
-                else:
-                    item = result
-                    headline = None
-                    rank = None
-                datum = self._create_dict_from_model(item)
+                datum = self._create_dict_from_model(item, expanded)
                 if headline:
                     datum['headline'] = headline
                 if rank:
@@ -176,47 +188,119 @@ class APIBase(MethodView):
             items = items[0]
         return json.dumps(items)
 
-    def _create_dict_from_model(self, model):
-        return self._select_attributes(self._add_hateoas_links(model))
+    def _stream_requested(self):
+        stream = request.args.get('stream')
+        return fuzzyboolean(stream) if stream else False
+
+    def _stream_response(self):
+        """Return the items as a stream of JSON lines.
 
-    def _add_hateoas_links(self, item):
+        Items are read from the DB in batches using keyset pagination on id,
+        so the page size is not capped. The last line holds the cursor to
+        get the next page, or null if there are no more items.
+        """
+        if request.args.get('fulltextsearch'):
+            raise BadRequest('fulltextsearch is not supported when streaming')
+        if request.args.get('orderby', 'id') != 'id':
+            raise BadRequest('Streamed items can only be ordered by id')
+        try:
+            limit = int(request.args.get('limit'))
+        except (ValueError, TypeError):
+            limit = None
+        if limit is not None and limit <= 0:
+            limit = None
+        repo_info = repos[self.__class__.__name__]
+        results = self._filter_query(repo_info, limit, 0, 'id', yielded=True)
+        return Response(stream_with_context(self._stream_items(results,
+                                                               limit)),
+                        mimetype='application/x-ndjson')
+
+    def _stream_items(self, results, limit):
+        last_id = None
+        count = 0
+        results = iter(results)
+        while True:
+            chunk = list(islice(results, STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            count += len(chunk)
+            last_id = chunk[-1].id
+            expanded = self._expand(chunk)
+            for item in chunk:
+                try:
+                    ensure_authorized_to('read', item)
+                except (Forbidden, Unauthorized):
+                    continue
+                datum = self._create_dict_from_model(item, expanded)
+                yield json.dumps(datum) + '\n'
+        cursor = None
+        if limit is not None and count == limit:
+            cursor = dict(last_id=last_id)
+        yield json.dumps(dict(cursor=cursor)) + '\n'
+
+    def _create_dict_from_model(self, model, expanded=None):
+        if expanded is None:
+            expanded = self._expand([model])
+        return self._select_attributes(self._add_hateoas_links(model,
+                                                               expanded))
+
+    def _expand(self, items):
+        """Return the related objects and stats requested for the items.
+
+        They are fetched with one query per relation for all the items and
+        returned as a dict with the attributes to add to each item by id.
+        """
+        expanded = defaultdict(dict)
+        items = [item for item in items if item is not None]
+        if not items:
+            return expanded
+        cls_name = items[0].__class__.__name__
+        if request.args.get('related'):
+            if cls_name == 'Task':
+                task_ids = [item.id for item in items]
+                for item in items:
+                    expanded[item.id].update(task_runs=[], result=None)
+                for tr in task_repo.filter_task_runs_by_task_ids(task_ids):
+                    expanded[tr.task_id]['task_runs'].append(tr.dictize())
+                for r in result_repo.filter_by_task_ids(task_ids):
+                    expanded[r.task_id]['result'] = r.dictize()
+
+            if cls_name == 'TaskRun':
+                task_ids = [item.task_id for item in items]
+                tasks = dict((t.id, t.dictize()) for t in
+                             task_repo.filter_tasks_by_ids(task_ids))
+                results = dict((r.task_id, r.dictize()) for r in
+                               result_repo.filter_by_task_ids(task_ids))
+                for item in items:
+                    expanded[item.id].update(task=tasks.get(item.task_id),
+                                             result=results.get(item.task_id))
+
+            if cls_name == 'Result':
+                task_ids = [item.task_id for item in items]
+                tasks = dict((t.id, t.dictize()) for t in
+                             task_repo.filter_tasks_by_ids(task_ids))
+                task_runs = defaultdict(list)
+                for tr in task_repo.filter_task_runs_by_task_ids(task_ids):
+                    task_runs[tr.task_id].append(tr.dictize())
+                for item in items:
+                    expanded[item.id]['task_runs'] = task_runs[item.task_id]
+                    if item.task_id in tasks:
+                        expanded[item.id]['task'] = tasks[item.task_id]
+
+        if request.args.get('stats'):
+            if cls_name == 'Project':
+                stats = {}
+                project_ids = [item.id for item in items]
+                for ps in project_stats_repo.filter_by_project_ids(project_ids):
+                    stats.setdefault(ps.project_id, ps.dictize())
+                for item in items:
+                    expanded[item.id]['stats'] = stats.get(item.id, {})
+        return expanded
+
+    def _add_hateoas_links(self, item, expanded=None):
         obj = item.dictize()
-        related = request.args.get('related')
-        if related:
-            if item.__class__.__name__ == 'Task':
-                obj['task_runs'] = []
-                obj['result'] = None
-                task_runs = task_repo.filter_task_runs_by(task_id=item.id)
-                results = result_repo.filter_by(task_id=item.id, last_version=True)
-                for tr in task_runs:
-                    obj['task_runs'].append(tr.dictize())
-                for r in results:
-                    obj['result'] = r.dictize()
-
-            if item.__class__.__name__ == 'TaskRun':
-                tasks = task_repo.filter_tasks_by(id=item.task_id)
-                results = result_repo.filter_by(task_id=item.task_id, last_version=True)
-                obj['task'] = None
-                obj['result'] = None
-                for t in tasks:
-                    obj['task'] = t.dictize()
-                for r in results:
-                    obj['result'] = r.dictize()
-
-            if item.__class__.__name__ == 'Result':
-                tasks = task_repo.filter_tasks_by(id=item.task_id)
-                task_runs = task_repo.filter_task_runs_by(task_id=item.task_id)
-                obj['task_runs'] = []
-                for t in tasks:
-                    obj['task'] = t.dictize()
-                for tr in task_runs:
-                    obj['task_runs'].append(tr.dictize())
-
-        stats = request.args.get('stats')
-        if stats:
-            if item.__class__.__name__ == 'Project':
-                stats = project_stats_repo.filter_by(project_id=item.id, limit=1)
-                obj['stats'] = stats[0].dictize() if stats else {}
+        if expanded:
+            obj.update(expanded.get(item.id, {}))
 
         links, link = self.hateoas.create_links(item)
         if links:
@@ -244,12 +328,13 @@ class APIBase(MethodView):
             del filters['owner_id']
         return filters
 
-    def _filter_query(self, repo_info, limit, offset, orderby):
+    def _filter_query(self, repo_info, limit, offset, orderby,
+                      yielded=False):
         filters = {}
         for k in request.args.keys():
             if k not in ['limit', 'offset', 'api_key', 'last_id', 'all',
                          'fulltextsearch', 'desc', 'orderby', 'related',
-                         'participated', 'full', 'stats']:
+                         'participated', 'full', 'stats', 'stream']:
                 # Raise an error if the k arg is not a column
                 if self.__class__ == Task and k == 'external_uid':
                     pass
@@ -266,8 +351,9 @@ class APIBase(MethodView):
         fulltextsearch = request.args.get('fulltextsearch')
         desc = request.args.get('desc') if request.args.get('desc') else False
         desc = fuzzyboolean(desc)
-        if last_id:
+        if last_id or yielded:
             results = getattr(repo, query_func)(limit=limit, last_id=last_id,
+                                                yielded=yielded,
                                                 fulltextsearch=fulltextsearch,
                                                 desc=False,
                                                 orderby=orderby,
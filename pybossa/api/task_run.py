@@ -21,22 +21,24 @@ PYBOSSA api module for exposing domain object TaskRun via an API.
 This package adds GET, POST, PUT and DELETE methods for:
     * task_runs
 
+and a POST method to submit several task runs of a project at once.
+
 """
 import json
 import time
 from flask import request, Response, current_app
 from flask_login import current_user
 from pybossa.model.task_run import TaskRun
-from werkzeug.exceptions import Forbidden, BadRequest
+from werkzeug.exceptions import Forbidden, BadRequest, NotFound
 
-from api_base import APIBase
+from api_base import APIBase, error
 from pybossa.util import get_user_id_or_ip, get_avatar_url
 from pybossa.core import task_repo, sentinel, anonymizer, project_repo
 from pybossa.core import uploader
 from pybossa.contributions_guard import ContributionsGuard
 from pybossa.auth import jwt_authorize_project
 from pybossa.auth import ensure_authorized_to, is_authorized
-from pybossa.sched import can_post
+from pybossa.sched import can_post, can_post_many
 
 
 class TaskRunAPI(APIBase):
@@ -61,6 +63,121 @@ class TaskRunAPI(APIBase):
         self._add_user_info(taskrun)
         self._add_created_timestamp(taskrun, task, guard)
 
+    def post_bulk(self, project_id):
+        """Post a list of task runs of a project.
+
+        Returns the status of every task run, in the same order.
+        """
+        try:
+            data = json.loads(request.data)
+            if not isinstance(data, list):
+                raise BadRequest('A list of task runs is expected')
+            max_size = current_app.config.get('TASK_RUN_BULK_MAX_SIZE')
+            if len(data) > max_size:
+                raise BadRequest('Up to %s task runs can be posted at once'
+                                 % max_size)
+            project = project_repo.get(project_id)
+            if project is None:
+                raise NotFound('Invalid project_id')
+            if (current_user.is_anonymous() and
+                    project.allow_anonymous_contributors is False):
+                raise Forbidden('Anonymous contributors are not allowed')
+            statuses = self._save_bulk(project, data)
+            return Response(json.dumps(statuses), mimetype='application/json')
+        except Exception as e:
+            return error.format_exception(e, target='taskrun', action='POST')
+
+    def _save_bulk(self, project, data):
+        user = get_user_id_or_ip()
+        statuses = [None] * len(data)
+        taskruns = []
+        for index, item in enumerate(data):
+            try:
+                taskruns.append((index, self._create_bulk_instance(project,
+                                                                   item)))
+            except Exception as e:
+                statuses[index] = self._bulk_error(e)
+        task_ids = [taskrun.task_id for _, taskrun in taskruns]
+        tasks = dict((task.id, task)
+                     for task in task_repo.get_tasks(project.id, task_ids))
+        allowed = can_post_many(project.id, task_ids, user)
+        contributor = None
+        answered = set()
+        if taskruns:
+            contributor = self._contributor(taskruns[0][1])
+            answered = task_repo.get_answered_task_ids(project.id, task_ids,
+                                                       *contributor)
+        guard = ContributionsGuard(sentinel.master)
+        requested = [tasks[task_id] for task_id in task_ids
+                     if task_id in tasks]
+        stamps = dict((task.id, stamp) for task, stamp in
+                      zip(requested, guard.retrieve_timestamps(requested,
+                                                               user)))
+        jwt_error = None
+        if any(taskrun.external_uid for _, taskrun in taskruns):
+            jwt_error = self._authorize_external_uid(project)
+        valid = []
+        for index, taskrun in taskruns:
+            try:
+                if self._contributor(taskrun) != contributor:
+                    raise BadRequest('Task runs must have the same '
+                                     'contributor')
+                if taskrun.task_id not in allowed:
+                    raise Forbidden('You must request a task first!')
+                if taskrun.task_id not in tasks:
+                    raise Forbidden('Invalid task_id')
+                if taskrun.external_uid and jwt_error:
+                    raise Forbidden(jwt_error)
+                if stamps.get(taskrun.task_id) is None:
+                    raise Forbidden('You must request a task first!')
+                if taskrun.task_id in answered:
+                    raise Forbidden('You have already answered this task')
+                answered.add(taskrun.task_id)
+                taskrun.created = stamps[taskrun.task_id]
+                valid.append((index, taskrun))
+            except Exception as e:
+                statuses[index] = self._bulk_error(e)
+        task_repo.save_task_runs(project.id,
+                                 [taskrun for _, taskrun in valid])
+        guard._remove_tasks_stamped([tasks[taskrun.task_id]
+                                     for _, taskrun in valid], user)
+        for index, taskrun in valid:
+            statuses[index] = dict(status='success', status_code=200,
+                                   taskrun=taskrun.dictize())
+        return statuses
+
+    def _create_bulk_instance(self, project, data):
+        if not isinstance(data, dict):
+            raise BadRequest('Invalid task run')
+        self._forbidden_attributes(data)
+        data = self.hateoas.remove_links(data)
+        data.setdefault('project_id', project.id)
+        taskrun = self.__class__(**data)
+        if taskrun.project_id != project.id:
+            raise Forbidden('Invalid project_id')
+        if taskrun.task_id is None:
+            raise BadRequest('task_id is required')
+        self._add_user_info(taskrun)
+        return taskrun
+
+    def _contributor(self, taskrun):
+        return (taskrun.user_id, taskrun.user_ip, taskrun.external_uid)
+
+    def _authorize_external_uid(self, project):
+        resp = jwt_authorize_project(project,
+                                     request.headers.get('Authorization'))
+        if type(resp) == Response:
+            return json.loads(resp.data)['description']
+        return None
+
+    def _bulk_error(self, e):
+        exception_cls = e.__class__.__name__
+        message = getattr(e, 'description', None) or str(e)
+        return dict(status='failed',
+                    status_code=error.error_status.get(exception_cls, 500),
+                    exception_cls=exception_cls,
+                    exception_msg=message)
+
     def _forbidden_attributes(self, data):
         for key in data.keys():
             if key in self.reserved_keys:
@@ -24,12 +24,34 @@ It exports:
     * memoize: for caching functions using its arguments as part of the key
     * delete_cached: to remove a cached value
     * delete_memoized: to remove a cached value from the memoize decorator
+    * delete_memoized_project: to remove the memoized values of a project
+    * get_memoized_many: to get the memoized values of many calls at once
+    * get_cache_stats: hit and miss counters of the cached functions
+
+Every memoized value is indexed in a tag (a sorted set scored by expiration
+time) of its function and, if the decorator is called with tag_project, of
+its project. Invalidating all the values of a function or a project walks
+the tag instead of scanning the whole keyspace.
+
+Decorators called with stale_timeout protect expensive functions from
+stampedes: an expired value is still served for stale_timeout seconds while
+a single worker, holding a lock, recomputes it.
+
+Both decorators accept a local_timeout. When CACHE_L1_ENABLED is set, the
+values of those functions are also kept for local_timeout seconds in an in
+process LRU cache in front of Redis. Deletions are broadcast to every worker
+through Redis pub/sub.
 
 """
 import os
+import time
 import hashlib
+import threading
+import uuid
 from functools import wraps
+from redis.exceptions import ResponseError
 from pybossa.core import sentinel
+from pybossa.cache.local_cache import LocalCache
 
 try:
     import cPickle as pickle
@@ -47,6 +69,21 @@ ONE_HOUR = 60 * 60
 HALF_HOUR = 30 * 60
 FIVE_MINUTES = 5 * 60
 
+L1_CHANNEL = 'pybossa:cache:l1:invalidate'
+TAG_BATCH_SIZE = 500
+REFRESH_LOCK_TIMEOUT = 10 * 60
+REFRESH_WAIT = 0.1
+REFRESH_MAX_WAIT = 10
+SUBSCRIBE_WAIT = 1
+
+local_cache = LocalCache(
+    max_items=getattr(settings, 'CACHE_L1_MAX_ITEMS', 1000),
+    max_bytes=getattr(settings, 'CACHE_L1_MAX_BYTES', 32 * 1024 * 1024))
+
+_stats = dict()
+_listener = dict(pid=None, subscribed=threading.Event())
+_listener_lock = threading.Lock()
+
 
 def get_key_to_hash(*args, **kwargs):
     """Return key to hash for *args and **kwargs."""
@@ -67,7 +104,240 @@ def get_hash_key(prefix, key_to_hash):
     return key
 
 
-def cache(key_prefix, timeout=300):
+def get_tag_key(kind, name):
+    """Return the key of the tag indexing the memoized values of name."""
+    return "%s:tag:%s:%s" % (settings.REDIS_KEYPREFIX, kind, name)
+
+
+def _tag(pipeline, tag, key, timeout):
+    now = time.time()
+    pipeline.zadd(tag, now + timeout, key)
+    # Drop the values already expired so tags do not grow unbounded
+    pipeline.zremrangebyscore(tag, '-inf', now)
+    pipeline.expire(tag, max(timeout, ONE_DAY))
+
+
+def _delete_tagged(tag):
+    """Delete the values indexed in a tag and return the keys deleted."""
+    # Work on a snapshot, so values stored meanwhile land in a new tag
+    snapshot = '%s:deleting:%s' % (tag, uuid.uuid4().hex)
+    try:
+        sentinel.master.rename(tag, snapshot)
+    except ResponseError:
+        return []
+    deleted = []
+    batch = []
+    for key, _ in sentinel.master.zscan_iter(snapshot, count=TAG_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) == TAG_BATCH_SIZE:
+            sentinel.master.delete(*batch)
+            deleted.extend(batch)
+            batch = []
+    if batch:
+        sentinel.master.delete(*batch)
+        deleted.extend(batch)
+    sentinel.master.delete(snapshot)
+    return deleted
+
+
+def get_cache_stats():
+    """Return the hit and miss counters of every cached function."""
+    return dict((name, dict(counters)) for name, counters in _stats.items())
+
+
+def _get_stats(name):
+    return _stats.setdefault(name, dict(local_hits=0, hits=0, misses=0,
+                                        refreshes=0))
+
+
+def local_cache_enabled():
+    """Return True if the in process cache is enabled."""
+    return (getattr(settings, 'CACHE_L1_ENABLED', False) and
+            os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None)
+
+
+def _start_invalidation_listener():
+    """Start the listener of the invalidations of this process, waiting up
+    to SUBSCRIBE_WAIT seconds for it to be subscribed."""
+    pid = os.getpid()
+    if _listener['pid'] == pid:
+        return
+    with _listener_lock:
+        if _listener['pid'] == pid:
+            return
+        # Forked workers do not inherit the thread, nor can trust the values
+        local_cache.clear()
+        subscribed = threading.Event()
+        thread = threading.Thread(target=_listen_invalidations,
+                                  args=(subscribed,),
+                                  name='pybossa-cache-l1-invalidation')
+        thread.daemon = True
+        thread.start()
+        _listener['subscribed'] = subscribed
+        _listener['pid'] = pid
+    subscribed.wait(SUBSCRIBE_WAIT)
+
+
+def _listening():
+    """Return True if the invalidations reach the local cache, so values
+    can be stored in it."""
+    return (_listener['pid'] == os.getpid() and
+            _listener['subscribed'].is_set())
+
+
+def _listen_invalidations(subscribed):  # pragma: no cover
+    while True:
+        try:
+            pubsub = sentinel.master.pubsub()
+            pubsub.subscribe(L1_CHANNEL)
+            for message in pubsub.listen():
+                if message['type'] == 'subscribe':
+                    subscribed.set()
+                elif message['type'] == 'message':
+                    _invalidate_local(message['data'])
+        except Exception:
+            # Invalidations may have been missed while disconnected
+            subscribed.clear()
+            local_cache.clear()
+            time.sleep(1)
+
+
+def _invalidate_local(message):
+    kind, _, key = message.partition(' ')
+    if kind == 'prefix':
+        local_cache.delete_prefix(key)
+    elif kind == 'keys':
+        for k in key.split(' '):
+            local_cache.delete(k)
+    else:
+        local_cache.delete(key)
+
+
+def _publish_invalidation(kind, key):
+    if local_cache_enabled():
+        message = '%s %s' % (kind, key)
+        _invalidate_local(message)
+        sentinel.master.publish(L1_CHANNEL, message)
+
+
+def _set_cached(key, output, timeout, tags):
+    if not tags:
+        sentinel.master.setex(key, timeout, output)
+        return
+    pipeline = sentinel.master.pipeline(transaction=False)
+    pipeline.setex(key, timeout, output)
+    for tag in tags:
+        _tag(pipeline, tag, key, timeout)
+    pipeline.execute()
+
+
+def get_refresh_lock_key(key):
+    """Return the key of the lock held by the worker refreshing key."""
+    return '%s:refresh' % key
+
+
+def _acquire_refresh_lock(key):
+    return bool(sentinel.master.set(get_refresh_lock_key(key), 1,
+                                    ex=REFRESH_LOCK_TIMEOUT, nx=True))
+
+
+def _release_refresh_lock(key):
+    sentinel.master.delete(get_refresh_lock_key(key))
+
+
+def _wait_for_value(key):
+    waited = 0
+    while waited < REFRESH_MAX_WAIT:
+        time.sleep(REFRESH_WAIT)
+        waited += REFRESH_WAIT
+        output = sentinel.master.get(key)
+        if output:
+            return output
+        if not sentinel.master.exists(get_refresh_lock_key(key)):
+            return None
+    return None
+
+
+def refresh_in_background():
+    """Return True if stale values are refreshed by an RQ worker."""
+    return getattr(settings, 'CACHE_REFRESH_IN_BACKGROUND', False)
+
+
+def _schedule_refresh(f, *args, **kwargs):
+    from pybossa.jobs import enqueue_job, refresh_cached_function
+    job = dict(name=refresh_cached_function,
+               args=[f.__module__, f.__name__, list(args), kwargs],
+               kwargs={},
+               timeout=REFRESH_LOCK_TIMEOUT,
+               queue='high')
+    enqueue_job(job)
+
+
+def _compute(key, timeout, local_timeout, stale_timeout, tags, f, *args,
+             **kwargs):
+    value = f(*args, **kwargs)
+    output = pickle.dumps(value)
+    _set_cached(key, output, timeout + stale_timeout, tags)
+    if local_timeout and local_cache_enabled() and _listening():
+        local_cache.set(key, output, min(local_timeout, timeout))
+    return value
+
+
+def _get_cached(key, stats, timeout, local_timeout, stale_timeout, tags, f,
+                *args, **kwargs):
+    if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
+        local = bool(local_timeout) and local_cache_enabled()
+        if local:
+            _start_invalidation_listener()
+            output = local_cache.get(key)
+            if output is not None:
+                stats['local_hits'] += 1
+                return pickle.loads(output)
+        if stale_timeout:
+            pipeline = sentinel.slave.pipeline(transaction=False)
+            pipeline.get(key)
+            pipeline.ttl(key)
+            output, ttl = pipeline.execute()
+        else:
+            output, ttl = sentinel.slave.get(key), None
+        if output:
+            stats['hits'] += 1
+            # Stale: a single worker refreshes it, the rest keep using it
+            if (ttl is not None and 0 <= ttl <= stale_timeout and
+                    _acquire_refresh_lock(key)):
+                stats['refreshes'] += 1
+                if refresh_in_background():
+                    _schedule_refresh(f, *args, **kwargs)
+                    return pickle.loads(output)
+                try:
+                    return _compute(key, timeout, local_timeout,
+                                    stale_timeout, tags, f, *args, **kwargs)
+                finally:
+                    _release_refresh_lock(key)
+            if local and _listening():
+                local_cache.set(key, output, min(local_timeout, timeout))
+            return pickle.loads(output)
+        stats['misses'] += 1
+        if stale_timeout:
+            if not _acquire_refresh_lock(key):
+                output = _wait_for_value(key)
+                if output:
+                    return pickle.loads(output)
+            try:
+                return _compute(key, timeout, local_timeout, stale_timeout,
+                                tags, f, *args, **kwargs)
+            finally:
+                _release_refresh_lock(key)
+        return _compute(key, timeout, local_timeout, 0, tags, f, *args,
+                        **kwargs)
+    stats['misses'] += 1
+    value = f(*args, **kwargs)
+    _set_cached(key, pickle.dumps(value), timeout + (stale_timeout or 0),
+                tags)
+    return value
+
+
+def cache(key_prefix, timeout=300, local_timeout=None, stale_timeout=0):
     """
     Decorator for caching functions.
 
@@ -77,52 +347,110 @@ def cache(key_prefix, timeout=300):
     if timeout is None:
         timeout = 300
     def decorator(f):
+        stats = _get_stats(key_prefix)
+        key = "%s::%s" % (settings.REDIS_KEYPREFIX, key_prefix)
         @wraps(f)
         def wrapper(*args, **kwargs):
-            key = "%s::%s" % (settings.REDIS_KEYPREFIX, key_prefix)
-            if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-                output = sentinel.slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
-                return output
-            output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
-            return output
+            return _get_cached(key, stats, timeout, local_timeout,
+                               stale_timeout, None, f, *args, **kwargs)
+        def refresh(*args, **kwargs):
+            try:
+                return _compute(key, timeout, local_timeout, stale_timeout,
+                                None, f, *args, **kwargs)
+            finally:
+                _release_refresh_lock(key)
+        wrapper.cache_stats = stats
+        wrapper.refresh = refresh
         return wrapper
     return decorator
 
 
-def memoize(timeout=300):
+def memoize(timeout=300, local_timeout=None, tag_project=False,
+            stale_timeout=0):
     """
     Decorator for caching functions using its arguments as part of the key.
 
+    With tag_project, the first argument (or project_id keyword) is the
+    project the value belongs to.
+
+    With stale_timeout, values are kept stale_timeout seconds after they
+    expire. Meanwhile only one worker recomputes the value, inline or in the
+    background if CACHE_REFRESH_IN_BACKGROUND is set, while the rest keep
+    getting the stale one.
+
     Returns the cached value, or the function if the cache is disabled
 
     """
     if timeout is None:
         timeout = 300
     def decorator(f):
-        @wraps(f)
-        def wrapper(*args, **kwargs):
+        stats = _get_stats(f.__name__)
+        def get_key_and_tags(args, kwargs):
             key = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, f.__name__)
             key_to_hash = get_key_to_hash(*args, **kwargs)
             key = get_hash_key(key, key_to_hash)
-            if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-                output = sentinel.slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
-                return output
-            output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
-            return output
+            tags = [get_tag_key('function', f.__name__)]
+            if tag_project:
+                project_id = kwargs.get('project_id', args[0] if args else None)
+                tags.append(get_tag_key('project', project_id))
+            return key, tags
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key, tags = get_key_and_tags(args, kwargs)
+            return _get_cached(key, stats, timeout, local_timeout,
+                               stale_timeout, tags, f, *args, **kwargs)
+        def refresh(*args, **kwargs):
+            key, tags = get_key_and_tags(args, kwargs)
+            try:
+                return _compute(key, timeout, local_timeout, stale_timeout,
+                                tags, f, *args, **kwargs)
+            finally:
+                _release_refresh_lock(key)
+        wrapper.cache_stats = stats
+        wrapper.refresh = refresh
+        wrapper.get_key_and_tags = get_key_and_tags
+        wrapper.timeout = timeout + stale_timeout
         return wrapper
     return decorator
 
 
+def get_memoized_many(calls, compute):
+    """
+    Return the values of a list of (memoized function, args) calls.
+
+    The values already cached are read with a single MGET. compute is called
+    once with the calls missing and returns a dict with their values, which
+    are stored back in a pipeline, so they are cached as if each function
+    had been called.
+
+    """
+    values = dict()
+    if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None and calls:
+        keys = [function.get_key_and_tags(args, {})[0]
+                for function, args in calls]
+        for call, output in zip(calls, sentinel.slave.mget(keys)):
+            if output:
+                call[0].cache_stats['hits'] += 1
+                values[call] = pickle.loads(output)
+    missing = [call for call in set(calls) if call not in values]
+    if missing:
+        for function, _ in missing:
+            function.cache_stats['misses'] += 1
+        computed = compute(missing)
+        pipeline = sentinel.master.pipeline(transaction=False)
+        for i, (function, args) in enumerate(missing, 1):
+            key, tags = function.get_key_and_tags(args, {})
+            output = pickle.dumps(computed[(function, args)])
+            pipeline.setex(key, function.timeout, output)
+            for tag in tags:
+                _tag(pipeline, tag, key, function.timeout)
+            if i % TAG_BATCH_SIZE == 0:
+                pipeline.execute()
+        pipeline.execute()
+        values.update(computed)
+    return [values[call] for call in calls]
+
+
 def delete_cached(key):
     """
     Delete a cached value from the cache.
@@ -132,7 +460,9 @@ def delete_cached(key):
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
         key = "%s::%s" % (settings.REDIS_KEYPREFIX, key)
-        return bool(sentinel.master.delete(key))
+        deleted = bool(sentinel.master.delete(key))
+        _publish_invalidation('key', key)
+        return deleted
     return True
 
 
@@ -148,9 +478,25 @@ def delete_memoized(function, *args, **kwargs):
         if args or kwargs:
             key_to_hash = get_key_to_hash(*args, **kwargs)
             key = get_hash_key(key, key_to_hash)
-            return bool(sentinel.master.delete(key))
-        keys_to_delete = sentinel.slave.keys(pattern=key + '*')
-        if not keys_to_delete:
-            return False
-        return bool(sentinel.master.delete(*keys_to_delete))
+            deleted = bool(sentinel.master.delete(key))
+            _publish_invalidation('key', key)
+            return deleted
+        deleted = _delete_tagged(get_tag_key('function', function.__name__))
+        _publish_invalidation('prefix', key)
+        return bool(deleted)
+    return True
+
+
+def delete_memoized_project(project_id):
+    """
+    Delete the memoized values of the functions tagged with the project.
+
+    Returns True if success or no cache is enabled
+
+    """
+    if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
+        deleted = _delete_tagged(get_tag_key('project', project_id))
+        if deleted:
+            _publish_invalidation('keys', ' '.join(deleted))
+        return bool(deleted)
     return True
@@ -17,7 +17,7 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
 from sqlalchemy.sql import text
-from pybossa.cache import cache, delete_cached
+from pybossa.cache import cache, delete_cached, FIVE_MINUTES
 from pybossa.core import db, timeouts
 import pybossa.model as model
 
@@ -25,7 +25,8 @@ import pybossa.model as model
 session = db.slave_session
 
 @cache(key_prefix="categories_all",
-       timeout=timeouts.get('CATEGORY_TIMEOUT'))
+       timeout=timeouts.get('CATEGORY_TIMEOUT'),
+       local_timeout=FIVE_MINUTES)
 def get_all():
     """Return all categories"""
     data = session.query(model.category.Category).all()
@@ -33,7 +34,8 @@ def get_all():
 
 
 @cache(key_prefix="categories_used",
-       timeout=timeouts.get('CATEGORY_TIMEOUT'))
+       timeout=timeouts.get('CATEGORY_TIMEOUT'),
+       local_timeout=FIVE_MINUTES)
 def get_used():
     """Return categories only used by projects"""
     sql = text('''
@@ -0,0 +1,98 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""In process LRU cache used as a first level in front of Redis."""
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class LocalCache(object):
+
+    """Bounded LRU cache of pickled values with a TTL per entry.
+
+    Values are stored as strings, so callers always get their own copy and
+    the size of the cache can be bounded in bytes.
+    """
+
+    def __init__(self, max_items=1000, max_bytes=32 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def size(self):
+        """Return the number of bytes stored."""
+        return self._bytes
+
+    def get(self, key):
+        """Return the value for key or None if missing or expired."""
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            expiration, value = item
+            if expiration < time():
+                self._bytes -= len(value)
+                return None
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds evicting the least recently used."""
+        if len(value) > self.max_bytes or ttl <= 0:
+            return False
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (time() + ttl, value)
+            self._bytes += len(value)
+            while (len(self._data) > self.max_items or
+                   self._bytes > self.max_bytes):
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+        return True
+
+    def delete(self, key):
+        """Remove a key."""
+        with self._lock:
+            return self._pop(key)
+
+    def delete_prefix(self, prefix):
+        """Remove all the keys starting with prefix."""
+        with self._lock:
+            keys = [key for key in self._data if key.startswith(prefix)]
+            for key in keys:
+                self._pop(key)
+            return len(keys)
+
+    def clear(self):
+        """Remove all the keys."""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is None:
+            return False
+        self._bytes -= len(item[1])
+        return True
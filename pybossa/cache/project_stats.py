@@ -19,7 +19,7 @@
 from flask import current_app
 from sqlalchemy.sql import text
 from pybossa.core import db
-from pybossa.cache import memoize, ONE_DAY, FIVE_MINUTES
+from pybossa.cache import memoize, ONE_DAY, ONE_HOUR, FIVE_MINUTES
 import pybossa.cache.projects as cached_projects
 from pybossa.model.project_stats import ProjectStats
 from flask_babel import gettext
@@ -33,7 +33,8 @@ import os
 session = db.slave_session
 
 
-@memoize(timeout=ONE_DAY)
+# Shares its key with cache.projects.n_tasks
+@memoize(timeout=ONE_DAY, tag_project=True)
 def n_tasks(project_id):
     """Return number of tasks of project.
 
@@ -43,7 +44,7 @@ def n_tasks(project_id):
     return projects.n_tasks(project_id)
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, stale_timeout=ONE_HOUR)
 def stats_users(project_id, period=None):
     """Return users's stats for a given project_id."""
     users = {}
@@ -159,7 +160,7 @@ def convert_period_to_days(period):
     return int_period
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, stale_timeout=ONE_HOUR)
 def stats_dates(project_id, period='15 day'):
     """Return statistics with dates for a project."""
     dates = {}
@@ -251,7 +252,7 @@ def stats_dates(project_id, period='15 day'):
     return dates, dates_anon, dates_auth
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, stale_timeout=ONE_HOUR)
 def stats_hours(project_id, period='2 week'):
     """Return statistics of a project per hours."""
     hours = {}
@@ -21,6 +21,8 @@ from pybossa.core import db, timeouts
 from pybossa.model.project import Project
 from pybossa.util import pretty_date
 from pybossa.cache import memoize, cache, delete_memoized, delete_cached
+from pybossa.cache import delete_memoized_project, get_memoized_many
+from pybossa.cache import FIVE_MINUTES
 
 
 session = db.slave_session
@@ -51,20 +53,36 @@ def get_top(n=4):
     return top_projects
 
 
-def browse_tasks(project_id, limit=10, offset=0):
-    """Cache browse tasks view for a project."""
+BROWSE_TASKS_WINDOW = 100
+
+
+def _browse_tasks_filters(state=None, min_pct=None, max_pct=None):
+    """Return the SQL conditions and params filtering the tasks browsed."""
+    pct = '''(CASE WHEN task.n_answers > 0
+             THEN LEAST(CAST(task.n_task_runs AS FLOAT) / task.n_answers, 1)
+             ELSE 0 END)'''
+    sql = ''
+    if state is not None:
+        sql += ' AND task.state=:state'
+    if min_pct is not None:
+        sql += ' AND %s >= :min_pct' % pct
+    if max_pct is not None:
+        sql += ' AND %s <= :max_pct' % pct
+    return sql, dict(state=state, min_pct=min_pct, max_pct=max_pct)
+
+
+def _browse_tasks(project_id, first_id, offset, limit, state, min_pct,
+                  max_pct):
+    filters, params = _browse_tasks_filters(state, min_pct, max_pct)
     sql = text('''
-               SELECT task.id, task.n_answers, sum(counter.n_task_runs) as n_task_runs
-               FROM task, counter
-               WHERE task.id=counter.task_id and task.project_id=:project_id
-               GROUP BY task.id
+               SELECT task.id, task.n_answers, task.n_task_runs FROM task
+               WHERE task.project_id=:project_id AND task.id>=:first_id {}
                ORDER BY task.id ASC LIMIT :limit OFFSET :offset
-               ''')
-    results = session.execute(sql, dict(project_id=project_id,
-                                        limit=limit,
-                                        offset=offset))
+               '''.format(filters))
+    params.update(project_id=project_id, first_id=first_id, limit=limit,
+                  offset=offset)
     tasks = []
-    for row in results:
+    for row in session.execute(sql, params):
         task = dict(id=row.id, n_task_runs=row.n_task_runs,
                     n_answers=row.n_answers)
         task['pct_status'] = _pct_status(row.n_task_runs, row.n_answers)
@@ -72,6 +90,48 @@ def browse_tasks(project_id, limit=10, offset=0):
     return tasks
 
 
+@memoize(timeout=timeouts.get('BROWSE_TASKS_TIMEOUT'), tag_project=True)
+def browse_tasks_windows(project_id, state=None, min_pct=None, max_pct=None):
+    """Return the number of tasks browsed and the first id of every window
+    of BROWSE_TASKS_WINDOW tasks."""
+    filters, params = _browse_tasks_filters(state, min_pct, max_pct)
+    sql = text('''
+               SELECT id, n_tasks FROM (
+               SELECT task.id, ROW_NUMBER() OVER (ORDER BY task.id) AS rank,
+               COUNT(*) OVER () AS n_tasks
+               FROM task WHERE task.project_id=:project_id {}) AS tasks
+               WHERE rank % :window = 1 ORDER BY id
+               '''.format(filters))
+    params.update(project_id=project_id, window=BROWSE_TASKS_WINDOW)
+    n_tasks = 0
+    first_ids = []
+    for row in session.execute(sql, params):
+        n_tasks = row.n_tasks
+        first_ids.append(row.id)
+    return dict(n_tasks=n_tasks, first_ids=first_ids)
+
+
+def browse_tasks(project_id, limit=10, offset=0, last_id=None, state=None,
+                 min_pct=None, max_pct=None):
+    """Return a page of tasks of a project with their completion.
+
+    Tasks are sorted by id. With last_id the page starts after that task,
+    otherwise the offset is resolved from the memoized first id of its
+    window, so the query never skips more than BROWSE_TASKS_WINDOW tasks.
+    Tasks can be filtered by state and by completion, from 0 to 1.
+    """
+    if last_id is not None:
+        return _browse_tasks(project_id, last_id + 1, 0, limit, state,
+                             min_pct, max_pct)
+    first_ids = browse_tasks_windows(project_id, state, min_pct,
+                                     max_pct)['first_ids']
+    window, offset = divmod(offset, BROWSE_TASKS_WINDOW)
+    if window >= len(first_ids):
+        return []
+    return _browse_tasks(project_id, first_ids[window], offset, limit, state,
+                         min_pct, max_pct)
+
+
 def _pct_status(n_task_runs, n_answers):
     """Return percentage status."""
     if n_answers != 0 and n_answers is not None:
@@ -82,7 +142,7 @@ def _pct_status(n_task_runs, n_answers):
     return float(0)
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag_project=True)
 def n_tasks(project_id):
     """Return number of tasks of a project."""
     sql = text('''SELECT COUNT(task.id) AS n_tasks FROM task
@@ -94,7 +154,7 @@ def n_tasks(project_id):
     return n_tasks
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag_project=True)
 def n_completed_tasks(project_id):
     """Return number of completed tasks of a project."""
     sql = text('''SELECT COUNT(task.id) AS n_completed_tasks FROM task
@@ -108,7 +168,7 @@ def n_completed_tasks(project_id):
     return n_completed_tasks
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag_project=True)
 def n_results(project_id):
     """Return number of results of a project."""
     query = text('''
@@ -125,7 +185,7 @@ def n_results(project_id):
     return n_results
 
 
-@memoize(timeout=timeouts.get('REGISTERED_USERS_TIMEOUT'))
+@memoize(timeout=timeouts.get('REGISTERED_USERS_TIMEOUT'), tag_project=True)
 def n_registered_volunteers(project_id):
     """Return number of registered users that have participated in a project."""
     sql = text('''SELECT COUNT(DISTINCT(task_run.user_id))
@@ -141,7 +201,7 @@ def n_registered_volunteers(project_id):
     return n_registered_volunteers
 
 
-@memoize(timeout=timeouts.get('ANON_USERS_TIMEOUT'))
+@memoize(timeout=timeouts.get('ANON_USERS_TIMEOUT'), tag_project=True)
 def n_anonymous_volunteers(project_id):
     """Return number of anonymous users that have participated in a project."""
     sql = text('''SELECT COUNT(DISTINCT(task_run.user_ip))
@@ -164,7 +224,7 @@ def n_volunteers(project_id):
     return total
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag_project=True)
 def n_task_runs(project_id):
     """Return number of task_runs of a project."""
     sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run
@@ -177,7 +237,7 @@ def n_task_runs(project_id):
     return n_task_runs
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag_project=True)
 def overall_progress(project_id):
     """Return the percentage of completed tasks for a project."""
     if n_tasks(project_id) != 0:
@@ -186,7 +246,7 @@ def overall_progress(project_id):
         return 0
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag_project=True)
 def last_activity(project_id):
     """Return last activity, date, from a project."""
     sql = text('''SELECT finish_time FROM task_run WHERE project_id=:project_id
@@ -217,6 +277,79 @@ def average_contribution_time(project_id):
         return 0
 
 
+def _compute_stats(calls):
+    """Compute the missing values of get_stats with grouped queries."""
+    functions = set(function for function, _ in calls)
+    project_ids = list(set(args[0] for _, args in calls))
+    stats = dict((project_id, dict(n_tasks=0, n_completed_tasks=0,
+                                   n_registered_volunteers=0,
+                                   n_anonymous_volunteers=0,
+                                   last_activity=None))
+                 for project_id in project_ids)
+    if functions & set([n_tasks, overall_progress]):
+        sql = text('''SELECT project_id, COUNT(id) AS n_tasks,
+                   COUNT(CASE WHEN state='completed' THEN 1 END)
+                   AS n_completed_tasks
+                   FROM task WHERE project_id=ANY(:project_ids)
+                   GROUP BY project_id;''')
+        for row in session.execute(sql, dict(project_ids=project_ids)):
+            stats[row.project_id].update(
+                n_tasks=row.n_tasks, n_completed_tasks=row.n_completed_tasks)
+    if functions & set([n_registered_volunteers, n_anonymous_volunteers]):
+        sql = text('''SELECT project_id,
+                   COUNT(DISTINCT(CASE WHEN user_ip IS NULL THEN user_id END))
+                   AS n_registered_volunteers,
+                   COUNT(DISTINCT(CASE WHEN user_id IS NULL THEN user_ip END))
+                   AS n_anonymous_volunteers
+                   FROM task_run WHERE project_id=ANY(:project_ids)
+                   GROUP BY project_id;''')
+        for row in session.execute(sql, dict(project_ids=project_ids)):
+            stats[row.project_id].update(
+                n_registered_volunteers=row.n_registered_volunteers,
+                n_anonymous_volunteers=row.n_anonymous_volunteers)
+    if last_activity in functions:
+        sql = text('''SELECT project_id, MAX(finish_time) AS last_activity
+                   FROM task_run WHERE project_id=ANY(:project_ids)
+                   GROUP BY project_id;''')
+        for row in session.execute(sql, dict(project_ids=project_ids)):
+            stats[row.project_id]['last_activity'] = row.last_activity
+    values = dict()
+    for function, args in calls:
+        project_stats = stats[args[0]]
+        if function is overall_progress:
+            value = 0
+            if project_stats['n_tasks'] != 0:
+                value = ((project_stats['n_completed_tasks'] * 100) /
+                         project_stats['n_tasks'])
+        else:
+            value = project_stats[function.__name__]
+        values[(function, args)] = value
+    return values
+
+
+def get_stats(project_ids):
+    """Return the stats of the listings for many projects at once.
+
+    It returns the same values as calling last_activity, overall_progress,
+    n_tasks and n_volunteers for every project, sharing their cache.
+    """
+    functions = (last_activity, overall_progress, n_tasks,
+                 n_registered_volunteers, n_anonymous_volunteers)
+    calls = [(function, (project_id,)) for project_id in project_ids
+             for function in functions]
+    values = iter(get_memoized_many(calls, _compute_stats))
+    stats = dict()
+    for project_id in project_ids:
+        activity, progress, tasks, registered, anonymous = [
+            next(values) for _ in functions]
+        stats[project_id] = dict(last_activity=pretty_date(activity),
+                                 last_activity_raw=activity,
+                                 overall_progress=progress,
+                                 n_tasks=tasks,
+                                 n_volunteers=registered + anonymous)
+    return stats
+
+
 def n_blogposts(project_id):
     """Return number of blogposts of a project."""
     sql = text('''
@@ -232,7 +365,8 @@ def n_blogposts(project_id):
 
 # This function does not change too much, so cache it for a longer time
 @cache(timeout=timeouts.get('STATS_FRONTPAGE_TIMEOUT'),
-       key_prefix="number_featured_projects")
+       key_prefix="number_featured_projects",
+       local_timeout=FIVE_MINUTES)
 def _n_featured():
     """Return number of featured projects."""
     sql = text('''SELECT COUNT(*) FROM project WHERE featured=true;''')
@@ -257,19 +391,16 @@ def get_all_featured(category=None):
            AND "user".restrict=false
            GROUP BY project.id, "user".id;''')
 
-    results = session.execute(sql)
+    results = session.execute(sql).fetchall()
+    stats = get_stats([row.id for row in results])
     projects = []
     for row in results:
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
                        created=row.created, description=row.description,
                        updated=row.updated,
-                       last_activity=pretty_date(last_activity(row.id)),
-                       last_activity_raw=last_activity(row.id),
                        owner=row.owner,
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
                        info=row.info)
+        project.update(stats[row.id])
         projects.append(Project().to_public_json(project))
     return projects
 
@@ -281,7 +412,8 @@ def get_featured(category=None, page=1, per_page=5):
 
 
 @cache(key_prefix="number_published_projects",
-       timeout=timeouts.get('STATS_APP_TIMEOUT'))
+       timeout=timeouts.get('STATS_APP_TIMEOUT'),
+       local_timeout=FIVE_MINUTES)
 def n_published():
     """Return number of published projects."""
     sql = text('''SELECT COUNT(id) FROM project WHERE published=true;''')
@@ -294,7 +426,8 @@ def n_published():
 
 # Cache it for longer times, as this is only shown to admin users
 @cache(timeout=timeouts.get('STATS_DRAFT_TIMEOUT'),
-       key_prefix="number_draft_projects")
+       key_prefix="number_draft_projects",
+       local_timeout=FIVE_MINUTES)
 def _n_draft():
     """Return number of draft projects."""
     sql = text('''SELECT COUNT(id) FROM project WHERE published=false;''')
@@ -317,7 +450,8 @@ def get_all_draft(category=None):
            AND "user".restrict=false
            AND project.published=false;''')
 
-    results = session.execute(sql)
+    results = session.execute(sql).fetchall()
+    stats = get_stats([row.id for row in results])
     projects = []
     for row in results:
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
@@ -325,12 +459,8 @@ def get_all_draft(category=None):
                        updated=row.updated,
                        description=row.description,
                        owner=row.owner,
-                       last_activity=pretty_date(last_activity(row.id)),
-                       last_activity_raw=last_activity(row.id),
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
                        info=row.info)
+        project.update(stats[row.id])
         projects.append(Project().to_public_json(project))
     return projects
 
@@ -385,7 +515,8 @@ def get_all(category):
            AND (project.info->>'passwd_hash') IS NULL
            GROUP BY project.id, "user".id ORDER BY project.name;''')
 
-    results = session.execute(sql, dict(category=category))
+    results = session.execute(sql, dict(category=category)).fetchall()
+    stats = get_stats([row.id for row in results])
     projects = []
     for row in results:
         project = dict(id=row.id,
@@ -395,12 +526,8 @@ def get_all(category):
                        description=row.description,
                        owner=row.owner,
                        featured=row.featured,
-                       last_activity=pretty_date(last_activity(row.id)),
-                       last_activity_raw=last_activity(row.id),
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
                        info=row.info)
+        project.update(stats[row.id])
         projects.append(Project().to_public_json(project))
     return projects
 
@@ -441,7 +568,7 @@ def reset():
 
 def delete_browse_tasks(project_id):
     """Reset browse_tasks value in cache"""
-    delete_memoized(browse_tasks, project_id)
+    delete_memoized_project(project_id)
 
 
 def delete_n_tasks(project_id):
@@ -498,16 +625,9 @@ def clean(project_id):
 def clean_project(project_id, category=None):
     """Clean cache for a specific project"""
     project = db.session.query(Project).get(project_id)
-    delete_browse_tasks(project_id)
-    delete_n_tasks(project_id)
-    delete_n_completed_tasks(project_id)
-    delete_n_results(project_id)
-    delete_n_registered_volunteers(project_id)
-    delete_n_anonymous_volunteers(project_id)
-    delete_n_volunteers(project_id)
-    delete_last_activity(project_id)
-    delete_n_task_runs(project_id)
-    delete_overall_progress(project_id)
+    # n_tasks, n_completed_tasks, n_results, n_registered_volunteers,
+    # n_anonymous_volunteers, last_activity, n_task_runs, overall_progress
+    delete_memoized_project(project_id)
     if project:
         delete_memoized(get_all, project.category.short_name)
         delete_memoized(n_count, project.category.short_name)
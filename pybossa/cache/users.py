@@ -18,6 +18,7 @@
 """Cache module for users."""
 from sqlalchemy.sql import text
 from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.orm import make_transient_to_detached
 from pybossa.core import db, timeouts
 from pybossa.cache import cache, memoize, delete_memoized
 from pybossa.util import pretty_date, exists_materialized_view
@@ -316,3 +317,40 @@ def get_user_pref_metadata(name):
 
 def delete_user_pref_metadata(name):
     delete_memoized(get_user_pref_metadata, name)
+
+
+#: Columns of the users cached by their API key. Secrets like the password
+#: hash are left out, the rest are loaded from the DB if they are accessed.
+API_KEY_USER_COLUMNS = ('id', 'name', 'fullname', 'locale', 'admin', 'pro',
+                        'privacy_mode', 'restrict', 'valid_email',
+                        'confirmation_email_sent', 'subscribed', 'consent')
+
+
+@memoize(timeout=timeouts.get('API_KEY_TIMEOUT'),
+         local_timeout=timeouts.get('API_KEY_LOCAL_TIMEOUT'))
+def user_by_api_key_cached(api_key):
+    """Return the columns of the user owning the API key."""
+    columns = [getattr(User, column) for column in API_KEY_USER_COLUMNS]
+    row = db.session.query(*columns).filter_by(api_key=api_key).first()
+    if row is None:
+        return None
+    return dict(zip(API_KEY_USER_COLUMNS, row))
+
+
+def get_user_by_api_key(api_key):
+    """Return the user owning the API key without querying the DB.
+
+    The user is rebuilt from the cached columns and attached to the session
+    as it is, so lazy relationships and the columns not cached still work.
+    """
+    data = user_by_api_key_cached(api_key)
+    if data is None:
+        return None
+    user = User(api_key=api_key, **data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def delete_user_by_api_key(api_key):
+    """Delete from cache the user owning the API key."""
+    delete_memoized(user_by_api_key_cached, api_key)
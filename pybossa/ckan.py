@@ -18,18 +18,58 @@
 """CKAN module for PYBOSSA."""
 import requests
 import json
+import threading
+import time
+import Queue
+from requests.adapters import HTTPAdapter
 from pybossa.model.task import Task
 from pybossa.model.task_run import TaskRun
 
 
+SYNC_KEY = 'pybossa:ckan:sync:{0}:{1}'
+
+
+def get_last_synced_id(conn, project_id, table, resource_id):
+    """Return the id of the last row upserted to a resource, if known."""
+    sync = conn.hgetall(SYNC_KEY.format(project_id, table))
+    if sync.get('resource_id') != str(resource_id):
+        return None
+    return int(sync['last_id'])
+
+
+def set_last_synced_id(conn, project_id, table, resource_id, last_id):
+    """Store the id of the last row upserted to a resource."""
+    conn.hmset(SYNC_KEY.format(project_id, table),
+               dict(resource_id=resource_id, last_id=last_id))
+
+
 class Ckan(object):
 
-    """Class for CKAN service."""
+    """Class for CKAN service.
+
+    Requests share a pool of connections. Records are upserted in chunks by
+    several threads, the size of the chunks adapting to the time CKAN takes
+    to store them.
+    """
+
+    #: Number of concurrent datastore_upsert requests
+    workers = 4
+    chunk_size = 100
+    min_chunk_size = 20
+    max_chunk_size = 5000
+    #: Seconds an upsert should take, chunks grow or shrink to match it
+    target_time = 2
+    retries = 3
+    backoff = 1
+    #: Seconds to wait to connect to CKAN and for each of its responses
+    timeout = (5, 60)
+    retry_status_codes = (429, 502, 503, 504)
 
     def _field_setup(self, obj):
         int_fields = ['id', 'project_id', 'task_id', 'user_id',
-                      'n_answers', 'timeout', 'calibration', 'quorum']
-        text_fields = ['state', 'user_ip']
+                      'n_answers', 'timeout', 'calibration', 'quorum',
+                      'n_task_runs']
+        text_fields = ['state', 'user_ip', 'info_hash']
         float_fields = ['priority_0']
         timestamp_fields = ['created', 'finish_time']
         json_fields = ['info']
@@ -65,6 +105,10 @@ class Ckan(object):
                            task_run=self._field_setup(TaskRun))
         self.primary_key = dict(task='id', task_run='id')
         self.indexes = dict(task='id', task_run='id')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def get_resource_id(self, name):
         """Get resource ID from name."""
@@ -76,9 +120,10 @@ class Ckan(object):
     def package_exists(self, name):
         """Check if package exists."""
         pkg = {'id': name}
-        r = requests.get(self.url + "/action/package_show",
-                         headers=self.headers,
-                         params=pkg)
+        r = self.session.get(self.url + "/action/package_show",
+                             headers=self.headers,
+                             params=pkg,
+                             timeout=self.timeout)
         if r.status_code == 200 or r.status_code == 404 or r.status_code == 403:
             try:
                 output = json.loads(r.text)
@@ -104,9 +149,10 @@ class Ckan(object):
                'notes': project.description,
                'type': 'pybossa',
                'url': url}
-        r = requests.post(self.url + "/action/package_create",
-                          headers=self.headers,
-                          data=json.dumps(pkg))
+        r = self.session.post(self.url + "/action/package_create",
+                              headers=self.headers,
+                              data=json.dumps(pkg),
+                              timeout=self.timeout)
         if r.status_code == 200:
             output = json.loads(r.text)
             self.package = output['result']
@@ -128,9 +174,10 @@ class Ckan(object):
                'type': 'pybossa',
                'resources': resources,
                'url': url}
-        r = requests.post(self.url + "/action/package_update",
-                          headers=self.headers,
-                          data=json.dumps(pkg))
+        r = self.session.post(self.url + "/action/package_update",
+                              headers=self.headers,
+                              data=json.dumps(pkg),
+                              timeout=self.timeout)
         if r.status_code == 200:
             output = json.loads(r.text)
             self.package = output['result']
@@ -149,9 +196,10 @@ class Ckan(object):
                 'name': name,
                 'url': self.package['url'],
                 'description': "%ss" % name}
-        r = requests.post(self.url + "/action/resource_create",
-                          headers=self.headers,
-                          data=json.dumps(rsrc))
+        r = self.session.post(self.url + "/action/resource_create",
+                              headers=self.headers,
+                              data=json.dumps(rsrc),
+                              timeout=self.timeout)
         if r.status_code == 200:
             return json.loads(r.text)
         else:
@@ -169,9 +217,10 @@ class Ckan(object):
                      'indexes': self.indexes[name],
                      'primary_key': self.primary_key[name],
                      'force': True}
-        r = requests.post(self.url + "/action/datastore_create",
-                          headers=self.headers,
-                          data=json.dumps(datastore))
+        r = self.session.post(self.url + "/action/datastore_create",
+                              headers=self.headers,
+                              data=json.dumps(datastore),
+                              timeout=self.timeout)
 
         if r.status_code == 200:
             output = json.loads(r.text)
@@ -185,36 +234,110 @@ class Ckan(object):
                             r.text,
                             r.status_code)
 
-    def datastore_upsert(self, name, records, resource_id=None):
-        """Upsert datastore."""
+    def datastore_upsert(self, name, records, resource_id=None,
+                         method='insert'):
+        """Upsert datastore.
+
+        records is an iterable of dicts, or a JSON string with a list of
+        them. It is consumed chunk by chunk while the chunks are upserted.
+        """
         if resource_id is None:
             resource_id = self.get_resource_id(name)
-        _records = ''
-        for text in records:
-            _records += text
-        _records = json.loads(_records)
-        for i in range(0, len(_records), 20):
-            chunk = _records[i:i + 20]
-            payload = {'resource_id': resource_id,
-                       'records': chunk,
-                       'method': 'insert',
-                       'force': True}
-            r = requests.post(self.url + "/action/datastore_upsert",
-                              headers=self.headers,
-                              data=json.dumps(payload))
-            if r.status_code != 200:
-                msg = "CKAN: the remote site failed! datastore_upsert failed"
-                raise Exception(msg,
-                                r.text,
-                                r.status_code)
+        if isinstance(records, basestring):
+            records = json.loads(records)
+        chunks = Queue.Queue(maxsize=self.workers * 2)
+        errors = []
+
+        def upsert():
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                if not errors:
+                    try:
+                        self._upsert_chunk(resource_id, chunk, method)
+                    except Exception as e:
+                        errors.append(e)
+
+        threads = [threading.Thread(target=upsert)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) >= self.chunk_size:
+                    chunks.put(chunk)
+                    chunk = []
+                    if errors:
+                        break
+            if chunk and not errors:
+                chunks.put(chunk)
+        finally:
+            for thread in threads:
+                chunks.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
         return True
 
+    def _upsert_chunk(self, resource_id, chunk, method):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            if attempt > 0:
+                # The failed request may have stored the records already, so
+                # an insert would fail with duplicated primary keys
+                method = 'upsert'
+            payload = json.dumps({'resource_id': resource_id,
+                                  'records': chunk,
+                                  'method': method,
+                                  'force': True})
+            start = time.time()
+            try:
+                r = self.session.post(self.url + "/action/datastore_upsert",
+                                      headers=self.headers,
+                                      data=payload,
+                                      timeout=self.timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                if last:
+                    raise
+            else:
+                if r.status_code == 200:
+                    self._adapt_chunk_size(len(chunk), time.time() - start)
+                    return
+                if r.status_code == 413 and len(chunk) > 1:
+                    # Too large for CKAN, upsert it in halves
+                    self.chunk_size = max(self.min_chunk_size, len(chunk) / 2)
+                    half = len(chunk) / 2
+                    self._upsert_chunk(resource_id, chunk[:half], method)
+                    self._upsert_chunk(resource_id, chunk[half:], method)
+                    return
+                if last or r.status_code not in self.retry_status_codes:
+                    msg = "CKAN: the remote site failed! datastore_upsert failed"
+                    raise Exception(msg,
+                                    r.text,
+                                    r.status_code)
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def _adapt_chunk_size(self, size, elapsed):
+        if size < self.chunk_size:
+            return
+        if elapsed < self.target_time / 2.0:
+            self.chunk_size = min(self.max_chunk_size, size * 2)
+        elif elapsed > self.target_time * 2:
+            self.chunk_size = max(self.min_chunk_size, size / 2)
+
     def datastore_delete(self, name, resource_id=None):
         """Delete datastore."""
         payload = {'resource_id': resource_id, 'force': True}
-        r = requests.post(self.url + "/action/datastore_delete",
-                          headers=self.headers,
-                          data=json.dumps(payload))
+        r = self.session.post(self.url + "/action/datastore_delete",
+                              headers=self.headers,
+                              data=json.dumps(payload),
+                              timeout=self.timeout)
         if r.status_code == 404 or r.status_code == 200:
             return True
         else:
@@ -40,6 +40,12 @@ class ContributionsGuard(object):
         key = self._create_key(task, user)
         return self.conn.get(key)
 
+    def retrieve_timestamps(self, tasks, user):
+        if not tasks:
+            return []
+        keys = [self._create_key(task, user) for task in tasks]
+        return self.conn.mget(keys)
+
     def _create_key(self, task, user):
         user_id = user['user_id'] or user['user_ip']
         if user.get('external_uid'):
@@ -49,3 +55,9 @@ class ContributionsGuard(object):
     def _remove_task_stamped(self, task, user):
         key = self._create_key(task, user)
         return self.conn.delete(key)
+
+    def _remove_tasks_stamped(self, tasks, user):
+        if not tasks:
+            return 0
+        keys = [self._create_key(task, user) for task in tasks]
+        return self.conn.delete(*keys)
@@ -514,7 +514,8 @@ def setup_hooks(app):
         if 'Authorization' in request.headers:
             apikey = request.headers.get('Authorization')
         if apikey:
-            user = user_repo.get_by(api_key=apikey)
+            from pybossa.cache.users import get_user_by_api_key
+            user = get_user_by_api_key(apikey)
             if user:
                 _request_ctx_stack.top.user = user
         # Handle forms
@@ -632,6 +633,8 @@ def setup_ratelimits(app):
     global ratelimits
     ratelimits['LIMIT'] = app.config['LIMIT']
     ratelimits['PER'] = app.config['PER']
+    ratelimits['BACKEND'] = app.config['RATELIMIT_BACKEND']
+    ratelimits['LEASE'] = app.config['RATELIMIT_LEASE']
 
 
 def setup_cache_timeouts(app):
@@ -648,12 +651,15 @@ def setup_cache_timeouts(app):
     timeouts['STATS_DRAFT_TIMEOUT'] = app.config['STATS_DRAFT_TIMEOUT']
     timeouts['N_APPS_PER_CATEGORY_TIMEOUT'] = \
         app.config['N_APPS_PER_CATEGORY_TIMEOUT']
+    timeouts['BROWSE_TASKS_TIMEOUT'] = app.config['BROWSE_TASKS_TIMEOUT']
     # Categories
     timeouts['CATEGORY_TIMEOUT'] = app.config['CATEGORY_TIMEOUT']
     # Users
     timeouts['USER_TIMEOUT'] = app.config['USER_TIMEOUT']
     timeouts['USER_TOP_TIMEOUT'] = app.config['USER_TOP_TIMEOUT']
     timeouts['USER_TOTAL_TIMEOUT'] = app.config['USER_TOTAL_TIMEOUT']
+    timeouts['API_KEY_TIMEOUT'] = app.config['API_KEY_TIMEOUT']
+    timeouts['API_KEY_LOCAL_TIMEOUT'] = app.config['API_KEY_LOCAL_TIMEOUT']
 
 
 def setup_scheduled_jobs(app):  # pragma: no cover
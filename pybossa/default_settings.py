@@ -63,6 +63,13 @@ REDIS_DB = 0
 
 REDIS_KEYPREFIX = 'pybossa_cache'
 
+# In process cache in front of Redis for the hottest cached functions
+CACHE_L1_ENABLED = False
+CACHE_L1_MAX_ITEMS = 1000
+CACHE_L1_MAX_BYTES = 32 * 1024 * 1024
+# Refresh stale cached values in an RQ worker instead of inline
+CACHE_REFRESH_IN_BACKGROUND = False
+
 ## Default cache timeouts
 # Project cache
 AVATAR_TIMEOUT = 30 * 24 * 60 * 60
@@ -80,6 +87,9 @@ CATEGORY_TIMEOUT = 24 * 60 * 60
 USER_TIMEOUT = 15 * 60
 USER_TOP_TIMEOUT = 24 * 60 * 60
 USER_TOTAL_TIMEOUT = 24 * 60 * 60
+# Users authenticated by their API key, in Redis and in process
+API_KEY_TIMEOUT = 5 * 60
+API_KEY_LOCAL_TIMEOUT = 60
 
 # Project Presenters
 PRESENTERS = ["basic", "image", "sound", "video", "map", "pdf"]
@@ -94,6 +104,12 @@ TEMPLATE_TASKS = {
 # Rate limits default values
 LIMIT = 300
 PER = 15 * 60
+# 'fixed' windows or 'gcra', which can lease RATELIMIT_LEASE requests at once
+RATELIMIT_BACKEND = 'fixed'
+RATELIMIT_LEASE = 0
+
+# Maximum number of task runs posted at once to the bulk endpoint
+TASK_RUN_BULK_MAX_SIZE = 100
 
 # Expiration time for password protected project cookies
 PASSWD_COOKIE_TIMEOUT = 60 * 30
@@ -153,8 +169,33 @@ UNPUBLISH_PROJECTS = True
 # TTL for ZIP files of personal data
 TTL_ZIP_SEC_FILES = 3
 
+# Export the new rows of a project as segments of an incremental ZIP. Rows
+# younger than EXPORT_INCREMENTAL_LAG seconds wait for the next export, as
+# rows with lower ids may still be committed meanwhile
+EXPORT_INCREMENTAL = False
+EXPORT_INCREMENTAL_LAG = 5 * 60
+
+# Split exports in one job per project, table and format, and export the
+# tables in shards of EXPORT_SHARD_SIZE rows using EXPORT_SHARD_WORKERS
+# processes
+EXPORT_JOBS_PER_TABLE = False
+EXPORT_SHARD_SIZE = 100000
+EXPORT_SHARD_WORKERS = 1
+
+# Webhooks are posted by a pool of WEBHOOK_WORKERS threads, with a timeout of
+# WEBHOOK_TIMEOUT seconds and WEBHOOK_RETRIES retries. With a
+# WEBHOOK_BATCH_SIZE > 1 several payloads are posted as a JSON list
+WEBHOOK_TIMEOUT = 10
+WEBHOOK_RETRIES = 2
+WEBHOOK_BACKOFF = 1
+WEBHOOK_WORKERS = 4
+WEBHOOK_BATCH_SIZE = 1
+WEBHOOK_RESPONSE_MAX_LENGTH = 4096
+
 # Default cryptopan key
 CRYPTOPAN_KEY = '32-char-str-for-AES-key-and-pad.'
+# Anonymized IPs kept in memory by every worker
+ANONYMIZER_CACHE_SIZE = 10000
 
 # Instruct PYBOSSA to generate absolute paths or not for avatars
 AVATAR_ABSOLUTE = True
@@ -25,7 +25,10 @@ import os
 import zipfile
 import tempfile
 import json
-from pybossa.core import uploader, task_repo, result_repo
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from sqlalchemy import text
+from pybossa.core import uploader, task_repo, result_repo, db, sentinel
 from pybossa.uploader import local
 from unidecode import unidecode
 from flask import url_for, safe_join, send_file, redirect, current_app
@@ -33,18 +36,62 @@ from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
 from flatten_json import flatten
 
+
+PROGRESS_KEY = 'pybossa:export:progress:{0}'
+PROGRESS_TTL = 24 * 60 * 60
+PROGRESS_EVERY = 1000
+
+_shard_app = None
+
+
+def get_export_progress(project_id):
+    """Return the progress of the export shards of a project by shard."""
+    progress = sentinel.master.hgetall(PROGRESS_KEY.format(project_id))
+    return dict((shard, json.loads(value))
+                for shard, value in progress.iteritems())
+
+
+def _init_shard_worker():
+    """Create the app used by the shards run in a pool of processes."""
+    global _shard_app
+    from pybossa.core import create_app
+    _shard_app = create_app(run_as_server=False)
+
+
+def _export_shard(args):
+    from pybossa.core import json_exporter, csv_exporter
+    export_format, ty, project_id, shard, last_id, max_id, total = args
+    exporter = dict(json=json_exporter, csv=csv_exporter)[export_format]
+    with _shard_app.app_context():
+        return exporter._export_shard(ty, project_id, shard, last_id, max_id,
+                                      total)
+
+
 class Exporter(object):
 
     """Abstract generic exporter class."""
 
+    export_format = None
+
     repositories = dict(task=[task_repo, 'filter_tasks_by'],
                         task_run=[task_repo, 'filter_task_runs_by'],
                         result=[result_repo, 'filter_by'])
 
     def _get_data(self, table, project_id, flat=False, info_only=False):
         """Get the data for a given table."""
+        return list(self._get_rows(table, project_id, flat, info_only))
+
+    def _get_rows(self, table, project_id, flat=False, info_only=False,
+                  last_id=None, max_id=None):
+        """Yield the rows of a given table one by one.
+
+        The rows are read from the DB in batches, so memory usage does not
+        depend on the size of the project. last_id and max_id restrict the
+        rows to an id range.
+        """
         repo, query = self.repositories[table]
-        data = getattr(repo, query)(project_id=project_id)
+        data = getattr(repo, query)(project_id=project_id, yielded=True,
+                                    last_id=last_id, max_id=max_id)
         ignore_keys = current_app.config.get('IGNORE_FLAT_KEYS') or []
         if table == 'task':
             csv_export_key = current_app.config.get('TASK_CSV_EXPORT_INFO_KEY')
@@ -54,7 +101,6 @@ class Exporter(object):
             csv_export_key = current_app.config.get('RESULT_CSV_EXPORT_INFO_KEY')
         if info_only:
             if flat:
-                tmp = []
                 for row in data:
                     inf = copy.deepcopy(row.dictize()['info'])
                     if inf and type(inf) == dict and csv_export_key and inf.get(csv_export_key):
@@ -62,24 +108,18 @@ class Exporter(object):
                     new_key = '%s_id' % table
                     if inf and type(inf) == dict:
                         inf[new_key] = row.id
-                        tmp.append(flatten(inf,
-                                           root_keys_to_ignore=ignore_keys))
+                        yield flatten(inf, root_keys_to_ignore=ignore_keys)
                     elif inf and type(inf) == list:
                         for datum in inf:
                             if type(datum) == dict:
                                 datum[new_key] = row.id
-                                tmp.append(flatten(datum,
-                                                   root_keys_to_ignore=ignore_keys))
+                                yield flatten(datum,
+                                              root_keys_to_ignore=ignore_keys)
             else:
-                tmp = []
                 for row in data:
-                    if row.dictize()['info']:
-                        tmp.append(row.dictize()['info'])
-                    else:
-                        tmp.append({})
+                    yield row.dictize()['info'] or {}
         else:
             if flat:
-                tmp = []
                 for row in data:
                     cleaned = row.dictize()
                     fav_user_ids = None
@@ -99,17 +139,102 @@ class Exporter(object):
                     if task_run_ids:
                         cleaned['task_run_ids'] = task_run_ids
 
-                    tmp.append(cleaned)
+                    yield cleaned
             else:
-                tmp = [row.dictize() for row in data]
-        return tmp
+                for row in data:
+                    yield row.dictize()
 
     def _project_name_latin_encoded(self, project):
         """project short name for later HTML header usage"""
         name = unidecode(project.short_name)
         return name
 
-    def _zip_factory(self, filename):
+    def _get_max_id(self, table, project_id):
+        """Return the id of the last row of a given table."""
+        repo, query = self.repositories[table]
+        rows = getattr(repo, query)(project_id=project_id, limit=1,
+                                    desc=True)
+        return rows[0].id if rows else 0
+
+    def _get_shards(self, table, project_id):
+        """Split the rows of a table in id ranges of EXPORT_SHARD_SIZE rows.
+
+        Returns a list of (last_id, max_id, total) tuples.
+        """
+        max_id = self._get_max_id(table, project_id)
+        size = current_app.config.get('EXPORT_SHARD_SIZE', 100000)
+        sql = text('''SELECT id, n FROM
+                   (SELECT id, row_number() OVER (ORDER BY id) AS n
+                    FROM {0} WHERE project_id=:project_id AND id<=:max_id)
+                   AS numbered WHERE mod(n, :size)=0 ORDER BY id;'''
+                   .format(table))
+        params = dict(project_id=project_id, max_id=max_id, size=size)
+        boundaries = [(row.id, size) for row in db.session.execute(sql, params)]
+        sql = text('''SELECT COUNT(id) FROM {0}
+                   WHERE project_id=:project_id AND id<=:max_id;'''
+                   .format(table))
+        rest = db.session.execute(sql, params).scalar() - size * len(boundaries)
+        shards = []
+        last_id = 0
+        for boundary, total in boundaries + [(max_id, rest)]:
+            if boundary > last_id:
+                shards.append((last_id, boundary, total))
+            last_id = boundary
+        return shards or [(0, 0, 0)]
+
+    def _run_shards(self, ty, project_id):
+        """Export the shards of a table and return their parts in order.
+
+        With EXPORT_SHARD_WORKERS > 1 the shards are run in a pool of
+        processes.
+        """
+        progress_key = PROGRESS_KEY.format(project_id)
+        prefix = '%s:%s:' % (ty, self.export_format)
+        stale = [field for field in sentinel.master.hkeys(progress_key)
+                 if field.startswith(prefix)]
+        if stale:
+            sentinel.master.hdel(progress_key, *stale)
+        shards = self._get_shards(ty, project_id)
+        workers = current_app.config.get('EXPORT_SHARD_WORKERS', 1)
+        if workers > 1 and len(shards) > 1:
+            pool = Pool(min(workers, len(shards)), _init_shard_worker)
+            try:
+                return pool.map(_export_shard,
+                                [(self.export_format, ty, project_id, i) +
+                                 shard for i, shard in enumerate(shards)])
+            finally:
+                pool.close()
+                pool.join()
+        return [self._export_shard(ty, project_id, i, *shard)
+                for i, shard in enumerate(shards)]
+
+    def _export_shard(self, ty, project_id, shard, last_id, max_id, total):
+        """Write the rows of a shard to a temporary file and return it"""
+        pass
+
+    def _track_progress(self, rows, project_id, ty, shard, total):
+        """Yield the rows reporting the progress of the shard every
+        PROGRESS_EVERY rows."""
+        key = PROGRESS_KEY.format(project_id)
+        field = '%s:%s:%d' % (ty, self.export_format, shard)
+
+        def report(n, done=False):
+            pipeline = sentinel.master.pipeline(transaction=False)
+            pipeline.hset(key, field, json.dumps(dict(rows=n, total=total,
+                                                      done=done)))
+            pipeline.expire(key, PROGRESS_TTL)
+            pipeline.execute()
+
+        n = 0
+        report(n)
+        for row in rows:
+            yield row
+            n += 1
+            if n % PROGRESS_EVERY == 0:
+                report(n)
+        report(n, done=True)
+
+    def _zip_factory(self, filename, mode='w'):
         """create a ZipFile Object with compression and allow big ZIP files (allowZip64)"""
         try:
             import zlib
@@ -117,13 +242,89 @@ class Exporter(object):
             zip_compression= zipfile.ZIP_DEFLATED
         except Exception as ex:
             zip_compression= zipfile.ZIP_STORED
-        _zip = zipfile.ZipFile(file=filename, mode='w', compression=zip_compression, allowZip64=True)
+        _zip = zipfile.ZipFile(file=filename, mode=mode, compression=zip_compression, allowZip64=True)
         return _zip
 
     def _make_zip(self, project, ty):
         """Generate a ZIP of a certain type and upload it"""
         pass
 
+    def _write_segment(self, _zip, project, ty, segment, last_id, max_id):
+        """Add the rows with last_id < id <= max_id to an incremental ZIP"""
+        pass
+
+    def _read_manifest(self, filename):
+        """Return the manifest stored in the comment of an incremental ZIP"""
+        try:
+            manifest = json.loads(zipfile.ZipFile(filename).comment)
+            return dict(last_id=int(manifest['last_id']),
+                        segments=int(manifest['segments']))
+        except Exception:
+            return None
+
+    def _get_settled_max_id(self, table, project_id):
+        """Return the id of the last row of a given table created at least
+        EXPORT_INCREMENTAL_LAG seconds ago.
+
+        Ids are taken when rows are inserted, not when they are committed, so
+        the rows of the last seconds can still be followed by lower ids.
+        """
+        lag = current_app.config.get('EXPORT_INCREMENTAL_LAG', 0)
+        until = (datetime.utcnow() - timedelta(seconds=lag)).isoformat()
+        sql = text('''SELECT COALESCE(MAX(id), 0) FROM {0}
+                   WHERE project_id=:project_id AND created<=:until;'''
+                   .format(table))
+        return db.session.execute(sql, dict(project_id=project_id,
+                                            until=until)).scalar()
+
+    def _add_segment(self, filename, mode, manifest, project, ty, max_id):
+        """Write the rows after the last exported one to a ZIP and update
+        its manifest"""
+        _zip = self._zip_factory(filename, mode)
+        try:
+            if max_id > manifest['last_id']:
+                segment = manifest['segments'] + 1
+                self._write_segment(_zip, project, ty, segment,
+                                    manifest['last_id'], max_id)
+                manifest = dict(last_id=max_id, segments=segment)
+            _zip.comment = json.dumps(manifest)
+        finally:
+            _zip.close()
+
+    def _make_incremental_zip(self, project, ty):
+        """Append the rows added since the last export to an incremental ZIP.
+
+        Every run adds a new segment with the new rows to the ZIP, and the
+        last exported id is kept as a JSON manifest in the ZIP comment. ZIPs
+        of the local uploader are appended in place; other uploaders get a
+        full one every time.
+        """
+        filename = self.incremental_download_name(project, ty)
+        manifest = None
+        if isinstance(uploader, local.LocalUploader):
+            path = safe_join(self._download_path(project), filename)
+            if os.path.isfile(path):
+                manifest = self._read_manifest(path)
+        max_id = self._get_settled_max_id(ty, project.id)
+        if manifest is not None:
+            if max_id > manifest['last_id']:
+                self._add_segment(path, 'a', manifest, project, ty, max_id)
+            return filename
+        zipped_datafile = tempfile.NamedTemporaryFile()
+        try:
+            self._add_segment(zipped_datafile.name, 'w',
+                              dict(last_id=0, segments=0), project, ty,
+                              max_id)
+            zipped_datafile.seek(0)
+            _file = FileStorage(filename=filename, stream=zipped_datafile)
+            uploader.upload_file(_file, container=self._container(project))
+            return filename
+        finally:
+            zipped_datafile.close()
+
+    def incremental_enabled(self):
+        return current_app.config.get('EXPORT_INCREMENTAL', False)
+
     def _container(self, project):
         return "user_%d" % project.owner_id
 
@@ -145,6 +346,11 @@ class Exporter(object):
         filename = secure_filename(filename)
         return filename
 
+    def incremental_download_name(self, project, ty):
+        """Get the filename of the incremental ZIP of a project."""
+        filename = self.download_name(project, ty)
+        return '%s_incremental.zip' % filename[:-len('.zip')]
+
     def zip_existing(self, project, ty):
         """Check if exported ZIP is existing"""
         # TODO: Check ty
@@ -154,10 +360,16 @@ class Exporter(object):
     def get_zip(self, project, ty):
         """Get a ZIP file directly from uploaded directory
         or generate one on the fly and upload it if not existing."""
-        filename = self.download_name(project, ty)
-        if not self.zip_existing(project, ty):
-            print "Warning: Generating %s on the fly now!" % filename
-            self._make_zip(project, ty)
+        if self.incremental_enabled():
+            filename = self.incremental_download_name(project, ty)
+            if not uploader.file_exists(filename, self._container(project)):
+                print "Warning: Generating %s on the fly now!" % filename
+                self._make_incremental_zip(project, ty)
+        else:
+            filename = self.download_name(project, ty)
+            if not self.zip_existing(project, ty):
+                print "Warning: Generating %s on the fly now!" % filename
+                self._make_zip(project, ty)
         if isinstance(uploader, local.LocalUploader):
             filepath = self._download_path(project)
             res = send_file(filename_or_fp=safe_join(filepath, filename),
@@ -179,3 +391,8 @@ class Exporter(object):
     def pregenerate_zip_files(self, project):
         """Cache and generate all types (tasks and task_run) of ZIP files"""
         pass
+
+    def pregenerate_incremental_zip_files(self, project):
+        """Add the new rows of all types to the incremental ZIP files"""
+        for ty in ('task', 'task_run', 'result'):
+            self._make_incremental_zip(project, ty)
@@ -20,6 +20,8 @@
 CSV Exporter module for exporting tasks and tasks results out of PYBOSSA
 """
 
+import os
+import json
 import tempfile
 from pybossa.exporter import Exporter
 from pybossa.core import uploader, task_repo
@@ -28,47 +30,135 @@ from pybossa.model.task_run import TaskRun
 from pybossa.util import UnicodeWriter
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
-import pandas as pd
 
 
 class CsvExporter(Exporter):
 
-    def _respond_csv(self, table, project_id, info_only=False):
-        flat_data = self._get_data(table, project_id,
-                                   flat=True, info_only=info_only)
-        return pd.DataFrame(flat_data)
+    export_format = 'csv'
+
+    def _spool_rows(self, spool, rows):
+        """Write the rows to a spool file as JSON lines and return the keys
+        found."""
+        keys = set()
+        for row in rows:
+            keys.update(row.keys())
+            spool.write(json.dumps(row) + '\n')
+        return keys
+
+    def _write_spooled_csv(self, out, spools, keys):
+        """Write the rows of the spool files as CSV with a column per key."""
+        if not keys:
+            return
+        header = sorted(keys)
+        writer = UnicodeWriter(out)
+        writer.writerow(header)
+        for spool in spools:
+            for line in spool:
+                row = json.loads(line)
+                writer.writerow([self._csv_value(row.get(key))
+                                 for key in header])
+
+    def _write_csv(self, out, rows):
+        """Write the rows as CSV with a column for every key found.
+
+        The rows are spooled to a temporary file while the header is
+        collected, so only one row is kept in memory at a time.
+        """
+        spool = tempfile.TemporaryFile()
+        try:
+            keys = self._spool_rows(spool, rows)
+            spool.seek(0)
+            self._write_spooled_csv(out, [spool], keys)
+        finally:
+            spool.close()
+
+    def _export_shard(self, ty, project_id, shard, last_id, max_id, total):
+        rows = self._get_rows(ty, project_id, flat=True, last_id=last_id,
+                              max_id=max_id)
+        info_rows = self._get_rows(ty, project_id, flat=True, info_only=True,
+                                   last_id=last_id, max_id=max_id)
+        rows = self._track_progress(rows, project_id, ty, shard, total)
+        parts = {}
+        for kind, data in (('data', rows), ('info', info_rows)):
+            part = tempfile.NamedTemporaryFile(delete=False)
+            try:
+                keys = self._spool_rows(part, data)
+            finally:
+                part.close()
+            parts[kind] = dict(path=part.name, keys=list(keys))
+        return parts
+
+    def _merge_shards(self, out, parts):
+        """Write the rows of the shards as a single CSV."""
+        keys = set()
+        for part in parts:
+            keys.update(part['keys'])
+        spools = []
+        try:
+            for part in parts:
+                spools.append(open(part['path'], 'rb'))
+            self._write_spooled_csv(out, spools, keys)
+        finally:
+            for spool in spools:
+                spool.close()
+            for part in parts:
+                os.remove(part['path'])
+
+    def _csv_value(self, value):
+        if value is None:
+            return ''
+        return value
 
     def _make_zip(self, project, ty):
         name = self._project_name_latin_encoded(project)
-        dataframe = self._respond_csv(ty, project.id)
-        if dataframe is not None:
-            info_dataframe = self._respond_csv(ty, project.id, info_only=True)
-            datafile = tempfile.NamedTemporaryFile()
-            info_datafile = tempfile.NamedTemporaryFile()
+        datafile = tempfile.NamedTemporaryFile()
+        info_datafile = tempfile.NamedTemporaryFile()
+        try:
+            parts = self._run_shards(ty, project.id)
+            self._merge_shards(datafile, [part['data'] for part in parts])
+            self._merge_shards(info_datafile, [part['info'] for part in parts])
+            datafile.flush()
+            info_datafile.flush()
+            zipped_datafile = tempfile.NamedTemporaryFile()
             try:
-                dataframe.to_csv(datafile, index=False,
-                                 encoding='utf-8')
-                info_dataframe.to_csv(
-                    info_datafile, index=False, encoding='utf-8')
-                datafile.flush()
-                info_datafile.flush()
-                zipped_datafile = tempfile.NamedTemporaryFile()
-                try:
-                    _zip = self._zip_factory(zipped_datafile.name)
-                    _zip.write(
-                        datafile.name, secure_filename('%s_%s.csv' % (name, ty)))
-                    _zip.write(
-                        info_datafile.name, secure_filename('%s_%s_info_only.csv' % (name, ty)))
-                    _zip.close()
-                    container = "user_%d" % project.owner_id
-                    _file = FileStorage(
-                        filename=self.download_name(project, ty), stream=zipped_datafile)
-                    uploader.upload_file(_file, container=container)
-                finally:
-                    zipped_datafile.close()
+                _zip = self._zip_factory(zipped_datafile.name)
+                _zip.write(
+                    datafile.name, secure_filename('%s_%s.csv' % (name, ty)))
+                _zip.write(
+                    info_datafile.name, secure_filename('%s_%s_info_only.csv' % (name, ty)))
+                _zip.close()
+                container = "user_%d" % project.owner_id
+                _file = FileStorage(
+                    filename=self.download_name(project, ty), stream=zipped_datafile)
+                uploader.upload_file(_file, container=container)
             finally:
-                datafile.close()
-                info_datafile.close()
+                zipped_datafile.close()
+        finally:
+            datafile.close()
+            info_datafile.close()
+
+    def _write_segment(self, _zip, project, ty, segment, last_id, max_id):
+        name = self._project_name_latin_encoded(project)
+        datafile = tempfile.NamedTemporaryFile()
+        info_datafile = tempfile.NamedTemporaryFile()
+        try:
+            self._write_csv(datafile,
+                            self._get_rows(ty, project.id, flat=True,
+                                           last_id=last_id, max_id=max_id))
+            self._write_csv(info_datafile,
+                            self._get_rows(ty, project.id, flat=True,
+                                           info_only=True, last_id=last_id,
+                                           max_id=max_id))
+            datafile.flush()
+            info_datafile.flush()
+            _zip.write(datafile.name,
+                       secure_filename('%s_%s_%04d.csv' % (name, ty, segment)))
+            _zip.write(info_datafile.name,
+                       secure_filename('%s_%s_%04d_info_only.csv'
+                                       % (name, ty, segment)))
+        finally:
+            datafile.close()
+            info_datafile.close()
 
     def download_name(self, project, ty):
         return super(CsvExporter, self).download_name(project, ty, 'csv')
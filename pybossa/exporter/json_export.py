@@ -20,9 +20,12 @@
 JSON Exporter module for exporting tasks and tasks results out of PYBOSSA
 """
 
+import os
 import uuid
 import json
+import shutil
 import tempfile
+from types import GeneratorType
 from pybossa.exporter import Exporter
 from pybossa.core import uploader, task_repo, sentinel
 from werkzeug.datastructures import FileStorage
@@ -37,9 +40,15 @@ scheduler = Scheduler(queue_name='scheduled_jobs', connection=redis_conn)
 
 class JsonExporter(Exporter):
 
+    export_format = 'json'
+
     def gen_json(self, table, project_id):
         return self._get_data(table, project_id)
 
+    def iter_json(self, table, project_id, last_id=None):
+        """Yield the rows of a table one by one, after last_id if given."""
+        return self._get_rows(table, project_id, last_id=last_id)
+
     def _respond_json(self, ty, id):  # TODO: Refactor _respond_json out?
         # TODO: check ty here
         return self.gen_json(ty, id)
@@ -52,10 +61,72 @@ class JsonExporter(Exporter):
                                    'json', zipname)
         else:
             name = self._project_name_latin_encoded(project)
-            json_task_generator = self._respond_json(ty, project.id)
-            if json_task_generator is not None:
-                return self.handle_zip(name, json_task_generator,
+            datafile = tempfile.TemporaryFile()
+            try:
+                self._merge_shards(datafile, self._run_shards(ty, project.id))
+                datafile.seek(0)
+                return self.handle_zip(name, datafile,
                                        ty, user_id, project, 'json', zipname)
+            finally:
+                datafile.close()
+
+    def _write_json_items(self, out, rows):
+        """Write the rows separated by commas and return how many."""
+        count = 0
+        for row in rows:
+            if count:
+                out.write(', ')
+            out.write(json.dumps(row))
+            count += 1
+        return count
+
+    def _write_json(self, out, rows):
+        """Write the rows as a JSON array one row at a time."""
+        out.write('[')
+        self._write_json_items(out, rows)
+        out.write(']')
+
+    def _export_shard(self, ty, project_id, shard, last_id, max_id, total):
+        rows = self._get_rows(ty, project_id, last_id=last_id, max_id=max_id)
+        rows = self._track_progress(rows, project_id, ty, shard, total)
+        part = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            count = self._write_json_items(part, rows)
+        finally:
+            part.close()
+        return dict(path=part.name, count=count)
+
+    def _merge_shards(self, out, parts):
+        """Join the rows of the shards in a single JSON array."""
+        out.write('[')
+        first = True
+        try:
+            for part in parts:
+                if not part['count']:
+                    continue
+                if not first:
+                    out.write(', ')
+                with open(part['path'], 'rb') as f:
+                    shutil.copyfileobj(f, out)
+                first = False
+        finally:
+            for part in parts:
+                os.remove(part['path'])
+        out.write(']')
+
+    def _write_segment(self, _zip, project, ty, segment, last_id, max_id):
+        name = self._project_name_latin_encoded(project)
+        datafile = tempfile.NamedTemporaryFile()
+        try:
+            self._write_json(datafile, self._get_rows(ty, project.id,
+                                                      last_id=last_id,
+                                                      max_id=max_id))
+            datafile.flush()
+            _zip.write(datafile.name,
+                       secure_filename('%s_%s_%04d.json' % (name, ty,
+                                                            segment)))
+        finally:
+            datafile.close()
 
     def download_name(self, project, ty):
         return super(JsonExporter, self).download_name(project, ty, 'json')
@@ -72,7 +143,12 @@ class JsonExporter(Exporter):
         try:
             datafile = tempfile.NamedTemporaryFile()
             try:
-                datafile.write(json.dumps(data))
+                if isinstance(data, GeneratorType):
+                    self._write_json(datafile, data)
+                elif hasattr(data, 'read'):
+                    shutil.copyfileobj(data, datafile)
+                else:
+                    datafile.write(json.dumps(data))
                 datafile.flush()
                 _zip.write(datafile.name,
                            secure_filename('%s_%s.%s' % (name, ty, ext)))
@@ -15,32 +15,133 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Activity feed of PYBOSSA.
+
+Events are stored in a capped sorted set, scored by time, as compact JSON
+references to the project and the user involved. The fields shown are
+resolved when the feed is read, from cached summaries of the projects and
+the users.
+
+New task and completed task events of a project are coalesced in buckets of
+FEED_BUCKET seconds, so busy projects do not flood the feed.
+
+"""
 import json
 from time import time
-from pybossa.core import sentinel
-try:
-    import cPickle as pickle
-except ImportError:  # pragma: no cover
-    import pickle
+from sqlalchemy import text
+from pybossa.core import sentinel, db, timeouts
+from pybossa.cache import memoize, get_memoized_many
+from pybossa.model.project import Project
+from pybossa.model.user import User
 
 
 FEED_KEY = 'pybossa_feed'
+FEED_MAX_SIZE = 1000
+FEED_BUCKET = 10 * 60
+COALESCED_ACTIONS = ('Task', 'TaskCompleted')
+
 
-def update_feed(obj):
-    """Add domain object to update feed in Redis."""
+def update_feed(action, project_id=None, user_id=None):
+    """Add an event to the update feed in Redis."""
+    now = time()
+    event = dict(action_updated=action)
+    if project_id is not None:
+        event['project_id'] = project_id
+    if user_id is not None:
+        event['user_id'] = user_id
+    if action in COALESCED_ACTIONS:
+        event['bucket'] = int(now // FEED_BUCKET)
+    member = json.dumps(event, sort_keys=True, separators=(',', ':'))
     pipeline = sentinel.master.pipeline()
-    serialized_object = pickle.dumps(obj)
-    pipeline.zadd(FEED_KEY, time(), serialized_object)
+    pipeline.zadd(FEED_KEY, now, member)
+    pipeline.zremrangebyrank(FEED_KEY, 0, -(FEED_MAX_SIZE + 1))
     pipeline.execute()
 
+
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag_project=True)
+def get_feed_project(project_id):
+    """Return the public fields of a project shown in the feed."""
+    sql = text('''SELECT * FROM project WHERE id=:project_id;''')
+    row = db.slave_session.execute(sql, dict(project_id=project_id)).first()
+    if row is None:
+        return None
+    return Project().to_public_json(dict(row))
+
+
+@memoize(timeout=timeouts.get('USER_TIMEOUT'))
+def get_feed_user(user_id):
+    """Return the public fields of a user shown in the feed."""
+    sql = text('''SELECT * FROM "user" WHERE id=:user_id;''')
+    row = db.slave_session.execute(sql, dict(user_id=user_id)).first()
+    if row is None:
+        return None
+    return User().to_public_json(dict(row))
+
+
+def _get_summaries(calls):
+    """Return the summaries of a list of get_feed_* calls, by call."""
+    summaries = dict((call, None) for call in calls)
+    for function, model, table in ((get_feed_project, Project, 'project'),
+                                   (get_feed_user, User, '"user"')):
+        ids = [args[0] for f, args in calls if f is function]
+        if not ids:
+            continue
+        sql = text('''SELECT * FROM {} WHERE id=ANY(:ids);'''.format(table))
+        for row in db.slave_session.execute(sql, dict(ids=ids)):
+            summaries[(function, (row.id,))] = model().to_public_json(dict(row))
+    return summaries
+
+
+def _resolve(event, summaries):
+    project = user = None
+    if event.get('project_id') is not None:
+        project = summaries[(get_feed_project, (event['project_id'],))]
+        if project is None:
+            return None
+    if event.get('user_id') is not None:
+        user = summaries[(get_feed_user, (event['user_id'],))]
+        if user is None:
+            return None
+    if user is None:
+        tmp = dict(project)
+    else:
+        tmp = dict(user)
+        if project is not None:
+            tmp['project_id'] = project['id']
+            tmp['project_name'] = project['name']
+            tmp['project_short_name'] = project['short_name']
+            tmp['category_id'] = project['category_id']
+    tmp['action_updated'] = event['action_updated']
+    return tmp
+
+
 def get_update_feed():
-    """Return update feed list."""
+    """Return update feed list.
+
+    The projects and users of the events are resolved in a single batch.
+    """
     data = sentinel.slave.zrevrange(FEED_KEY, 0, 99, withscores=True)
+    events = []
+    calls = set()
+    for member, score in data:
+        try:
+            event = json.loads(member)
+        except ValueError:
+            # Entries stored before the feed was compacted
+            continue
+        if event.get('project_id') is not None:
+            calls.add((get_feed_project, (event['project_id'],)))
+        if event.get('user_id') is not None:
+            calls.add((get_feed_user, (event['user_id'],)))
+        events.append((event, score))
+    calls = list(calls)
+    summaries = dict(zip(calls, get_memoized_many(calls, _get_summaries)))
     feed = []
-    for u in data:
-        tmp = pickle.loads(u[0])
-        tmp['updated'] = u[1]
-        if tmp.get('info') and type(tmp.get('info')) == unicode:
-            tmp['info'] = json.loads(tmp['info'])
+    for event, score in events:
+        tmp = _resolve(event, summaries)
+        if tmp is None:
+            continue
+        tmp['updated'] = score
         feed.append(tmp)
     return feed
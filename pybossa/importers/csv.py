@@ -17,7 +17,6 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
 import requests
-from StringIO import StringIO
 from flask_babel import gettext
 from pybossa.util import unicode_csv_reader
 
@@ -25,6 +24,39 @@ from .base import BulkTaskImport, BulkImportException
 from werkzeug.datastructures import FileStorage
 import io, time
 
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _iter_response_lines(r):
+    """Yield the lines of a streamed response keeping their line breaks.
+
+    Lines are split on \\n only, so quoted cells spanning several lines are
+    handed to the CSV reader as they are in the file.
+    """
+    pending = u''
+    try:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE,
+                                    decode_unicode=True):
+            lines = (pending + chunk).split(u'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + u'\n'
+        if pending:
+            yield pending
+    finally:
+        r.close()
+
+
+def _iter_file_lines(stream):
+    """Yield the lines of a file closing it once read."""
+    try:
+        for line in iter(stream.readline, u''):
+            yield line
+    finally:
+        stream.close()
+
+
 class BulkTaskCSVImport(BulkTaskImport):
 
     """Class to import CSV tasks in bulk."""
@@ -37,8 +69,18 @@ class BulkTaskCSVImport(BulkTaskImport):
 
     def tasks(self):
         """Get tasks from a given URL."""
+        csvreader = unicode_csv_reader(self._get_csv_lines())
+        return self._import_csv_tasks(csvreader)
+
+    def count_tasks(self):
+        """Count the rows of the CSV without building the tasks."""
+        csvreader = unicode_csv_reader(self._get_csv_lines())
+        return self._count_csv_tasks(csvreader)
+
+    def _get_csv_lines(self):
+        """Get a generator with the lines of the CSV."""
         dataurl = self._get_data_url()
-        r = requests.get(dataurl)
+        r = requests.get(dataurl, stream=True)
         return self._get_csv_data_from_request(r)
 
     def _get_data_url(self):
@@ -55,8 +97,7 @@ class BulkTaskCSVImport(BulkTaskImport):
         for row in csvreader:
             if not headers:
                 headers = row
-                self._check_no_duplicated_headers(headers)
-                self._check_no_empty_headers(headers)
+                self._check_valid_headers(headers)
                 field_headers = set(headers) & fields
                 for field in field_headers:
                     field_header_index.append(headers.index(field))
@@ -71,6 +112,23 @@ class BulkTaskCSVImport(BulkTaskImport):
                         task_data["info"][headers[idx]] = cell
                 yield task_data
 
+    def _count_csv_tasks(self, csvreader):
+        """Count CSV tasks checking the rows as the import does."""
+        headers = []
+        row_number = 0
+        for row in csvreader:
+            if not headers:
+                headers = row
+                self._check_valid_headers(headers)
+            else:
+                row_number += 1
+                self._check_valid_row_length(row, row_number, headers)
+        return row_number
+
+    def _check_valid_headers(self, headers):
+        self._check_no_duplicated_headers(headers)
+        self._check_no_empty_headers(headers)
+
     def _check_no_duplicated_headers(self, headers):
         if len(headers) != len(set(headers)):
             msg = gettext('The file you uploaded has '
@@ -103,9 +161,7 @@ class BulkTaskCSVImport(BulkTaskImport):
             raise BulkImportException(msg, 'error')
 
         r.encoding = 'utf-8'
-        csvcontent = StringIO(r.text)
-        csvreader = unicode_csv_reader(csvcontent)
-        return self._import_csv_tasks(csvreader)
+        return _iter_response_lines(r)
 
 
 class BulkTaskGDImport(BulkTaskCSVImport):
@@ -142,9 +198,6 @@ class BulkTaskLocalCSVImport(BulkTaskCSVImport):
         """Get data."""
         return self.form_data['csv_filename']
 
-    def count_tasks(self):
-        return len([task for task in self.tasks()])
-
     def _get_csv_data_from_request(self, csv_filename):
         if csv_filename is None:
             msg = ("Not a valid csv file for import")
@@ -165,11 +218,9 @@ class BulkTaskLocalCSVImport(BulkTaskCSVImport):
             raise BulkImportException(gettext(msg), 'error')
 
         csv_file.stream.seek(0)
-        csvcontent = io.StringIO(csv_file.stream.read())
-        csvreader = unicode_csv_reader(csvcontent)
-        return list(self._import_csv_tasks(csvreader))
+        return _iter_file_lines(csv_file.stream)
 
-    def tasks(self):
-        """Get tasks from a given URL."""
+    def _get_csv_lines(self):
+        """Get a generator with the lines of the local file."""
         csv_filename = self._get_data()
         return self._get_csv_data_from_request(csv_filename)
@@ -26,6 +26,12 @@ from .epicollect import BulkTaskEpiCollectPlusImport
 from .iiif import BulkTaskIIIFImporter
 from .s3 import BulkTaskS3Import
 from .minio import BulkTaskMinioImport
+
+
+# Tasks checked for duplicates and inserted at a time
+IMPORT_BATCH_SIZE = 1000
+
+
 class Importer(object):
 
     """Class to import data."""
@@ -61,22 +67,31 @@ class Importer(object):
     def create_tasks(self, task_repo, project_id, **form_data):
         """Create tasks."""
         from pybossa.model.task import Task
+        from pybossa.cache import projects as cached_projects
         """Create tasks from a remote source using an importer object and
         avoiding the creation of repeated tasks"""
-        empty = True
         n = 0
         importer = self._create_importer_for(**form_data)
-        for task_data in importer.tasks():
-            task = Task(project_id=project_id)
-            [setattr(task, k, v) for k, v in task_data.iteritems()]
-            found = task_repo.get_task_by(project_id=project_id, info=task.info)
-            if found is None:
-                task_repo.save(task)
-                n += 1
-                empty = False
-        if empty:
+        tasks = []
+        # All the batches are committed with the last one, so a source that
+        # fails halfway does not leave part of its tasks imported
+        try:
+            for task_data in importer.tasks():
+                task = Task(project_id=project_id)
+                [setattr(task, k, v) for k, v in task_data.iteritems()]
+                tasks.append(task)
+                if len(tasks) == IMPORT_BATCH_SIZE:
+                    n += len(task_repo.import_tasks(project_id, tasks,
+                                                    commit=False))
+                    tasks = []
+            n += len(task_repo.import_tasks(project_id, tasks))
+        except Exception:
+            task_repo.db.session.rollback()
+            raise
+        if n == 0:
             msg = gettext('It looks like there were no new records to import')
             return ImportReport(message=msg, metadata=None, total=n)
+        cached_projects.clean_project(project_id)
         metadata = importer.import_metadata()
         msg = str(n) + " " + gettext('new tasks were imported successfully')
         if n == 1:
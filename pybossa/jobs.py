@@ -30,6 +30,9 @@ from pbsonesignal import PybossaOneSignal
 from pybossa.core import uploader
 from pybossa.exporter.json_export import JsonExporter
 
+#: Projects with counter deltas to compact
+DIRTY_COUNTERS_KEY = 'pybossa:counter:dirty'
+
 
 def schedule_job(function, scheduler):
     """Schedule a job and return a log message."""
@@ -120,10 +123,13 @@ def get_periodic_jobs(queue):
     leaderboard_jobs = get_leaderboard_jobs() if queue == 'super' else []
     weekly_update_jobs = get_weekly_stats_update_projects() if queue == 'low' else []
     failed_jobs = get_maintenance_jobs() if queue == 'maintenance' else []
+    task_queue_jobs = get_task_queue_jobs() if queue == 'low' else []
+    counter_jobs = get_counter_compaction_jobs() if queue == 'low' else []
     _all = [zip_jobs, jobs, project_jobs, autoimport_jobs,
             engage_jobs, non_contrib_jobs, dashboard_jobs,
             weekly_update_jobs, failed_jobs, leaderboard_jobs,
-            warning_jobs, delete_account_jobs]
+            warning_jobs, delete_account_jobs, task_queue_jobs,
+            counter_jobs]
 
     return (job for sublist in _all for job in sublist if job['queue'] == queue)
 
@@ -164,8 +170,17 @@ def get_export_task_jobs(queue):
                         if p.owner.pro is False)
     else:
         projects = (p.dictize() for p in project_repo.filter_by(published=True))
+    per_table = current_app.config.get('EXPORT_JOBS_PER_TABLE')
     for project in projects:
         project_id = project.get('id')
+        if per_table:
+            for ty in ('task', 'task_run', 'result'):
+                for fmt in ('json', 'csv'):
+                    yield dict(name=project_export_table,
+                               args=[project_id, ty, fmt], kwargs={},
+                               timeout=timeout,
+                               queue=queue)
+            continue
         job = dict(name=project_export,
                    args=[project_id], kwargs={},
                    timeout=timeout,
@@ -173,14 +188,31 @@ def get_export_task_jobs(queue):
         yield job
 
 
+def project_export_table(_id, ty, fmt):
+    """Export one table of a project in one format."""
+    from pybossa.core import project_repo, json_exporter, csv_exporter
+    exporter = dict(json=json_exporter, csv=csv_exporter)[fmt]
+    app = project_repo.get(_id)
+    if app is not None:
+        print "Export project id %d %s (%s)" % (_id, ty, fmt)
+        if current_app.config.get('EXPORT_INCREMENTAL'):
+            exporter._make_incremental_zip(app, ty)
+        else:
+            exporter._make_zip(app, ty)
+
+
 def project_export(_id):
     """Export project."""
     from pybossa.core import project_repo, json_exporter, csv_exporter
     app = project_repo.get(_id)
     if app is not None:
         print "Export project id %d" % _id
-        json_exporter.pregenerate_zip_files(app)
-        csv_exporter.pregenerate_zip_files(app)
+        if current_app.config.get('EXPORT_INCREMENTAL'):
+            json_exporter.pregenerate_incremental_zip_files(app)
+            csv_exporter.pregenerate_incremental_zip_files(app)
+        else:
+            json_exporter.pregenerate_zip_files(app)
+            csv_exporter.pregenerate_zip_files(app)
 
 
 def get_project_jobs(queue):
@@ -205,6 +237,40 @@ def get_project_jobs(queue):
         yield job
 
 
+def get_task_queue_jobs(queue='low'):
+    """Return jobs to reconcile the Redis task queues with the DB."""
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    timeout = current_app.config.get('TIMEOUT')
+    sql = text('''SELECT id FROM project
+               WHERE info->>'sched'='depth_first_queue';''')
+    results = db.slave_session.execute(sql)
+    for row in results:
+        yield dict(name=reconcile_task_queue,
+                   args=[row.id], kwargs={},
+                   timeout=timeout,
+                   queue=queue)
+
+
+def get_counter_compaction_jobs(queue='low'):
+    """Return jobs to compact the counters of the projects with deltas.
+
+    The task run listeners flag the projects they append deltas to in a
+    Redis set, which is emptied here.
+    """
+    from pybossa.core import sentinel
+    timeout = current_app.config.get('TIMEOUT')
+    pipeline = sentinel.master.pipeline()
+    pipeline.smembers(DIRTY_COUNTERS_KEY)
+    pipeline.delete(DIRTY_COUNTERS_KEY)
+    project_ids, _ = pipeline.execute()
+    for project_id in sorted(int(project_id) for project_id in project_ids):
+        yield dict(name=compact_counters,
+                   args=[project_id], kwargs={},
+                   timeout=timeout,
+                   queue=queue)
+
+
 def create_dict_jobs(data, function, timeout, queue='low'):
     """Create a dict job."""
     for d in data:
@@ -531,54 +597,185 @@ def import_tasks(project_id, from_auto=False, **form_data):
     return msg
 
 
+def _webhook_options():
+    return dict(timeout=current_app.config.get('WEBHOOK_TIMEOUT'),
+                retries=current_app.config.get('WEBHOOK_RETRIES'),
+                backoff=current_app.config.get('WEBHOOK_BACKOFF'))
+
+
+def _post_webhook(url, data, params=None, options=None, max_length=None):
+    """Post to a webhook and return its truncated response and status code."""
+    from pybossa import webhook_dispatcher
+    try:
+        response = webhook_dispatcher.post(url, data, params=params,
+                                           **(options or {}))
+        return (webhook_dispatcher.truncate(response.text, max_length),
+                response.status_code)
+    except requests.exceptions.RequestException:
+        return 'Connection Error', None
+
+
+def _notify_webhooks(project, webhooks):
+    failed = [wh for wh in webhooks if wh.response_status_code != 200]
+    if failed and project.published and current_app.config.get('ADMINS'):
+        subject = "Broken: %s webhook failed" % project.name
+        body = 'Sorry, but the webhook failed'
+        mail_dict = dict(recipients=current_app.config.get('ADMINS'),
+                         subject=subject, body=body, html=failed[-1].response)
+        send_mail(mail_dict)
+    if current_app.config.get('SSE'):
+        from pybossa.core import sentinel
+        for wh in webhooks:
+            publish_channel(sentinel, project.short_name,
+                            data=wh.dictize(), type='webhook', private=True)
+
+
 def webhook(url, payload=None, oid=None, rerun=False):
     """Post to a webhook."""
-    from flask import current_app
-    from readability.readability import Document
-    try:
-        import json
-        from pybossa.core import sentinel, webhook_repo, project_repo
-        project = project_repo.get(payload['project_id'])
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        if oid:
-            webhook = webhook_repo.get(oid)
-        else:
-            webhook = Webhook(project_id=payload['project_id'],
-                              payload=payload)
-        if url:
-            params = dict()
-            if rerun:
-                params['rerun'] = True
-            response = requests.post(url, params=params,
-                                     data=json.dumps(payload),
-                                     headers=headers)
-            webhook.response = Document(response.text).summary()
-            webhook.response_status_code = response.status_code
-        else:
-            raise requests.exceptions.ConnectionError('Not URL')
-        if oid:
-            webhook_repo.update(webhook)
-            webhook = webhook_repo.get(oid)
-        else:
-            webhook_repo.save(webhook)
-    except requests.exceptions.ConnectionError:
-        webhook.response = 'Connection Error'
-        webhook.response_status_code = None
+    import json
+    from pybossa.core import webhook_repo, project_repo
+    project = project_repo.get(payload['project_id'])
+    if oid:
+        webhook = webhook_repo.get(oid)
+    else:
+        webhook = Webhook(project_id=payload['project_id'],
+                          payload=payload)
+    if url:
+        params = dict()
+        if rerun:
+            params['rerun'] = True
+        max_length = current_app.config.get('WEBHOOK_RESPONSE_MAX_LENGTH')
+        response, status_code = _post_webhook(url, json.dumps(payload),
+                                              params=params,
+                                              options=_webhook_options(),
+                                              max_length=max_length)
+    else:
+        response, status_code = 'Connection Error', None
+    webhook.response = response
+    webhook.response_status_code = status_code
+    if oid:
+        webhook_repo.update(webhook)
+        webhook = webhook_repo.get(oid)
+    else:
         webhook_repo.save(webhook)
-    finally:
-        if project.published and webhook.response_status_code != 200 and current_app.config.get('ADMINS'):
-            subject = "Broken: %s webhook failed" % project.name
-            body = 'Sorry, but the webhook failed'
-            mail_dict = dict(recipients=current_app.config.get('ADMINS'),
-                             subject=subject, body=body, html=webhook.response)
-            send_mail(mail_dict)
-    if current_app.config.get('SSE'):
-        publish_channel(sentinel, payload['project_short_name'],
-                        data=webhook.dictize(), type='webhook',
-                        private=True)
+    _notify_webhooks(project, [webhook])
     return webhook
 
 
+def dispatch_webhooks(project_id):
+    """Deliver the pending webhooks of a project.
+
+    They are posted concurrently by WEBHOOK_WORKERS threads. With
+    WEBHOOK_BATCH_SIZE > 1 the payloads for the same URL are posted
+    together as a JSON list. The responses of every round of deliveries
+    are stored with a single bulk insert. The payloads of a round stay in
+    the processing list of the job until then, so that a later job posts
+    them again if this one dies.
+    """
+    import json
+    from functools import partial
+    from multiprocessing.pool import ThreadPool
+    from pybossa import webhook_dispatcher
+    from pybossa.core import sentinel, webhook_repo, project_repo
+    project = project_repo.get(project_id)
+    workers = current_app.config.get('WEBHOOK_WORKERS')
+    batch_size = current_app.config.get('WEBHOOK_BATCH_SIZE')
+    max_length = current_app.config.get('WEBHOOK_RESPONSE_MAX_LENGTH')
+    post = partial(_post_webhook, options=_webhook_options(),
+                   max_length=max_length)
+
+    def deliver(batch):
+        url, payloads = batch
+        data = payloads if batch_size > 1 else payloads[0]
+        return post(url, json.dumps(data))
+
+    webhook_dispatcher.unschedule(project_id, sentinel.master)
+    processing = webhook_dispatcher.claim(project_id, sentinel.master)
+    pool = ThreadPool(workers)
+    delivered = 0
+    try:
+        while True:
+            items = webhook_dispatcher.pop(project_id, sentinel.master,
+                                           workers * batch_size, processing)
+            if not items:
+                break
+            batches = []
+            urls = []
+            for item in items:
+                if item['url'] not in urls:
+                    urls.append(item['url'])
+            for url in urls:
+                payloads = [item['payload'] for item in items
+                            if item['url'] == url]
+                for i in range(0, len(payloads), batch_size):
+                    batches.append((url, payloads[i:i + batch_size]))
+
+            webhooks = []
+            for (url, payloads), (response, status_code) in zip(
+                    batches, pool.map(deliver, batches)):
+                for payload in payloads:
+                    webhooks.append(Webhook(project_id=project_id,
+                                            payload=payload,
+                                            response=response,
+                                            response_status_code=status_code))
+            webhook_repo.save_many(webhooks)
+            webhook_dispatcher.ack(processing, sentinel.master)
+            _notify_webhooks(project, webhooks)
+            delivered += len(webhooks)
+    finally:
+        pool.close()
+        pool.join()
+    webhook_dispatcher.release(project_id, processing, sentinel.master)
+    return "%s webhooks of project %s delivered" % (delivered, project_id)
+
+
+def reconcile_task_queue(project_id):
+    """Rebuild the Redis task queue of a project from the DB."""
+    from pybossa.core import db, sentinel
+    from pybossa import redis_task_queue
+    size = redis_task_queue.rebuild(project_id, sentinel.master,
+                                    db.slave_session)
+    return "Task queue of project %s rebuilt with %s tasks" % (project_id,
+                                                              size)
+
+
+def compact_counters(project_id):
+    """Fold the counter rows of every task of a project into a single one.
+
+    Task runs append +1/-1 rows to the counter table. Folding them keeps one
+    row per task with its number of task runs, so the breadth first
+    scheduler does not have to sum the whole log.
+    """
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    from pybossa.model import make_timestamp
+    # A single statement: rows inserted meanwhile are kept as new deltas
+    sql = text('''WITH folded AS (
+                   DELETE FROM counter
+                   WHERE project_id=:project_id AND task_id IN (
+                       SELECT task_id FROM counter
+                       WHERE project_id=:project_id
+                       GROUP BY task_id HAVING COUNT(*) > 1)
+                   RETURNING task_id, n_task_runs)
+               INSERT INTO counter(created, project_id, task_id, n_task_runs)
+               SELECT CAST(:created AS TIMESTAMP), :project_id, task_id,
+                      SUM(n_task_runs)
+               FROM folded GROUP BY task_id;''')
+    result = db.session.execute(sql, dict(project_id=project_id,
+                                          created=make_timestamp()))
+    db.session.commit()
+    return "Counters of %s tasks of project %s compacted" % (result.rowcount,
+                                                             project_id)
+
+
+def refresh_cached_function(module_name, function_name, args, kwargs):
+    """Recompute the cached value of a function with the given arguments."""
+    import importlib
+    module = importlib.import_module(module_name)
+    getattr(module, function_name).refresh(*args, **kwargs)
+    return "%s.%s refreshed" % (module_name, function_name)
+
+
 def notify_blog_users(blog_id, project_id, queue='high'):
     """Send email with new blog post."""
     from sqlalchemy.sql import text
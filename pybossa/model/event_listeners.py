@@ -16,10 +16,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 from datetime import datetime
-from flask import current_app
+from flask import current_app, g, has_app_context
 
 from rq import Queue
-from sqlalchemy import event
+from sqlalchemy import event, text
 
 from flask import url_for
 
@@ -28,16 +28,18 @@ from pybossa.model import update_project_timestamp, update_target_timestamp
 from pybossa.model import make_timestamp
 from pybossa.model.blogpost import Blogpost
 from pybossa.model.project import Project
-from pybossa.model.task import Task
+from pybossa.model.task import Task, hash_info
 from pybossa.model.task_run import TaskRun
 from pybossa.model.webhook import Webhook
 from pybossa.model.user import User
 from pybossa.model.result import Result
 from pybossa.model.counter import Counter
 from pybossa.core import result_repo, db
-from pybossa.jobs import webhook, notify_blog_users
+from pybossa.jobs import (dispatch_webhooks, notify_blog_users,
+                          DIRTY_COUNTERS_KEY)
 from pybossa.jobs import push_notification
 from pybossa import sched
+from pybossa import redis_task_queue, webhook_dispatcher
 
 from pybossa.core import sentinel
 
@@ -46,22 +48,49 @@ mail_queue = Queue('email', connection=sentinel.master)
 webpush_queue = Queue('webpush', connection=sentinel.master)
 
 
+PROJECT_SQL = text('''SELECT name, short_name, published, webhook, info,
+                   category_id FROM project WHERE id=:project_id;''')
+
+
+def get_project(conn, project_id):
+    """Return the project data used by the listeners.
+
+    It is cached for the rest of the request, so bulk inserts of tasks or
+    task runs only look the project up once.
+    """
+    cached = g.get('_listener_projects', {}) if has_app_context() else {}
+    if project_id not in cached:
+        tmp = dict()
+        for r in conn.execute(PROJECT_SQL, dict(project_id=project_id)):
+            tmp = dict(id=project_id, name=r.name, short_name=r.short_name,
+                       published=r.published, webhook=r.webhook,
+                       info=r.info, category_id=r.category_id)
+        if not has_app_context():
+            return tmp
+        cached[project_id] = tmp
+        g._listener_projects = cached
+    return dict(cached[project_id])
+
+
+def uses_task_queue(conn, project_id):
+    """Return True if the project is scheduled from the Redis task queue."""
+    info = get_project(conn, project_id).get('info') or {}
+    return info.get('sched') == 'depth_first_queue'
+
+
+@event.listens_for(Project, 'after_update')
+@event.listens_for(Project, 'after_delete')
+def forget_project(mapper, conn, target):
+    """Drop the project from the listeners cache of the request."""
+    if has_app_context():
+        g.get('_listener_projects', {}).pop(target.id, None)
+
+
 @event.listens_for(Blogpost, 'after_insert')
 def add_blog_event(mapper, conn, target):
     """Update PYBOSSA feed with new blog post."""
-    sql_query = ('select name, short_name, info from project \
-                 where id=%s') % target.project_id
-    results = conn.execute(sql_query)
-    obj = dict(action_updated='Blog')
-    tmp = dict()
-    for r in results:
-        tmp['id'] = target.project_id
-        tmp['name'] = r.name
-        tmp['short_name'] = r.short_name
-        tmp['info'] = r.info
-    tmp = Project().to_public_json(tmp)
-    obj.update(tmp)
-    update_feed(obj)
+    tmp = get_project(conn, target.project_id)
+    update_feed('Blog', project_id=target.project_id)
     # Notify volunteers
     if current_app.config.get('DISABLE_EMAIL_NOTIFICATIONS') is None:
         scheme = current_app.config.get('PREFERRED_URL_SCHEME', 'http')
@@ -91,14 +120,7 @@ def add_blog_event(mapper, conn, target):
 @event.listens_for(Project, 'after_insert')
 def add_project_event(mapper, conn, target):
     """Update PYBOSSA feed with new project."""
-    tmp = dict(id=target.id,
-               name=target.name,
-               short_name=target.short_name,
-               info=target.info)
-    obj = dict(action_updated='Project')
-    tmp = Project().to_public_json(tmp)
-    obj.update(tmp)
-    update_feed(obj)
+    update_feed('Project', project_id=target.id)
     # Create a clean projectstats object for it
     sql_query = """INSERT INTO project_stats
                    (project_id, n_tasks, n_task_runs, n_results, n_volunteers,
@@ -111,65 +133,61 @@ def add_project_event(mapper, conn, target):
 @event.listens_for(Task, 'after_insert')
 def add_task_event(mapper, conn, target):
     """Update PYBOSSA feed with new task."""
-    sql_query = ('select name, short_name, info from project \
-                 where id=%s') % target.project_id
-    results = conn.execute(sql_query)
-    obj = dict(action_updated='Task')
-    tmp = dict()
-    for r in results:
-        tmp['id'] = target.project_id
-        tmp['name'] = r.name
-        tmp['short_name'] = r.short_name
-        tmp['info'] = r.info
-    tmp = Project().to_public_json(tmp)
-    obj.update(tmp)
-    update_feed(obj)
+    tmp = get_project(conn, target.project_id)
+    _sched = (tmp.get('info') or {}).get('sched')
+    update_feed('Task', project_id=target.project_id)
+    if _sched == 'depth_first_queue':
+        redis_task_queue.push(target.project_id, target.id, target.priority_0,
+                              sentinel.master)
+
+
+@event.listens_for(Task, 'before_insert')
+@event.listens_for(Task, 'before_update')
+def set_info_hash(mapper, conn, target):
+    """Keep the digest of the task info up to date."""
+    target.info_hash = hash_info(target.info)
+
+
+TASKS_IMPORT_SQL = text('''
+    WITH imported AS (
+        SELECT unnest(CAST(:task_ids AS integer[])) AS task_id
+    ), counters AS (
+        INSERT INTO counter(created, project_id, task_id, n_task_runs)
+        SELECT CAST(:created AS TIMESTAMP), :project_id, task_id, 0
+        FROM imported
+    )
+    UPDATE project SET updated=:created WHERE id=:project_id;
+    ''')
+
+
+def after_tasks_import(conn, project_id, tasks):
+    """Do the bookkeeping of the Task after_insert listeners for a set of
+    tasks inserted in bulk into the same project."""
+    if not tasks:
+        return
+    params = dict(task_ids=[task.id for task in tasks], project_id=project_id,
+                  created=make_timestamp())
+    conn.execute(TASKS_IMPORT_SQL, params)
+    tmp = get_project(conn, project_id)
+    _sched = (tmp.get('info') or {}).get('sched')
+    update_feed('Task', project_id=project_id)
+    if _sched == 'depth_first_queue':
+        redis_task_queue.push_many(project_id,
+                                   [(task.id, task.priority_0)
+                                    for task in tasks],
+                                   sentinel.master)
 
 
 @event.listens_for(User, 'after_insert')
 def add_user_event(mapper, conn, target):
     """Update PYBOSSA feed with new user."""
-    obj = target.to_public_json()
-    obj['action_updated'] = 'User'
-    update_feed(obj)
-
-
-def add_user_contributed_to_feed(conn, user_id, project_obj):
-    if user_id is not None:
-        sql_query = ('select fullname, name, info from "user" \
-                     where id=%s and restrict=false') % user_id
-        results = conn.execute(sql_query)
-        tmp = None
-        for r in results:
-            tmp = dict(id=user_id,
-                       name=r.name,
-                       fullname=r.fullname,
-                       info=r.info)
-            tmp = User().to_public_json(tmp)
-            tmp['project_id'] = project_obj['id']
-            tmp['project_name'] = project_obj['name']
-            tmp['project_short_name'] = project_obj['short_name']
-            tmp['category_id'] = project_obj['category_id']
-            tmp['action_updated'] = 'UserContribution'
-        if tmp:
-            update_feed(tmp)
-
-
-def is_task_completed(conn, task_id, project_id):
-    sql_query = ('select count(id) from task_run \
-                 where task_run.task_id=%s and \
-                 task_run.project_id=%s') % (task_id, project_id)
-    n_answers = conn.scalar(sql_query)
-    sql_query = ('select n_answers from task \
-                 where task.id=%s') % task_id
-    task_n_answers = conn.scalar(sql_query)
-    return (n_answers) >= task_n_answers
-
-
-def update_task_state(conn, task_id):
-    sql_query = ("UPDATE task SET state=\'completed\' \
-                 where id=%s") % task_id
-    conn.execute(sql_query)
+    update_feed('User', user_id=target.id)
+
+
+def add_user_contributed_to_feed(user, project_obj):
+    if user is not None:
+        update_feed('UserContribution', project_id=project_obj['id'],
+                    user_id=user['id'])
 
 
 def push_webhook(project_obj, task_id, result_id):
@@ -180,84 +198,129 @@ def push_webhook(project_obj, task_id, result_id):
                        task_id=task_id,
                        result_id=result_id,
                        fired_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
-        webhook_queue.enqueue(webhook, project_obj['webhook'], payload)
-
-
-def create_result(conn, project_id, task_id):
-    """Create a result for the given project and task."""
-    sql_query = ("SELECT id FROM task_run WHERE project_id=%s \
-                 AND task_id=%s") % (project_id, task_id)
-    results = conn.execute(sql_query)
-    task_run_ids = ", ".join(str(tr.id) for tr in results)
-
-    sql_query = ("""SELECT id FROM result WHERE project_id=%s \
-                   AND task_id=%s;""") % (project_id, task_id)
-
-    results = conn.execute(sql_query)
-
-    for r in results:
-        if r:
-            # Update result
-            sql_query = ("""UPDATE result SET last_version=false \
-                           WHERE id=%s;""") % (r.id)
-            conn.execute(sql_query)
-
-    sql_query = """INSERT INTO result
-                   (created, project_id, task_id, task_run_ids, last_version)
-                   VALUES ('%s', %s, %s, '{%s}', %s);""" % (make_timestamp(),
-                                                  project_id,
-                                                  task_id,
-                                                  task_run_ids,
-                                                  True)
-    conn.execute(sql_query)
-
-    sql_query = """SELECT id FROM result \
-                WHERE project_id=%s \
-                AND task_id=%s \
-                AND last_version=true""" % (project_id, task_id)
-
-    results = conn.execute(sql_query)
-    for r in results:
-        return r.id
-
-@event.listens_for(TaskRun, 'after_insert')
-def on_taskrun_submit(mapper, conn, target):
-    """Update the task.state when n_answers condition is met."""
-    # Get project details
-    sql_query = ('select name, short_name, published, webhook, info, category_id \
-                 from project where id=%s') % target.project_id
-    results = conn.execute(sql_query)
-    tmp = dict()
-    for r in results:
-        tmp['name'] = r.name
-        tmp['short_name'] = r.short_name
-        _published = r.published
-        tmp['info'] = r.info
-        _webhook = r.webhook
-        tmp['category_id'] = r.category_id
-        tmp['id'] = target.project_id
+        if webhook_dispatcher.push(project_obj['id'], project_obj['webhook'],
+                                   payload, sentinel.master):
+            webhook_queue.enqueue(dispatch_webhooks, project_obj['id'])
+
+
+# Appends the counter deltas of the submitted tasks, adds them to the
+# n_task_runs of the tasks, flips their state and versions their result once
+# n_answers is met. It returns a row per new
+# result (or a single one with NULLs) with the contributor for the feed.
+TASK_RUNS_SUBMIT_SQL = text('''
+    WITH submitted AS (
+        SELECT task_id, COUNT(*) AS n_task_runs
+        FROM unnest(CAST(:task_ids AS integer[])) AS task_id
+        GROUP BY task_id),
+    new_counters AS (
+        INSERT INTO counter(created, project_id, task_id, n_task_runs)
+        SELECT CAST(:created AS TIMESTAMP), :project_id, task_id, n_task_runs
+        FROM submitted),
+    updated_project AS (
+        UPDATE project SET updated=:created WHERE id=:project_id),
+    task_runs AS (
+        SELECT task_id, array_agg(id ORDER BY id) AS ids FROM task_run
+        WHERE project_id=:project_id
+        AND task_id IN (SELECT task_id FROM submitted)
+        GROUP BY task_id),
+    updated_tasks AS (
+        UPDATE task SET n_task_runs=task.n_task_runs + submitted.n_task_runs,
+        state=CASE WHEN array_length(task_runs.ids, 1) >= task.n_answers
+                   THEN 'completed' ELSE task.state END
+        FROM submitted JOIN task_runs ON task_runs.task_id=submitted.task_id
+        WHERE task.id=submitted.task_id
+        RETURNING task.id,
+        array_length(task_runs.ids, 1) >= task.n_answers AS completed),
+    completed AS (
+        SELECT id FROM updated_tasks WHERE completed),
+    old_results AS (
+        UPDATE result SET last_version=false
+        WHERE project_id=:project_id
+        AND task_id IN (SELECT id FROM completed)),
+    new_results AS (
+        INSERT INTO result(created, project_id, task_id, task_run_ids,
+                           last_version)
+        SELECT :created, :project_id, task_runs.task_id, task_runs.ids, true
+        FROM task_runs JOIN completed ON completed.id=task_runs.task_id
+        RETURNING id, task_id)
+    SELECT new_results.task_id, new_results.id AS result_id,
+           "user".id AS user_id, "user".name, "user".fullname, "user".info
+    FROM (SELECT 1) AS submit
+    LEFT JOIN new_results ON true
+    LEFT JOIN "user" ON "user".id=:user_id AND "user".restrict=false
+    ORDER BY new_results.task_id;''')
+
+
+def submit_task_runs(conn, project_id, task_ids, user_id):
+    """Record task runs of a contributor and return the results created.
+
+    Returns a dict with the new result id of every completed task, and the
+    public data of the contributor, if any.
+    """
+    rows = conn.execute(TASK_RUNS_SUBMIT_SQL,
+                        dict(created=make_timestamp(),
+                             project_id=project_id,
+                             task_ids=list(task_ids),
+                             user_id=user_id)).fetchall()
+    sentinel.master.sadd(DIRTY_COUNTERS_KEY, project_id)
+    results = dict((row.task_id, row.result_id) for row in rows
+                   if row.result_id is not None)
+    user = None
+    if rows[0].user_id is not None:
+        row = rows[0]
+        user = dict(id=row.user_id, name=row.name, fullname=row.fullname,
+                    info=row.info)
+    return results, user
+
+
+def after_task_runs_submit(conn, project_id, task_runs):
+    """Update counters, tasks, results, feed and webhooks for task runs.
+
+    The task runs must belong to the same project and contributor.
+    """
+    tmp = get_project(conn, project_id)
+    _webhook = tmp['webhook']
 
     project_public = dict()
     project_public.update(Project().to_public_json(tmp))
-    project_public['action_updated'] = 'TaskCompleted'
-
-    sched.after_save(target, conn)
-    add_user_contributed_to_feed(conn, target.user_id, project_public)
-    if is_task_completed(conn, target.task_id, target.project_id):
-        update_task_state(conn, target.task_id)
-        update_feed(project_public)
-        result_id = create_result(conn, target.project_id, target.task_id)
+
+    scheduler = (tmp.get('info') or {}).get('sched') or 'default'
+    for task_run in task_runs:
+        sched.after_save(task_run, conn, scheduler)
+    results, user = submit_task_runs(conn, project_id,
+                                     [tr.task_id for tr in task_runs],
+                                     task_runs[0].user_id)
+    add_user_contributed_to_feed(user, project_public)
+    _queue = scheduler == 'depth_first_queue'
+    if _queue:
+        for task_run in task_runs:
+            user_param, uid = sched.get_user_param(task_run.user_id,
+                                                   task_run.user_ip,
+                                                   task_run.external_uid)
+            redis_task_queue.mark_seen(project_id, task_run.task_id,
+                                       user_param, uid, sentinel.master)
+    if results:
+        update_feed('TaskCompleted', project_id=project_id)
+    for task_id in sorted(results):
+        if _queue:
+            redis_task_queue.remove(project_id, task_id, sentinel.master)
         project_private = dict()
         project_private.update(project_public)
         project_private['webhook'] = _webhook
-        push_webhook(project_private, target.task_id, result_id)
+        push_webhook(project_private, task_id, results[task_id])
+    return results
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def on_taskrun_submit(mapper, conn, target):
+    """Update the task.state when n_answers condition is met."""
+    after_task_runs_submit(conn, target.project_id, [target])
 
 
 @event.listens_for(Blogpost, 'after_insert')
 @event.listens_for(Blogpost, 'after_update')
 @event.listens_for(Task, 'after_insert')
 @event.listens_for(Task, 'after_update')
-@event.listens_for(TaskRun, 'after_insert')
 @event.listens_for(TaskRun, 'after_update')
 def update_project(mapper, conn, target):
     """Update project updated timestamp."""
@@ -296,12 +359,24 @@ def delete_task_counter(mapper, conn, target):
     conn.execute(sql_query)
 
 
-@event.listens_for(TaskRun, 'after_insert')
-def increase_task_counter(mapper, conn, target):
-    sql_query = ("insert into counter(created, project_id, task_id, n_task_runs) \
-                 VALUES (TIMESTAMP '%s', %s, %s, 1)"
-                 % (make_timestamp(), target.project_id, target.task_id))
-    conn.execute(sql_query)
+@event.listens_for(Task, 'after_update')
+def update_task_queue(mapper, conn, target):
+    """Keep the Redis task queue of the project in sync with the task."""
+    if not uses_task_queue(conn, target.project_id):
+        return
+    if target.state == 'completed':
+        redis_task_queue.remove(target.project_id, target.id, sentinel.master)
+    else:
+        redis_task_queue.push(target.project_id, target.id, target.priority_0,
+                              sentinel.master)
+
+
+@event.listens_for(Task, 'after_delete')
+def delete_task_from_queue(mapper, conn, target):
+    """Remove the task from the Redis task queue of the project."""
+    if not uses_task_queue(conn, target.project_id):
+        return
+    redis_task_queue.remove(target.project_id, target.id, sentinel.master)
 
 
 @event.listens_for(TaskRun, 'after_delete')
@@ -310,3 +385,7 @@ def decrease_task_counter(mapper, conn, target):
                  VALUES (TIMESTAMP '%s', %s, %s, -1)"
                  % (make_timestamp(), target.project_id, target.task_id))
     conn.execute(sql_query)
+    sentinel.master.sadd(DIRTY_COUNTERS_KEY, target.project_id)
+    sql_query = ("update task set n_task_runs=greatest(n_task_runs - 1, 0) \
+                 where id=%s" % target.task_id)
+    conn.execute(sql_query)
@@ -16,8 +16,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import json
 from sqlalchemy import Integer, Boolean, Float, UnicodeText, Text
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.schema import Column, ForeignKey, Index
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 from sqlalchemy.ext.mutable import MutableList
@@ -26,12 +28,20 @@ from pybossa.model import DomainObject, make_timestamp
 from pybossa.model.task_run import TaskRun
 
 
+def hash_info(info):
+    """Return the digest of the canonical JSON of a task info."""
+    canonical = json.dumps(info, sort_keys=True, separators=(',', ':'))
+    return hashlib.md5(canonical).hexdigest()
+
+
 class Task(db.Model, DomainObject):
     '''An individual Task which can be performed by a user. A Task is
     associated to a project.
     '''
     __tablename__ = 'task'
-
+    __table_args__ = (Index('task_project_id_info_hash_idx', 'project_id',
+                            'info_hash'),
+                      Index('task_project_id_id_idx', 'project_id', 'id'))
 
     #: Task.ID
     id = Column(Integer, primary_key=True)
@@ -48,8 +58,12 @@ class Task(db.Model, DomainObject):
     priority_0 = Column(Float, default=0)
     #: Task.info field in JSON with the data for the task.
     info = Column(JSONB)
+    #: Digest of the info field, used to find duplicated tasks.
+    info_hash = Column(Text)
     #: Number of answers to collect for this task.
     n_answers = Column(Integer, default=30)
+    #: Number of task runs submitted for this task.
+    n_task_runs = Column(Integer, default=0, nullable=False)
     #: Array of User IDs that favorited this task
     fav_user_ids = Column(MutableList.as_mutable(ARRAY(Integer)))
 
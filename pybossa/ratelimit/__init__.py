@@ -20,19 +20,61 @@
 Rate limit module for limiting the requests in the API.
 
 This module exports:
-    * RateLimit class: for limiting the requests
+    * RateLimit class: for limiting the requests in fixed windows
+    * GCRARateLimit class: for limiting the requests with GCRA
     * ratelimit decorator: for decorating the views
 
+The class used by the decorator is chosen with RATELIMIT_BACKEND, 'fixed'
+or 'gcra'.
+
 """
+import math
+import threading
 import time
 from functools import update_wrapper, wraps
 from flask import request, g
 from werkzeug.exceptions import TooManyRequests
-from pybossa.core import sentinel, anonymizer
+from pybossa.core import sentinel, anonymizer, ratelimits
 from pybossa.error import ErrorStatus
 
 error = ErrorStatus()
 
+# Takes up to ARGV[4] requests from the ones allowed to the client.
+# KEYS[1]: theoretical arrival time (TAT) of the client. ARGV[1]: now,
+# ARGV[2]: time between requests, ARGV[3]: burst tolerance, all of them in
+# milliseconds. Returns the requests granted, the requests left and the TAT.
+GCRA_LUA = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+local wanted = tonumber(ARGV[4])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local available = math.floor((now + tolerance - tat) / interval)
+local granted = math.max(math.min(wanted, available), 0)
+if granted > 0 then
+    tat = tat + granted * interval
+    redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil(tat - now))
+end
+return {granted, math.max(available - granted, 0), math.ceil(tat)}
+"""
+
+LEASE_MAX_KEYS = 10000
+
+_leases = dict()
+_leases_lock = threading.Lock()
+_scripts = dict()
+
+
+def get_gcra_script(conn):
+    """Return the GCRA script registered once per connection."""
+    script = _scripts.get(conn)
+    if script is None:
+        script = _scripts[conn] = conn.register_script(GCRA_LUA)
+    return script
+
 
 class RateLimit(object):
 
@@ -63,6 +105,86 @@ class RateLimit(object):
     over_limit = property(lambda x: x.current >= x.limit)
 
 
+class GCRARateLimit(object):
+
+    """
+    Limit the number of requests with the generic cell rate algorithm.
+
+    A client gets a new request every per / limit seconds and can burst up to
+    limit requests. Requests are spread evenly instead of being reset at the
+    end of a window, but a client idle long enough to burst can still send
+    close to twice the limit within per seconds: the burst plus the steady
+    rate. Every check is a single EVALSHA on the master.
+
+    With a lease, the worker takes up to lease requests at once and serves
+    the rest from memory until they are used or the lease expires, saving
+    round trips for the clients sending many requests.
+
+    """
+
+    def __init__(self, key_prefix, limit, per, send_x_headers, lease=0):
+        self.key = key_prefix + 'gcra'
+        self.limit = limit
+        self.per = per
+        self.send_x_headers = send_x_headers
+        self.lease = lease
+        now = time.time()
+        if not self._take_leased(now):
+            self._take(now)
+
+    over_limit = property(lambda x: not x.granted)
+
+    def _take(self, now):
+        interval = 1000.0 * self.per / self.limit
+        script = get_gcra_script(sentinel.master)
+        args = [int(now * 1000), repr(interval), 1000 * self.per,
+                max(self.lease, 1)]
+        granted, remaining, tat = script(keys=[self.key], args=args)
+        self.granted = granted > 0
+        self.remaining = remaining + max(granted - 1, 0)
+        self.reset = int(math.ceil(tat / 1000.0))
+        if granted > 1:
+            lease = dict(tokens=granted - 1, remaining=remaining,
+                         reset=self.reset,
+                         expires=now + (granted - 1) * interval / 1000.0)
+            with _leases_lock:
+                if len(_leases) >= LEASE_MAX_KEYS:
+                    _drop_expired_leases(now)
+                _leases[self.key] = lease
+
+    def _take_leased(self, now):
+        if self.lease <= 1:
+            return False
+        with _leases_lock:
+            lease = _leases.get(self.key)
+            if lease is None:
+                return False
+            if lease['expires'] < now or lease['tokens'] <= 0:
+                del _leases[self.key]
+                return False
+            lease['tokens'] -= 1
+            self.granted = True
+            self.remaining = lease['remaining'] + lease['tokens']
+            self.reset = lease['reset']
+            return True
+
+
+def _drop_expired_leases(now):
+    for key in [key for key, lease in _leases.iteritems()
+                if lease['expires'] < now or lease['tokens'] <= 0]:
+        del _leases[key]
+    if len(_leases) >= LEASE_MAX_KEYS:
+        _leases.clear()
+
+
+def get_rate_limit(key_prefix, limit, per, send_x_headers):
+    """Return the rate limit of the configured backend."""
+    if ratelimits.get('BACKEND') == 'gcra':
+        return GCRARateLimit(key_prefix, limit, per, send_x_headers,
+                             lease=ratelimits.get('LEASE') or 0)
+    return RateLimit(key_prefix, limit, per, send_x_headers)
+
+
 def get_view_rate_limit():
     """Return the rate limit values."""
     return getattr(g, '_view_rate_limit', None)
@@ -83,7 +205,7 @@ def ratelimit(limit, per, send_x_headers=True,
         def rate_limited(*args, **kwargs):
             try:
                 key = 'rate-limit/%s/%s/' % (key_func(), scope_func())
-                rlimit = RateLimit(key, limit, per, send_x_headers)
+                rlimit = get_rate_limit(key, limit, per, send_x_headers)
                 g._view_rate_limit = rlimit
                 # if over_limit is not None and rlimit.over_limit:
                 if rlimit.over_limit:
@@ -17,36 +17,88 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
 from time import time
-from datetime import timedelta
 
 
 ACTIVE_USER_KEY = 'pybossa:active_users_in_project:{}'
 
+# Drops the expired users and returns how many are left.
+# KEYS[1]: active users hash. ARGV[1]: now.
+ACTIVE_USER_COUNT_LUA = """
+local now = tonumber(ARGV[1])
+local users = redis.call('HGETALL', KEYS[1])
+for i = 1, #users, 2 do
+    if tonumber(users[i + 1]) < now then
+        redis.call('HDEL', KEYS[1], users[i])
+    end
+end
+return redis.call('HLEN', KEYS[1])
+"""
+
+# Tries to lock the resources in order until `count` locks are held.
+# KEYS: resources. ARGV[1]: client id, ARGV[2]: now, ARGV[3]: expiration,
+# ARGV[4]: duration, ARGV[5]: count, ARGV[6..]: limit of each resource.
+# Returns the (1-based) indexes of the resources locked by the client.
+ACQUIRE_LOCKS_LUA = """
+local client_id = ARGV[1]
+local now = tonumber(ARGV[2])
+local count = tonumber(ARGV[5])
+local acquired = {}
+for k = 1, #KEYS do
+    local key = KEYS[k]
+    local locks = redis.call('HGETALL', key)
+    for i = 1, #locks, 2 do
+        if now > tonumber(locks[i + 1]) then
+            redis.call('HDEL', key, locks[i])
+        end
+    end
+    if redis.call('HEXISTS', key, client_id) == 1 then
+        table.insert(acquired, k)
+    elseif redis.call('HLEN', key) < tonumber(ARGV[5 + k]) then
+        redis.call('HSET', key, client_id, ARGV[3])
+        redis.call('EXPIRE', key, ARGV[4])
+        table.insert(acquired, k)
+    end
+    if #acquired >= count then
+        break
+    end
+end
+return acquired
+"""
+
+_scripts = dict()
+
+
+def _get_script(conn, lua):
+    """Return a script registered once per connection."""
+    script = _scripts.get((conn, lua))
+    if script is None:
+        script = _scripts[(conn, lua)] = conn.register_script(lua)
+    return script
+
 
 def get_active_user_key(project_id):
     return ACTIVE_USER_KEY.format(project_id)
 
 
 def get_active_user_count(project_id, conn):
-    now = time()
     key = get_active_user_key(project_id)
-    to_delete = [user for user, expiration in conn.hgetall(key).iteritems()
-                 if float(expiration) < now]
-    if to_delete:
-        conn.hdel(key, *to_delete)
-    return conn.hlen(key)
+    script = _get_script(conn, ACTIVE_USER_COUNT_LUA)
+    return script(keys=[key], args=[repr(time())])
 
 
 def register_active_user(project_id, user_id, conn, ttl=2*60*60):
     now = time()
     key = get_active_user_key(project_id)
-    conn.hset(key, user_id, now + ttl)
-    conn.expire(key, ttl)
+    pipeline = conn.pipeline(transaction=False)
+    pipeline.hset(key, user_id, now + ttl)
+    pipeline.expire(key, ttl)
+    pipeline.execute()
 
 
 class LockManager(object):
     """
-    Class to manage resource locks
+    Class to manage resource locks. Every operation is a single round trip
+    to Redis, acquiring locks is done atomically with a Lua script.
     :param cache: a Redis connection
     :param duration: how long a lock is valid after being acquired
         if not released (in seconds)
@@ -55,7 +107,7 @@ class LockManager(object):
         self._redis = cache
         self._duration = duration
 
-    def acquire_lock(self, resource_id, client_id, limit, pipeline=None):
+    def acquire_lock(self, resource_id, client_id, limit):
         """
         Acquire a lock on a resource.
         :param resource_id: resource on which lock is needed
@@ -63,18 +115,27 @@ class LockManager(object):
         :param limit: how many clients can access the resource concurrently
         :return: True if lock was successfully acquired, else False
         """
+        return bool(self.acquire_locks([resource_id], client_id, [limit]))
+
+    def acquire_locks(self, resource_ids, client_id, limits, count=1):
+        """
+        Try to acquire the locks on several resources, in order, until
+        count locks are held by the client.
+        :param resource_ids: resources on which a lock is needed
+        :param client_id: id of client needing the lock
+        :param limits: how many clients can access each resource concurrently
+        :param count: how many locks are needed
+        :return: list of the resources locked by the client
+        """
+        if not resource_ids:
+            return []
         timestamp = time()
         expiration = timestamp + self._duration
-        self._release_expired_locks(resource_id, timestamp)
-        if self._redis.hexists(resource_id, client_id):
-            return True
-        num_acquired = self._redis.hlen(resource_id)
-        if num_acquired < limit:
-            cache = pipeline or self._redis
-            cache.hset(resource_id, client_id, expiration)
-            cache.expire(resource_id, timedelta(seconds=self._duration))
-            return True
-        return False
+        args = [client_id, repr(timestamp), repr(expiration),
+                int(self._duration), count] + list(limits)
+        script = _get_script(self._redis, ACQUIRE_LOCKS_LUA)
+        acquired = script(keys=resource_ids, args=args)
+        return [resource_ids[index - 1] for index in acquired]
 
     def has_lock(self, resource_id, client_id):
         """
@@ -83,14 +144,50 @@ class LockManager(object):
         :return: True if client id holds a lock on the resource,
         False otherwise
         """
-        exists = self._redis.hexists(resource_id, client_id)
-        if not exists:
-            return False
         time_str = self._redis.hget(resource_id, client_id)
+        if time_str is None:
+            return False
         expiration = float(time_str)
         now = time()
         return expiration > now
 
+    def has_locks(self, resource_ids, client_id):
+        """
+        :param resource_ids: resources on which locks are being held
+        :param client_id: client id
+        :return: list of the resources on which the client holds a lock,
+        read in a single round trip to Redis
+        """
+        pipeline = self._redis.pipeline(transaction=False)
+        for resource_id in resource_ids:
+            pipeline.hget(resource_id, client_id)
+        now = time()
+        return [resource_id for resource_id, time_str
+                in zip(resource_ids, pipeline.execute())
+                if time_str is not None and float(time_str) > now]
+
+    def get_available(self, resource_ids, client_id, limits):
+        """
+        :param resource_ids: resources to check
+        :param client_id: client id
+        :param limits: how many clients can access each resource concurrently
+        :return: list of the resources on which the client holds a lock or
+        could acquire one, read in a single round trip to Redis without
+        acquiring any
+        """
+        pipeline = self._redis.pipeline(transaction=False)
+        for resource_id in resource_ids:
+            pipeline.hgetall(resource_id)
+        now = time()
+        available = []
+        for resource_id, limit, locks in zip(resource_ids, limits,
+                                             pipeline.execute()):
+            live = [client for client, time_str in locks.items()
+                    if float(time_str) > now]
+            if str(client_id) in live or len(live) < limit:
+                available.append(resource_id)
+        return available
+
     def release_lock(self, resource_id, client_id, pipeline=None):
         """
         Release a lock. Note that the lock is not release immediately, rather
@@ -110,13 +207,3 @@ class LockManager(object):
         :param resource_id: resource on which lock is being held
         """
         return self._redis.hgetall(resource_id)
-
-    def _release_expired_locks(self, resource_id, now):
-        locks = self.get_locks(resource_id)
-        to_delete = []
-        for key, expiration in locks.iteritems():
-            expiration = float(expiration)
-            if now > expiration:
-                to_delete.append(key)
-        if to_delete:
-            self._redis.hdel(resource_id, *to_delete)
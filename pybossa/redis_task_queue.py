@@ -0,0 +1,330 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Redis backed ready queue of tasks for the depth first queue scheduler.
+
+For every project using the scheduler it keeps:
+    * a sorted set with the ids of the incomplete tasks, ordered by
+      priority_0 DESC, id ASC.
+    * a hash with a dense index (1, 2, ...) for every task of the project,
+      so the bitmaps are sized by the number of tasks of the project and not
+      by the span of their ids.
+    * a hash with the metadata of the queue: its generation, which changes on
+      every rebuild, and the size of the index.
+    * one bitmap per contributor with the indexes of the tasks the
+      contributor has already answered. Bit 0 flags that the bitmap has been
+      loaded from the DB.
+
+The queue is a cache: PostgreSQL is the source of truth and `rebuild`
+recreates it from scratch. The tasks pushed while a rebuild is reading the
+DB are recorded apart and merged into the new queue.
+"""
+from uuid import uuid4
+
+from sqlalchemy import text
+
+
+READY_KEY = 'pybossa:sched:queue:ready:{0}'
+INDEX_KEY = 'pybossa:sched:queue:index:{0}'
+META_KEY = 'pybossa:sched:queue:meta:{0}'
+SEEN_KEY = 'pybossa:sched:queue:seen:{0}:{1}:{2}:{3}'
+REBUILD_KEY = 'pybossa:sched:queue:rebuild:{0}'
+REBUILDING_KEY = 'pybossa:sched:queue:rebuilding:{0}'
+PUSHED_KEY = 'pybossa:sched:queue:pushed:{0}'
+QUEUE_TTL = 24 * 60 * 60
+SEEN_TTL = 2 * 60 * 60
+CHUNK_SIZE = 100
+BATCH_SIZE = 1000
+
+# Adds tasks to the queue if it exists, giving an index to the new ones, and
+# records them if the queue is being rebuilt.
+# KEYS: ready, index, meta, rebuilding, pushed. ARGV[1]: ttl of the pushed
+# tasks, ARGV[2..]: score and member of every task.
+PUSH_LUA = """
+local pushed = 0
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    for i = 2, #ARGV, 2 do
+        redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+        if redis.call('HEXISTS', KEYS[2], ARGV[i + 1]) == 0 then
+            local index = redis.call('HINCRBY', KEYS[3], 'size', 1)
+            redis.call('HSET', KEYS[2], ARGV[i + 1], index)
+        end
+    end
+    local ttl = redis.call('TTL', KEYS[3])
+    if ttl > 0 then
+        redis.call('EXPIRE', KEYS[1], ttl)
+        redis.call('EXPIRE', KEYS[2], ttl)
+    end
+    pushed = 1
+end
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    for i = 2, #ARGV, 2 do
+        redis.call('ZADD', KEYS[5], ARGV[i], ARGV[i + 1])
+    end
+    redis.call('EXPIRE', KEYS[5], ARGV[1])
+    pushed = 1
+end
+return pushed
+"""
+
+# Merges the tasks pushed during a rebuild into the new queue and replaces
+# the old one with it. Returns the size of the queue.
+# KEYS: new ready, new index, ready, index, meta, rebuilding, pushed.
+# ARGV[1]: generation, ARGV[2]: size of the new index, ARGV[3]: ttl.
+FINISH_REBUILD_LUA = """
+local size = tonumber(ARGV[2])
+local pushed = redis.call('ZRANGE', KEYS[7], 0, -1, 'WITHSCORES')
+for i = 1, #pushed, 2 do
+    redis.call('ZADD', KEYS[1], pushed[i + 1], pushed[i])
+    if redis.call('HEXISTS', KEYS[2], pushed[i]) == 0 then
+        size = size + 1
+        redis.call('HSET', KEYS[2], pushed[i], size)
+    end
+end
+redis.call('DEL', KEYS[3], KEYS[4], KEYS[5], KEYS[6], KEYS[7])
+for i = 1, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], KEYS[i + 2])
+        redis.call('EXPIRE', KEYS[i + 2], ARGV[3])
+    end
+end
+redis.call('HMSET', KEYS[5], 'generation', ARGV[1], 'size', size)
+redis.call('EXPIRE', KEYS[5], ARGV[3])
+return redis.call('ZCARD', KEYS[3])
+"""
+
+# Returns up to ARGV[1] tasks of the queue not answered by a contributor,
+# after skipping ARGV[2] of them, scanning ARGV[3] tasks at a time.
+# KEYS: ready, index, seen.
+NEXT_TASKS_LUA = """
+local limit = tonumber(ARGV[1])
+local offset = tonumber(ARGV[2])
+local chunk = tonumber(ARGV[3])
+local tasks = {}
+local start = 0
+while #tasks < limit do
+    local members = redis.call('ZRANGE', KEYS[1], start, start + chunk - 1)
+    if #members == 0 then
+        break
+    end
+    start = start + #members
+    local indexes = redis.call('HMGET', KEYS[2], unpack(members))
+    for i = 1, #members do
+        local seen = 0
+        if indexes[i] then
+            seen = redis.call('GETBIT', KEYS[3], indexes[i])
+        end
+        if seen == 0 then
+            if offset > 0 then
+                offset = offset - 1
+            else
+                table.insert(tasks, members[i])
+                if #tasks == limit then
+                    break
+                end
+            end
+        end
+    end
+end
+return tasks
+"""
+
+_scripts = dict()
+
+
+def _get_script(conn, lua):
+    """Return a script registered once per connection."""
+    script = _scripts.get((conn, lua))
+    if script is None:
+        script = _scripts[(conn, lua)] = conn.register_script(lua)
+    return script
+
+
+def get_ready_key(project_id):
+    return READY_KEY.format(project_id)
+
+
+def get_index_key(project_id):
+    return INDEX_KEY.format(project_id)
+
+
+def get_meta_key(project_id):
+    return META_KEY.format(project_id)
+
+
+def get_seen_key(project_id, generation, user_param, uid):
+    return SEEN_KEY.format(project_id, generation, user_param, uid)
+
+
+def _member(task_id):
+    # Zero padded so members with the same score are sorted by id
+    return '%012d' % task_id
+
+
+def _score(priority_0):
+    # ZRANGE is ascending, store the priority negated
+    return -float(priority_0 or 0)
+
+
+def exists(project_id, conn):
+    """Return True if the queue of the project has been built."""
+    return bool(conn.exists(get_meta_key(project_id)))
+
+
+def rebuild(project_id, conn, session, ttl=QUEUE_TTL):
+    """Rebuild the queue of a project from the DB and return its size."""
+    ready_key = get_ready_key(project_id)
+    index_key = get_index_key(project_id)
+    tmp_ready_key = ready_key + ':tmp'
+    tmp_index_key = index_key + ':tmp'
+    rebuilding_key = REBUILDING_KEY.format(project_id)
+    pushed_key = PUSHED_KEY.format(project_id)
+    pipeline = conn.pipeline()
+    pipeline.delete(tmp_ready_key, tmp_index_key, pushed_key)
+    pipeline.set(rebuilding_key, 1, ex=ttl)
+    pipeline.execute()
+    sql = text('''SELECT id, priority_0, state FROM task
+               WHERE project_id=:project_id ORDER BY id;''')
+    rows = session.execute(sql, dict(project_id=project_id))
+    size = 0
+    pipeline = conn.pipeline(transaction=False)
+    for row in rows:
+        size += 1
+        pipeline.hset(tmp_index_key, _member(row.id), size)
+        if row.state != 'completed':
+            pipeline.zadd(tmp_ready_key, _score(row.priority_0),
+                          _member(row.id))
+        if size % BATCH_SIZE == 0:
+            pipeline.execute()
+    pipeline.execute()
+    rows.close()
+    keys = [tmp_ready_key, tmp_index_key, ready_key, index_key,
+            get_meta_key(project_id), rebuilding_key, pushed_key]
+    finish = _get_script(conn, FINISH_REBUILD_LUA)
+    return finish(keys=keys, args=[uuid4().hex, size, ttl])
+
+
+def request_rebuild(project_id, conn, ttl=5 * 60):
+    """Return True if the caller is the one that has to rebuild the queue.
+
+    It avoids several workers rebuilding the same queue at the same time.
+    """
+    return bool(conn.set(REBUILD_KEY.format(project_id), 1, ex=ttl, nx=True))
+
+
+def _push(project_id, tasks, conn, ttl=QUEUE_TTL):
+    keys = [get_ready_key(project_id), get_index_key(project_id),
+            get_meta_key(project_id), REBUILDING_KEY.format(project_id),
+            PUSHED_KEY.format(project_id)]
+    args = [ttl]
+    for task_id, priority_0 in tasks:
+        args.extend([_score(priority_0), _member(task_id)])
+    return bool(_get_script(conn, PUSH_LUA)(keys=keys, args=args))
+
+
+def push(project_id, task_id, priority_0, conn):
+    """Add a task to the queue if it exists or is being rebuilt."""
+    return _push(project_id, [(task_id, priority_0)], conn)
+
+
+def push_many(project_id, tasks, conn):
+    """Add a list of (task_id, priority_0) to the queue if it exists or is
+    being rebuilt."""
+    pushed = False
+    for i in range(0, len(tasks), BATCH_SIZE):
+        pushed = _push(project_id, tasks[i:i + BATCH_SIZE], conn) or pushed
+    return pushed
+
+
+def remove(project_id, task_id, conn):
+    """Remove a task from the queue.
+
+    Its index is kept, as the task can be pushed again.
+    """
+    return bool(conn.zrem(get_ready_key(project_id), _member(task_id)))
+
+
+def _get_generation(project_id, conn):
+    return conn.hget(get_meta_key(project_id), 'generation')
+
+
+def mark_seen(project_id, task_id, user_param, uid, conn):
+    """Flag a task as answered in the bitmap of the contributor.
+
+    It is only updated if the bitmap has already been loaded, as otherwise it
+    will be fully loaded from the DB the next time it is needed.
+    """
+    generation = _get_generation(project_id, conn)
+    if generation is None:
+        return False
+    index = conn.hget(get_index_key(project_id), _member(task_id))
+    if index is None:
+        return False
+    key = get_seen_key(project_id, generation, user_param, uid)
+    if not conn.getbit(key, 0):
+        return False
+    conn.setbit(key, int(index), 1)
+    return True
+
+
+def _load_seen(project_id, generation, user_param, uid, conn, session,
+               ttl=SEEN_TTL):
+    key = get_seen_key(project_id, generation, user_param, uid)
+    if conn.getbit(key, 0):
+        conn.expire(key, ttl)
+        return key
+    sql = text('''SELECT task_id FROM task_run
+               WHERE project_id=:project_id AND {}=:uid;'''.format(user_param))
+    rows = session.execute(sql, dict(project_id=project_id, uid=uid))
+    members = [_member(row.task_id) for row in rows]
+    index_key = get_index_key(project_id)
+    pipeline = conn.pipeline(transaction=False)
+    for i in range(0, len(members), BATCH_SIZE):
+        for index in conn.hmget(index_key, members[i:i + BATCH_SIZE]):
+            if index is not None:
+                pipeline.setbit(key, int(index), 1)
+        pipeline.execute()
+    pipeline.setbit(key, 0, 1)
+    pipeline.expire(key, ttl)
+    pipeline.execute()
+    return key
+
+
+def get_task_ids(project_id, user_param, uid, conn, session, limit=1,
+                 offset=0):
+    """Return the ids of the next tasks for a contributor.
+
+    The queue is scanned and filtered by Redis in a single call. Returns
+    None if the queue of the project has not been built yet.
+    """
+    generation = _get_generation(project_id, conn)
+    if generation is None:
+        return None
+    seen_key = _load_seen(project_id, generation, user_param, uid, conn,
+                          session)
+    ready_key = get_ready_key(project_id)
+    index_key = get_index_key(project_id)
+    next_tasks = _get_script(conn, NEXT_TASKS_LUA)
+    members = next_tasks(keys=[ready_key, index_key, seen_key],
+                         args=[limit, offset, CHUNK_SIZE])
+    pipeline = conn.pipeline(transaction=False)
+    pipeline.expire(ready_key, QUEUE_TTL)
+    pipeline.expire(index_key, QUEUE_TTL)
+    pipeline.expire(get_meta_key(project_id), QUEUE_TTL)
+    pipeline.execute()
+    return [int(member) for member in members]
@@ -52,6 +52,9 @@ from sqlalchemy.types import TIMESTAMP
 from sqlalchemy.orm.base import _entity_descriptor
 
 
+# Rows fetched per round trip when iterating over yielded queries
+YIELD_PER = 1000
+
 class Repository(object):
 
     def __init__(self, db, language='english'):
@@ -227,9 +230,11 @@ class Repository(object):
 
     def _filter_by(self, model, limit=None, offset=0, yielded=False,
                    last_id=None, fulltextsearch=None, desc=False,
-                   orderby='id', **filters):
+                   orderby='id', max_id=None, **filters):
         """Filter by using several arguments and ordering items."""
         query = self.create_context(filters, fulltextsearch, model)
+        if max_id is not None:
+            query = query.filter(model.id <= max_id)
         if last_id:
             query = query.filter(model.id > last_id)
             query = self._set_orderby_desc(query, model, limit,
@@ -238,8 +243,7 @@ class Repository(object):
             query = self._set_orderby_desc(query, model, limit,
                                            last_id, offset, desc, orderby)
         if yielded:
-            limit = limit or 1
-            return query.yield_per(limit)
+            return query.yield_per(min(limit or YIELD_PER, YIELD_PER))
         return query.all()
 
 
@@ -34,7 +34,8 @@ class ResultRepository(Repository):
         return self.db.session.query(Result).filter_by(**attributes).first()
 
     def filter_by(self, limit=None, offset=0, yielded=False,
-                  last_id=None, fulltextsearch=None, desc=False, **filters):
+                  last_id=None, fulltextsearch=None, desc=False,
+                  max_id=None, **filters):
         if 'last_version' not in filters.keys():
             filters['last_version'] = True
         if filters['last_version'] is False:
@@ -43,7 +44,15 @@ class ResultRepository(Repository):
         return self._filter_by(Result, limit, offset,
                               yielded, last_id,
                               fulltextsearch,
-                              desc, **filters)
+                              desc, max_id=max_id, **filters)
+
+    def filter_by_task_ids(self, task_ids):
+        if not task_ids:
+            return []
+        return self.db.session.query(Result)\
+                   .filter(Result.task_id.in_(set(task_ids)),
+                           Result.last_version==True)\
+                   .order_by(Result.id).all()
 
     def update(self, result):
         self._validate_can_be('updated', result)
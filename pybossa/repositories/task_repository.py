@@ -20,11 +20,12 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy import cast, Date
 
 from pybossa.repositories import Repository
-from pybossa.model.task import Task
+from pybossa.model.task import Task, hash_info
 from pybossa.model.task_run import TaskRun
 from pybossa.exc import WrongObjectError, DBIntegrityError
 from pybossa.cache import projects as cached_projects
 from pybossa.core import uploader
+from pybossa.model import make_timestamp
 from sqlalchemy import text
 
 
@@ -34,6 +35,19 @@ class TaskRepository(Repository):
     def get_task(self, id):
         return self.db.session.query(Task).get(id)
 
+    def get_tasks(self, project_id, task_ids):
+        if not task_ids:
+            return []
+        return self.db.session.query(Task)\
+                   .filter(Task.project_id==project_id,
+                           Task.id.in_(set(task_ids))).all()
+
+    def filter_tasks_by_ids(self, task_ids):
+        if not task_ids:
+            return []
+        return self.db.session.query(Task)\
+                   .filter(Task.id.in_(set(task_ids))).all()
+
     def get_task_by(self, **attributes):
         filters, _, _, _ = self.generate_query_from_keywords(Task, **attributes)
         # print self.db.session.query(Task).filter(*filters)
@@ -41,10 +55,10 @@ class TaskRepository(Repository):
 
     def filter_tasks_by(self, limit=None, offset=0, yielded=False,
                         last_id=None, fulltextsearch=None, desc=False,
-                        **filters):
+                        max_id=None, **filters):
 
         return self._filter_by(Task, limit, offset, yielded, last_id,
-                              fulltextsearch, desc, **filters)
+                              fulltextsearch, desc, max_id=max_id, **filters)
 
     def count_tasks_with(self, **filters):
         query_args, _, _, _  = self.generate_query_from_keywords(Task, **filters)
@@ -85,16 +99,36 @@ class TaskRepository(Repository):
 
     def filter_task_runs_by(self, limit=None, offset=0, last_id=None,
                             yielded=False, fulltextsearch=None,
-                            desc=False, **filters):
+                            desc=False, max_id=None, **filters):
         return self._filter_by(TaskRun, limit, offset, yielded, last_id,
-                              fulltextsearch, desc, **filters)
+                              fulltextsearch, desc, max_id=max_id, **filters)
+
 
+    def filter_task_runs_by_task_ids(self, task_ids):
+        if not task_ids:
+            return []
+        return self.db.session.query(TaskRun)\
+                   .filter(TaskRun.task_id.in_(set(task_ids)))\
+                   .order_by(TaskRun.id).all()
 
     def count_task_runs_with(self, **filters):
         query_args, _, _, _ = self.generate_query_from_keywords(TaskRun, **filters)
         return self.db.session.query(TaskRun).filter(*query_args).count()
 
 
+    def get_answered_task_ids(self, project_id, task_ids, user_id=None,
+                              user_ip=None, external_uid=None):
+        """Return the ids of the tasks already answered by a contributor."""
+        if not task_ids:
+            return set()
+        query = self.db.session.query(TaskRun.task_id)\
+                    .filter(TaskRun.project_id==project_id,
+                            TaskRun.task_id.in_(set(task_ids)),
+                            TaskRun.user_id==user_id,
+                            TaskRun.user_ip==user_ip,
+                            TaskRun.external_uid==external_uid)
+        return set(row.task_id for row in query)
+
     # Methods for saving, deleting and updating both Task and TaskRun objects
     def save(self, element):
         self._validate_can_be('saved', element)
@@ -106,6 +140,101 @@ class TaskRepository(Repository):
             self.db.session.rollback()
             raise DBIntegrityError(e)
 
+    def save_task_runs(self, project_id, task_runs):
+        """Insert task runs of one contributor in a single transaction.
+
+        There can only be one task run per task. The bookkeeping of the
+        after_insert listeners is done once for the whole set. Returns the
+        ids of the results created by task id.
+        """
+        from pybossa.model.event_listeners import after_task_runs_submit
+        for task_run in task_runs:
+            self._validate_can_be('saved', task_run)
+        if not task_runs:
+            return {}
+        now = make_timestamp()
+        columns = [c.name for c in TaskRun.__table__.columns if c.name != 'id']
+        rows = []
+        for task_run in task_runs:
+            task_run.created = task_run.created or now
+            task_run.finish_time = task_run.finish_time or now
+            rows.append(dict((c, getattr(task_run, c)) for c in columns))
+        try:
+            conn = self.db.session.connection()
+            table = TaskRun.__table__
+            stmt = table.insert().values(rows)\
+                        .returning(table.c.id, table.c.task_id)
+            ids = dict((row.task_id, row.id) for row in conn.execute(stmt))
+            for task_run in task_runs:
+                task_run.id = ids[task_run.task_id]
+            results = after_task_runs_submit(conn, project_id, task_runs)
+            self.db.session.commit()
+            cached_projects.clean_project(project_id)
+            return results
+        except IntegrityError as e:
+            self.db.session.rollback()
+            raise DBIntegrityError(e)
+
+    def import_tasks(self, project_id, tasks, commit=True):
+        """Insert the tasks that are not already in the project.
+
+        Duplicates are found by the digest of their info with one query for
+        the whole set, and the new tasks are inserted with a single
+        statement. With commit=False the transaction is left open, so several
+        batches can be imported atomically. The caches of the project are
+        not flushed, so the caller can do it once when the import is done.
+        Returns the tasks inserted.
+        """
+        from pybossa.model.event_listeners import after_tasks_import
+        new_tasks = dict()
+        for task in tasks:
+            self._validate_can_be('saved', task)
+            task.project_id = project_id
+            task.info_hash = hash_info(task.info)
+            new_tasks.setdefault(task.info_hash, task)
+        if new_tasks:
+            sql = text('''SELECT info_hash FROM task
+                       WHERE project_id=:project_id
+                       AND info_hash=ANY(CAST(:hashes AS text[]));''')
+            found = self.db.session.execute(sql,
+                                            dict(project_id=project_id,
+                                                 hashes=new_tasks.keys()))
+            for row in found:
+                new_tasks.pop(row.info_hash, None)
+        tasks = [task for task in tasks
+                 if new_tasks.get(task.info_hash) is task]
+        now = make_timestamp()
+        table = Task.__table__
+        columns = [c for c in table.columns if c.name != 'id']
+        rows = []
+        for task in tasks:
+            task.created = task.created or now
+            row = dict()
+            for column in columns:
+                value = getattr(task, column.name)
+                if (value is None and column.default is not None and
+                        column.default.is_scalar):
+                    value = column.default.arg
+                    setattr(task, column.name, value)
+                row[column.name] = value
+            rows.append(row)
+        try:
+            if rows:
+                conn = self.db.session.connection()
+                stmt = table.insert().values(rows)\
+                            .returning(table.c.id, table.c.info_hash)
+                ids = dict((row.info_hash, row.id)
+                           for row in conn.execute(stmt))
+                for task in tasks:
+                    task.id = ids[task.info_hash]
+                after_tasks_import(conn, project_id, tasks)
+            if commit:
+                self.db.session.commit()
+            return tasks
+        except IntegrityError as e:
+            self.db.session.rollback()
+            raise DBIntegrityError(e)
+
     def update(self, element):
         self._validate_can_be('updated', element)
         try:
@@ -139,6 +268,7 @@ class TaskRepository(Repository):
     def delete_taskruns_from_project(self, project):
         sql = text('''
                    DELETE FROM task_run WHERE project_id=:project_id;
+                   UPDATE task SET n_task_runs=0 WHERE project_id=:project_id;
                    ''')
         self.db.session.execute(sql, dict(project_id=project.id))
         self.db.session.commit()
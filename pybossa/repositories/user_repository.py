@@ -16,13 +16,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy import or_, func
+from sqlalchemy import or_, func, inspect
 from sqlalchemy.exc import IntegrityError
 
 from pybossa.repositories import Repository
 from pybossa.model.user import User
 from pybossa.model.task_run import TaskRun
 from pybossa.exc import WrongObjectError, DBIntegrityError
+from pybossa.cache import users as cached_users
 from faker import Faker
 from yacryptopan import CryptoPAn
 from flask import current_app
@@ -75,12 +76,14 @@ class UserRepository(Repository):
 
     def update(self, new_user):
         self._validate_can_be('updated', new_user)
+        api_keys = self._get_api_keys(new_user)
         try:
             self.db.session.merge(new_user)
             self.db.session.commit()
         except IntegrityError as e:
             self.db.session.rollback()
             raise DBIntegrityError(e)
+        self._clean_api_keys(api_keys)
 
     def fake_user_id(self, user):
         faker = Faker()
@@ -94,6 +97,7 @@ class UserRepository(Repository):
 
     def delete(self, user):
         self._validate_can_be('deleted', user)
+        api_keys = self._get_api_keys(user)
         try:
             self.fake_user_id(user)
             self.db.session.delete(user)
@@ -101,6 +105,21 @@ class UserRepository(Repository):
         except IntegrityError as e:
             self.db.session.rollback()
             raise DBIntegrityError(e)
+        self._clean_api_keys(api_keys)
+
+    def _get_api_keys(self, user):
+        """Return the current and the previous API keys of the user."""
+        history = inspect(user).attrs.api_key.history
+        api_keys = set(history.added or ()) | set(history.deleted or ())
+        api_keys.add(user.api_key)
+        return api_keys
+
+    def _clean_api_keys(self, api_keys):
+        # Any change of the user, a new key or a restriction for instance,
+        # has to be seen by the requests authenticated with its API key
+        for api_key in api_keys:
+            if api_key:
+                cached_users.delete_user_by_api_key(api_key)
 
     def _validate_can_be(self, action, user):
         if not isinstance(user, User):
@@ -47,6 +47,25 @@ class WebhookRepository(Repository):
             self.db.session.rollback()
             raise DBIntegrityError(e)
 
+    def save_many(self, webhooks):
+        for webhook in webhooks:
+            self._validate_can_be('saved', webhook)
+        if not webhooks:
+            return
+        # bulk inserts do not fetch the new ids, so take them beforehand
+        sql = text('''
+                   SELECT nextval('webhook_id_seq') FROM generate_series(1, :n);
+                   ''')
+        try:
+            ids = self.db.session.execute(sql, dict(n=len(webhooks)))
+            for webhook, (webhook_id,) in zip(webhooks, ids):
+                webhook.id = webhook_id
+            self.db.session.bulk_save_objects(webhooks)
+            self.db.session.commit()
+        except IntegrityError as e:
+            self.db.session.rollback()
+            raise DBIntegrityError(e)
+
     def update(self, webhook):
         self._validate_can_be('updated', webhook)
         try:
@@ -23,11 +23,11 @@ from sqlalchemy import and_
 from pybossa.model import DomainObject
 from pybossa.model.task import Task
 from pybossa.model.task_run import TaskRun
-from pybossa.model.counter import Counter
 from pybossa.core import db, sentinel, project_repo
 from pybossa.contributions_guard import ContributionsGuard
 from pybossa.redis_lock import (LockManager, get_active_user_count,
-    register_active_user)
+    get_active_user_key, register_active_user)
+from pybossa import redis_task_queue
 import random
 
 from flask import current_app
@@ -48,11 +48,41 @@ def new_task(project_id, sched, user_id=None, user_ip=None,
         'depth_first': get_depth_first_task,
         'incremental': get_incremental_task,
         'depth_first_all': get_depth_first_all_task,
+        'depth_first_queue': get_depth_first_queue_task,
         'locked': get_locked_task}
     scheduler = sched_map.get(sched, sched_map['default'])
     return scheduler(project_id, user_id, user_ip, external_uid, offset=offset, limit=limit, orderby=orderby, desc=desc)
 
 
+def has_available_task(project_id, sched, user_id=None, user_ip=None,
+                       external_uid=None):
+    """Return True if the scheduler has a task the user has not answered.
+
+    Unlike new_task it is read only: it neither locks tasks nor registers
+    the user as active, so it can be used just to render a page. For the
+    locked scheduler a task is available only if it has a lock left.
+    """
+    if sched == 'locked':
+        user_param, uid = _get_locked_user_param(user_id, user_ip,
+                                                 external_uid)
+        limit = sentinel.master.hlen(get_active_user_key(project_id)) + 5
+        candidates = _get_locked_candidates(project_id, user_param, uid,
+                                            limit)
+        return bool(available_locks(candidates, uid, TIMEOUT))
+    user_param, uid = get_user_param(user_id, user_ip, external_uid)
+    state = ''
+    if sched != 'depth_first_all':
+        state = "AND task.state!='completed'"
+    sql = text('''
+           SELECT EXISTS (SELECT 1 FROM task WHERE NOT EXISTS
+           (SELECT 1 FROM task_run WHERE project_id=:project_id AND
+           {}=:uid AND task_id=task.id)
+           AND task.project_id=:project_id {});
+           '''.format(user_param, state))
+    return session.execute(sql, dict(project_id=project_id,
+                                     uid=uid)).scalar()
+
+
 def can_post(project_id, task_id, user_id_or_ip):
     scheduler = get_project_scheduler(project_id, session)
     if scheduler == 'locked':
@@ -66,8 +96,21 @@ def can_post(project_id, task_id, user_id_or_ip):
         return True
 
 
-def after_save(task_run, conn):
-    scheduler = get_project_scheduler(task_run.project_id, conn)
+def can_post_many(project_id, task_ids, user_id_or_ip):
+    """Return the ids of the tasks the user is allowed to answer."""
+    scheduler = get_project_scheduler(project_id, session)
+    if scheduler != 'locked':
+        return set(task_ids)
+    user_id = user_id_or_ip['user_id'] or \
+            user_id_or_ip['external_uid'] or \
+            user_id_or_ip['user_ip'] or \
+            '127.0.0.1'
+    return set(has_locks(task_ids, user_id, TIMEOUT))
+
+
+def after_save(task_run, conn, scheduler=None):
+    if scheduler is None:
+        scheduler = get_project_scheduler(task_run.project_id, conn)
     uid = task_run.user_id or \
           task_run.external_uid or \
           task_run.user_ip or \
@@ -95,12 +138,9 @@ def get_breadth_first_task(project_id, user_id=None, user_ip=None,
                                                                 external_uid=external_uid)
 
     tmp = project_query.except_(subquery)
-    query = session.query(Task, func.sum(Counter.n_task_runs).label('n_task_runs'))\
-                   .filter(Task.id==Counter.task_id)\
-                   .filter(Counter.task_id.in_(tmp))\
-                   .group_by(Task.id)\
-                   .order_by(text('n_task_runs ASC'))\
-
+    # task.n_task_runs is kept up to date by the task run listeners
+    query = session.query(Task).filter(Task.id.in_(tmp))\
+                   .order_by(Task.n_task_runs.asc())
     query = _set_orderby_desc(query, orderby, desc)
     data = query.limit(limit).offset(offset).all()
     return _handle_tuples(data)
@@ -126,6 +166,49 @@ def get_depth_first_all_task(project_id, user_id=None, user_ip=None,
     return tasks
 
 
+def get_depth_first_queue_task(project_id, user_id=None, user_ip=None,
+                               external_uid=None, offset=0, limit=1,
+                               orderby='priority_0', desc=True):
+    """Get a new task for a given project from its Redis task queue.
+
+    Tasks are always served by priority_0 DESC, id ASC. While the queue of
+    the project is being built, tasks are served from the DB.
+    """
+    user_param, uid = get_user_param(user_id, user_ip, external_uid)
+    while True:
+        task_ids = redis_task_queue.get_task_ids(project_id, user_param, uid,
+                                                 sentinel.master, session,
+                                                 limit=limit, offset=offset)
+        if task_ids is None:
+            schedule_task_queue_rebuild(project_id)
+            return get_candidate_task_ids(project_id, user_id, user_ip,
+                                          external_uid, limit, offset,
+                                          orderby='priority_0', desc=True)
+        if not task_ids:
+            return []
+        tasks = session.query(Task).filter(Task.id.in_(task_ids)).all()
+        tasks = dict((task.id, task) for task in tasks
+                     if task.state != 'completed')
+        stale = [task_id for task_id in task_ids if task_id not in tasks]
+        if not stale:
+            return [tasks[task_id] for task_id in task_ids]
+        # The queue is a cache, drop the tasks completed or deleted in the DB
+        for task_id in stale:
+            redis_task_queue.remove(project_id, task_id, sentinel.master)
+
+
+def schedule_task_queue_rebuild(project_id):
+    """Enqueue a job to build the Redis task queue of a project."""
+    from pybossa.jobs import enqueue_job, reconcile_task_queue
+    if redis_task_queue.request_rebuild(project_id, sentinel.master):
+        job = dict(name=reconcile_task_queue,
+                   args=[project_id],
+                   kwargs={},
+                   timeout=current_app.config.get('TIMEOUT'),
+                   queue='high')
+        enqueue_job(job)
+
+
 def get_incremental_task(project_id, user_id=None, user_ip=None,
                          external_uid=None, offset=0, limit=1, orderby='id', desc=False):
     """Get a new task for a given project with its last given answer.
@@ -189,20 +272,35 @@ def get_locked_task(project_id, user_id=None, user_ip=None,
         return []
 
     user_count = get_active_user_count(project_id, sentinel.master)
-    limit = 2*user_count
+    user_param, uid = _get_locked_user_param(user_id, user_ip, external_uid)
+    candidates = _get_locked_candidates(project_id, user_param, uid,
+                                        user_count + 5)
+    if not candidates:
+        return []
 
-    user_param = 'user_id'
-    uid = user_id
-    if not user_id:
-        if not user_ip:
-            user_ip = '127.0.0.1'
-        if not external_uid:
-            user_param = 'user_ip'
-            uid = user_ip
-        else:
-            user_param = 'external_uid'
-            uid = external_uid
+    # With offset 1 the first task locked is skipped, but the lock is kept
+    task_ids, limits = zip(*candidates)
+    locked = acquire_locks(task_ids, uid, limits, TIMEOUT, count=offset + 1)
+    if len(locked) == offset + 1:
+        register_active_user(project_id, uid, sentinel.master, ttl=TIMEOUT)
+        return [session.query(Task).get(locked[-1])]
+
+    return []
+
+
+def _get_locked_user_param(user_id=None, user_ip=None, external_uid=None):
+    """Return the task_run column and value of a contributor, which is also
+    the client id of their locks."""
+    if user_id:
+        return 'user_id', user_id
+    if external_uid:
+        return 'external_uid', external_uid
+    return 'user_ip', user_ip or '127.0.0.1'
 
+
+def _get_locked_candidates(project_id, user_param, uid, limit):
+    """Return the (task id, answers left) of the next tasks of a locked
+    project the user has not answered."""
     sql = text('''
            SELECT task.id, COUNT(task_run.task_id) AS taskcount, n_answers
            FROM task
@@ -216,19 +314,9 @@ def get_locked_task(project_id, user_id=None, user_ip=None,
            '''.format(user_param))
 
     rows = session.execute(sql, dict(project_id=project_id,
-                                     uid=uid, limit=user_count + 5))
-
-    for task_id, taskcount, n_answers in rows:
-        remaining = n_answers - taskcount
-        if acquire_lock(task_id, uid, remaining, TIMEOUT):
-            if offset == 1:
-                offset = 0
-                continue
-            rows.close()
-            register_active_user(project_id, uid, sentinel.master, ttl=TIMEOUT)
-            return [session.query(Task).get(task_id)]
-
-    return []
+                                     uid=uid, limit=limit))
+    return [(task_id, n_answers - taskcount)
+            for task_id, taskcount, n_answers in rows]
 
 
 TASK_USERS_KEY_PREFIX = 'pybossa:project:task_requested:timestamps:{0}'
@@ -241,28 +329,62 @@ def has_lock(task_id, user_id, timeout):
     return lock_manager.has_lock(task_users_key, user_id)
 
 
-def acquire_lock(task_id, user_id, limit, timeout, pipeline=None, execute=True):
-    redis_conn = sentinel.master
-    pipeline = pipeline or redis_conn.pipeline(transaction=True)
-    lock_manager = LockManager(redis_conn, timeout)
+def has_locks(task_ids, user_id, timeout):
+    """Return the ids of the tasks locked by the user."""
+    lock_manager = LockManager(sentinel.master, timeout)
+    keys = [get_task_users_key(task_id) for task_id in task_ids]
+    locked = set(lock_manager.has_locks(keys, user_id))
+    return [task_id for task_id, key in zip(task_ids, keys) if key in locked]
+
+
+def available_locks(candidates, user_id, timeout):
+    """Return the ids of the (task id, limit) candidates the user holds or
+    could acquire the lock of, without acquiring any."""
+    lock_manager = LockManager(sentinel.master, timeout)
+    keys = [get_task_users_key(task_id) for task_id, _ in candidates]
+    limits = [limit for _, limit in candidates]
+    available = set(lock_manager.get_available(keys, user_id, limits))
+    return [task_id for key, (task_id, _) in zip(keys, candidates)
+            if key in available]
+
+
+def acquire_lock(task_id, user_id, limit, timeout):
+    lock_manager = LockManager(sentinel.master, timeout)
     task_users_key = get_task_users_key(task_id)
-    if lock_manager.acquire_lock(task_users_key, user_id, limit, pipeline=pipeline):
-        if execute:
-            return all(not isinstance(r, Exception) for r in pipeline.execute())
-        return True
-    return False
+    return lock_manager.acquire_lock(task_users_key, user_id, limit)
+
+
+def acquire_locks(task_ids, user_id, limits, timeout, count=1):
+    """Lock the first count tasks available in one call to Redis.
+
+    Returns the ids of the tasks locked by the user.
+    """
+    lock_manager = LockManager(sentinel.master, timeout)
+    keys = [get_task_users_key(task_id) for task_id in task_ids]
+    locked = set(lock_manager.acquire_locks(keys, user_id, limits,
+                                            count=count))
+    return [task_id for task_id, key in zip(task_ids, keys) if key in locked]
 
 
 def release_lock(task_id, user_id, timeout, pipeline=None, execute=True):
-    redis_conn = sentinel.master
-    pipeline = pipeline or redis_conn.pipeline(transaction=True)
-    lock_manager = LockManager(redis_conn, timeout)
+    lock_manager = LockManager(sentinel.master, timeout)
     task_users_key = get_task_users_key(task_id)
     lock_manager.release_lock(task_users_key, user_id, pipeline=pipeline)
-    if execute:
+    if pipeline is not None and execute:
         pipeline.execute()
 
 
+def get_user_param(user_id=None, user_ip=None, external_uid=None):
+    """Return the task_run column and value identifying a contributor."""
+    if user_id and not user_ip and not external_uid:
+        return 'user_id', user_id
+    if not user_ip:
+        user_ip = '127.0.0.1'
+    if user_ip and not external_uid:
+        return 'user_ip', user_ip
+    return 'external_uid', external_uid
+
+
 def get_task_users_key(task_id):
     return TASK_USERS_KEY_PREFIX.format(task_id)
 
@@ -281,6 +403,7 @@ def sched_variants():
     return [('default', 'Default'), ('breadth_first', 'Breadth First'),
             ('depth_first', 'Depth First'),
             ('depth_first_all', 'Depth First All'),
+            ('depth_first_queue', 'Depth First (Redis queue)'),
             ('locked', 'Locked')
             ]
 
@@ -56,7 +56,7 @@ from pybossa.cache import users as cached_users
 from pybossa.cache import categories as cached_cat
 from pybossa.cache import project_stats as stats
 from pybossa.cache.helpers import add_custom_contrib_button_to, has_no_presenter
-from pybossa.ckan import Ckan
+from pybossa.ckan import Ckan, get_last_synced_id, set_last_synced_id
 from pybossa.extensions import misaka
 from pybossa.cookies import CookieHandler
 from pybossa.password_manager import ProjectPasswdManager
@@ -72,6 +72,7 @@ from pybossa.auditlogger import AuditLogger
 from pybossa.contributions_guard import ContributionsGuard
 from pybossa.default_settings import TIMEOUT
 from pybossa.exporter.csv_reports_export import ProjectReportCsvExporter
+from pybossa.exporter import get_export_progress
 
 blueprint = Blueprint('project', __name__)
 
@@ -1095,10 +1096,10 @@ def presenter(short_name):
         user_id = None if current_user.is_anonymous() else current_user.id
         user_ip = (anonymizer.ip(request.remote_addr or '127.0.0.1')
                    if current_user.is_anonymous() else None)
-        task = sched.new_task(project.id,
-                              project.info.get('sched'),
-                              user_id, user_ip, 0)
-        return task == [] and ps.overall_progress < 100.0
+        available = sched.has_available_task(project.id,
+                                             project.info.get('sched'),
+                                             user_id, user_ip)
+        return not available and ps.overall_progress < 100.0
 
     def respond(tmpl):
         if (current_user.is_anonymous()):
@@ -1343,6 +1344,7 @@ def export_to(short_name):
                                n_volunteers=ps.n_volunteers,
                                n_completed_tasks=ps.n_completed_tasks,
                                overall_progress=ps.overall_progress,
+                               export_progress=get_export_progress(project.id),
                                pro_features=pro)
 
     def respond_json(ty):
@@ -1365,6 +1367,12 @@ def export_to(short_name):
         ckan.datastore_upsert(name=table,
                               records=records,
                               resource_id=new_resource['result']['id'])
+        return new_resource['result']['id']
+
+    def track_last_id(rows, synced):
+        for row in rows:
+            synced['last_id'] = row['id']
+            yield row
 
     def respond_ckan(ty):
         # First check if there is a package (dataset) in CKAN
@@ -1373,10 +1381,13 @@ def export_to(short_name):
         ckan = Ckan(url=current_app.config['CKAN_URL'],
                     api_key=current_user.ckan_api)
         project_url = url_for('.details', short_name=project.short_name, _external=True)
+        incremental = request.args.get('incremental') in ('1', 'true', 'True')
+        synced = dict(last_id=None)
 
         try:
             package, e = ckan.package_exists(name=project.short_name)
-            records = json_exporter.gen_json(ty, project.id)
+            records = track_last_id(json_exporter.iter_json(ty, project.id),
+                                    synced)
             if e:
                 raise e
             if package:
@@ -1387,23 +1398,43 @@ def export_to(short_name):
                                               resources=package['resources'])
 
                 ckan.package = package
-                resource_found = False
+                resource_id = None
                 for r in package['resources']:
                     if r['name'] == ty:
-                        ckan.datastore_delete(name=ty, resource_id=r['id'])
-                        ckan.datastore_create(name=ty, resource_id=r['id'])
-                        ckan.datastore_upsert(name=ty,
-                                              records=records,
-                                              resource_id=r['id'])
-                        resource_found = True
+                        resource_id = r['id']
+                        last_id = None
+                        if incremental:
+                            last_id = get_last_synced_id(sentinel.master,
+                                                         project.id, ty,
+                                                         resource_id)
+                        if last_id is not None:
+                            # Only push the rows created since the last sync
+                            synced['last_id'] = last_id
+                            rows = json_exporter.iter_json(ty, project.id,
+                                                           last_id=last_id)
+                            ckan.datastore_upsert(name=ty,
+                                                  records=track_last_id(rows, synced),
+                                                  resource_id=resource_id,
+                                                  method='upsert')
+                        else:
+                            ckan.datastore_delete(name=ty, resource_id=resource_id)
+                            ckan.datastore_create(name=ty, resource_id=resource_id)
+                            ckan.datastore_upsert(name=ty,
+                                                  records=records,
+                                                  resource_id=resource_id)
                         break
-                if not resource_found:
-                    create_ckan_datastore(ckan, ty, package['id'], records)
+                if resource_id is None:
+                    resource_id = create_ckan_datastore(ckan, ty,
+                                                        package['id'], records)
             else:
                 owner = user_repo.get(project.owner_id)
                 package = ckan.package_create(project=project, user=owner,
                                               url=project_url)
-                create_ckan_datastore(ckan, ty, package['id'], records)
+                resource_id = create_ckan_datastore(ckan, ty, package['id'],
+                                                    records)
+            if synced['last_id'] is not None:
+                set_last_synced_id(sentinel.master, project.id, ty,
+                                   resource_id, synced['last_id'])
             flash(msg, 'success')
             return respond()
         except requests.exceptions.ConnectionError:
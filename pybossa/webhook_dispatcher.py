@@ -0,0 +1,195 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Delivery of the webhooks of completed tasks.
+
+The payloads of every project are appended to a Redis list, and a single
+dispatch job per project at a time drains it. Each round of payloads is
+moved to a processing list of the job, and removed from it only once the
+responses are stored, so the payloads of a job that dies are delivered
+again by a later one. Webhooks are posted over a pool of connections per
+endpoint, retrying transient failures with an exponential backoff.
+"""
+import json
+import threading
+import time
+from urlparse import urlparse
+from uuid import uuid4
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+PENDING_KEY = 'pybossa:webhooks:pending:{0}'
+SCHEDULED_KEY = 'pybossa:webhooks:scheduled:{0}'
+PROCESSING_KEY = 'pybossa:webhooks:processing:{0}'
+HEADERS = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+POOL_SIZE = 10
+STALE_TIMEOUT = 15 * 60
+
+# Moves up to ARGV[1] items from the head of the pending list KEYS[1] to
+# the processing list KEYS[2] and returns them.
+POP_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+return items
+"""
+
+# Puts the items of the processing list KEYS[2] back in front of the
+# pending list KEYS[1], keeping their order.
+RESTORE_LUA = """
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[1], items[i])
+end
+redis.call('DEL', KEYS[2])
+return #items
+"""
+
+_scripts = {}
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_pending_key(project_id):
+    return PENDING_KEY.format(project_id)
+
+
+def get_scheduled_key(project_id):
+    return SCHEDULED_KEY.format(project_id)
+
+
+def get_processing_key(project_id):
+    return PROCESSING_KEY.format(project_id)
+
+
+def _get_script(conn, lua):
+    """Return a script registered once per connection."""
+    script = _scripts.get((conn, lua))
+    if script is None:
+        script = _scripts[(conn, lua)] = conn.register_script(lua)
+    return script
+
+
+def push(project_id, url, payload, conn, ttl=5 * 60):
+    """Append a webhook to the pending ones of a project.
+
+    Returns True if the caller has to enqueue a dispatch job, as there is
+    none pending for the project. The flag expires after ttl seconds, so a
+    lost job does not stop the deliveries.
+    """
+    conn.rpush(get_pending_key(project_id),
+               json.dumps(dict(url=url, payload=payload)))
+    return bool(conn.set(get_scheduled_key(project_id), 1, ex=ttl, nx=True))
+
+
+def claim(project_id, conn, stale=STALE_TIMEOUT):
+    """Return a new processing list for a dispatch job of a project.
+
+    The webhooks left in the processing lists not touched for stale
+    seconds, whose jobs died, are put back in front of the pending ones.
+    """
+    key = get_processing_key(project_id)
+    now = time.time()
+    restore = _get_script(conn, RESTORE_LUA)
+    for processing in conn.zrangebyscore(key, '-inf', now - stale):
+        restore(keys=[get_pending_key(project_id), processing])
+        conn.zrem(key, processing)
+    processing = '%s:%s' % (key, uuid4().hex)
+    conn.zadd(key, now, processing)
+    return processing
+
+
+def pop(project_id, conn, size, processing):
+    """Move up to size pending webhooks of a project to a processing list.
+
+    Returns them; they stay in the list until the job acknowledges them.
+    """
+    conn.zadd(get_processing_key(project_id), time.time(), processing)
+    items = _get_script(conn, POP_LUA)(
+        keys=[get_pending_key(project_id), processing], args=[size])
+    return [json.loads(item) for item in items]
+
+
+def ack(processing, conn):
+    """Forget the webhooks of a processing list, once they are stored."""
+    conn.delete(processing)
+
+
+def release(project_id, processing, conn):
+    """Drop the processing list of a dispatch job that has finished."""
+    pipeline = conn.pipeline()
+    pipeline.delete(processing)
+    pipeline.zrem(get_processing_key(project_id), processing)
+    pipeline.execute()
+
+
+def unschedule(project_id, conn):
+    """Flag that the dispatch job of a project has started.
+
+    Webhooks pushed from now on enqueue a new job.
+    """
+    conn.delete(get_scheduled_key(project_id))
+
+
+def get_session(url):
+    """Return the pooled session of the endpoint of a URL."""
+    parts = urlparse(url)
+    endpoint = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        session = _sessions.get(endpoint)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[endpoint] = session
+    return session
+
+
+def post(url, data, params=None, timeout=10, retries=0, backoff=1):
+    """Post data to a webhook and return the response.
+
+    Connection errors, timeouts and RETRY_STATUS_CODES are retried up to
+    retries times, waiting backoff * 2 ** attempt seconds in between.
+    """
+    session = get_session(url)
+    for attempt in range(retries + 1):
+        last = attempt == retries
+        try:
+            response = session.post(url, params=params or dict(), data=data,
+                                    headers=HEADERS, timeout=timeout)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if last:
+                raise
+        else:
+            if last or response.status_code not in RETRY_STATUS_CODES:
+                return response
+        time.sleep(backoff * 2 ** attempt)
+
+
+def truncate(text, length):
+    """Return text cut to length characters."""
+    if text is None or len(text) <= length:
+        return text
+    return text[:length]
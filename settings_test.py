@@ -79,3 +79,5 @@ AVATAR_ABSOLUTE = True
 SPAM = ['fake.com']
 USER_INACTIVE_NOTIFICATION = 5
 USER_INACTIVE_DELETE = 6
+WEBHOOK_BACKOFF = 0
+EXPORT_INCREMENTAL_LAG = 0
@@ -474,6 +474,13 @@ class FakeResponse(object):
     def __init__(self, **kwargs):
         self.__dict__.update(**kwargs)
 
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for i in xrange(0, len(self.text), chunk_size):
+            yield self.text[i:i + chunk_size]
+
+    def close(self):
+        pass
+
 
 def mock_contributions_guard(stamped=True, timestamp='2015-11-18T16:29:25.496327'):
     fake_guard_instance = MagicMock()
@@ -0,0 +1,95 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""Local stand-in of the CKAN datastore API for the tests."""
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class CkanHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        with server.lock:
+            server.requests.append(self.path)
+            hang = server.hangs > 0
+            if hang:
+                server.hangs -= 1
+        if hang:
+            time.sleep(server.hang_time)
+            return
+        with server.lock:
+            if server.failures > 0:
+                server.failures -= 1
+                return self.respond(503, dict(success=False))
+            if self.path.endswith('/action/datastore_upsert'):
+                data = json.loads(body)
+                server.chunks.append(len(data['records']))
+                server.methods.append(data['method'])
+                server.records.extend(data['records'])
+        self.respond(200, dict(success=True, result={}))
+
+    def respond(self, status_code, data):
+        body = json.dumps(data)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CkanServer(ThreadingMixIn, HTTPServer):
+
+    """CKAN server recording the records upserted to it.
+
+    The first `hangs` requests get no answer for `hang_time` seconds, and
+    the next `failures` ones are answered with a 503.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, failures=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), CkanHandler)
+        self.lock = threading.Lock()
+        self.failures = failures
+        self.hangs = 0
+        self.hang_time = 5
+        self.requests = []
+        self.chunks = []
+        self.methods = []
+        self.records = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs=dict(poll_interval=0.05))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
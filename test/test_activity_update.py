@@ -15,7 +15,11 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+import json
+from mock import patch
 from default import Test, with_context
+from pybossa.core import sentinel, db
+from pybossa.feed import FEED_KEY
 from pybossa.view.account import get_update_feed
 
 from factories import ProjectFactory, TaskFactory, TaskRunFactory, UserFactory, BlogpostFactory
@@ -113,3 +117,65 @@ class TestActivityFeed(Test):
         update_feed = get_update_feed()
         err_msg = "There should be at max 100 updates."
         assert len(update_feed) == 100, err_msg
+
+    @with_context
+    @patch('pybossa.feed.FEED_MAX_SIZE', 5)
+    def test_feed_is_capped(self):
+        """Test ACTIVITY FEED keeps only the last FEED_MAX_SIZE events."""
+        projects = ProjectFactory.create_batch(5)
+
+        assert sentinel.master.zcard(FEED_KEY) == 5
+        update_feed = get_update_feed()
+        assert update_feed[0]['id'] == projects[-1].id, update_feed
+
+    @with_context
+    @patch('pybossa.feed.time', return_value=1000.0)
+    def test_task_events_are_coalesced(self, time):
+        """Test ACTIVITY FEED stores one Task event per project and bucket."""
+        project = ProjectFactory.create()
+        TaskFactory.create_batch(3, project=project)
+
+        update_feed = get_update_feed()
+        tasks = [event for event in update_feed
+                 if event['action_updated'] == 'Task']
+        assert len(tasks) == 1, tasks
+        assert tasks[0]['id'] == project.id, tasks
+
+    @with_context
+    def test_feed_stores_references(self):
+        """Test ACTIVITY FEED stores compact references to the objects."""
+        project = ProjectFactory.create(info=dict(task_presenter='<div/>'))
+
+        events = [json.loads(member) for member in
+                  sentinel.master.zrange(FEED_KEY, 0, -1)]
+        assert dict(action_updated='Project', project_id=project.id) in events
+        assert dict(action_updated='User',
+                    user_id=project.owner_id) in events
+
+    @with_context
+    def test_feed_resolves_events_in_one_batch(self):
+        """Test ACTIVITY FEED reads the projects and users in two queries."""
+        ProjectFactory.create_batch(3)
+
+        with patch.object(db.slave_session, 'execute',
+                          wraps=db.slave_session.execute) as execute:
+            update_feed = get_update_feed()
+
+        projects = [event for event in update_feed
+                    if event['action_updated'] == 'Project']
+        assert len(projects) == 3, update_feed
+        assert execute.call_count == 2, execute.call_args_list
+
+    @with_context
+    def test_feed_users_do_not_share_the_profile_cache(self):
+        """Test ACTIVITY FEED users are cached apart from the user profiles."""
+        from pybossa.feed import get_feed_user
+        from pybossa.cache.users import get_user_summary
+        user = UserFactory.create(id=7, name='7')
+
+        feed_key = get_feed_user.get_key_and_tags((7,), {})[0]
+        profile_key = get_user_summary.get_key_and_tags(('7',), {})[0]
+        assert feed_key != profile_key, feed_key
+
+        assert 'api_key' not in get_feed_user(7)
+        assert get_user_summary('7')['api_key'] == user.api_key
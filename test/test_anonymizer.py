@@ -0,0 +1,86 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from yacryptopan import CryptoPAn
+from pybossa.anonymizer import Anonymizer
+
+
+KEY = '32-char-str-for-AES-key-and-pad.'
+
+
+class FakeApp(object):
+    def __init__(self, cache_size=10000):
+        self.config = dict(CRYPTOPAN_KEY=KEY, ANONYMIZER_CACHE_SIZE=cache_size)
+
+
+class TestAnonymizer(object):
+
+    def setUp(self):
+        self.cp = CryptoPAn(KEY)
+
+    def test_ip(self):
+        """Test Anonymizer ip returns the CryptoPAn anonymized address"""
+        anonymizer = Anonymizer(FakeApp())
+
+        assert anonymizer.ip('127.0.0.1') == self.cp.anonymize('127.0.0.1')
+        assert anonymizer.ip('::1') == self.cp.anonymize('::1')
+
+    def test_ip_is_memoized(self):
+        """Test Anonymizer ip only anonymizes an address once"""
+        anonymizer = Anonymizer(FakeApp())
+
+        with patch.object(anonymizer._cp, 'anonymize',
+                          wraps=anonymizer._cp.anonymize) as anonymize:
+            first = anonymizer.ip('10.0.0.1')
+            second = anonymizer.ip('10.0.0.1')
+
+        assert first == second, second
+        assert anonymize.call_count == 1, anonymize.call_count
+
+    def test_ip_memo_is_bounded(self):
+        """Test Anonymizer drops the least recently used addresses"""
+        anonymizer = Anonymizer(FakeApp(cache_size=2))
+
+        anonymizer.ip('10.0.0.1')
+        anonymizer.ip('10.0.0.2')
+        anonymizer.ip('10.0.0.1')
+        anonymizer.ip('10.0.0.3')
+
+        assert anonymizer._cache.keys() == ['10.0.0.1', '10.0.0.3']
+
+    def test_ips(self):
+        """Test Anonymizer ips returns the anonymized addresses in order"""
+        anonymizer = Anonymizer(FakeApp())
+        addrs = ['10.0.1.2', '10.0.0.1', '2001:db8::2', '10.0.0.2',
+                 '2001:db8::1', '10.0.0.1', '255.255.255.255', '0.0.0.0']
+
+        anonymized = anonymizer.ips(addrs)
+
+        assert anonymized == [self.cp.anonymize(addr) for addr in addrs]
+
+    def test_ips_reuses_shared_prefixes(self):
+        """Test Anonymizer ips only encrypts the bits after shared prefixes"""
+        anonymizer = Anonymizer(FakeApp())
+
+        with patch.object(anonymizer, '_compute_flips',
+                          wraps=anonymizer._compute_flips) as compute:
+            anonymizer.ips(['10.0.0.1', '10.0.0.2'])
+
+        starts = [args[1] for args, _ in compute.call_args_list]
+        assert starts == [0, 31], starts
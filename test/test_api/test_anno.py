@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+from lxml import etree
+from pybossa.api import get_border_of_elements, merge_annotate_tag
+from pybossa.api.anno import Anno, ElementIndex
+
+
+XML = """<pages>
+<page id="1" bbox="0,0,612,792">
+<textbox bbox="100,100,300,130">
+<textline bbox="100,100,300,112">
+<text bbox="100,100,108,112" size="12.000">a</text>
+<text bbox="108,100,116,112" size="12.000">b</text>
+<text bbox="290,100,300,112" size="12.000">c</text>
+</textline>
+<textline bbox="100,118,300,130">
+<text bbox="100,118,108,130" size="12.000">d</text>
+</textline>
+</textbox>
+<textbox bbox="400,600,500,612">
+<textline bbox="400,600,500,612">
+<text bbox="400,600,408,612" size="12.000">e</text>
+</textline>
+</textbox>
+</page>
+<page id="2" bbox="0,0,612,792">
+<textbox bbox="100,100,300,112">
+<textline bbox="100,100,300,112">
+<text bbox="100,100,108,112" size="12.000">f</text>
+</textline>
+</textbox>
+</page>
+</pages>"""
+
+
+class TestAnno(object):
+
+    def setUp(self):
+        self.root = etree.fromstring(XML)
+        self.index = ElementIndex(self.root)
+
+    def texts(self, elements):
+        return [element.text for element in elements]
+
+    def test_index_parses_every_bbox_once(self):
+        """Test ElementIndex parses the bbox of all the elements."""
+        bboxes = self.root.xpath('//*[@bbox]')
+
+        assert len(self.index.boxes) == len(bboxes)
+        text = self.root.xpath('//text')[0]
+        assert self.index.boxes[text] == (100.0, 100.0, 108.0, 112.0)
+
+    def test_find_covered_only_looks_up_the_page(self):
+        """Test find_covered returns elements of the annotated page."""
+        anno = Anno(98, 98, 118, 114, 2, 'area', 'label')
+
+        tags = anno.find_covered(self.index)
+
+        assert self.texts(tags) == ['f'], self.texts(tags)
+
+    def test_find_covered_matches_browse(self):
+        """Test find_covered returns the same elements as browse."""
+        boxes = [(98, 98, 118, 114), (98, 98, 302, 132), (280, 95, 305, 135),
+                 (395, 595, 505, 615), (0, 0, 612, 792), (200, 200, 250, 250)]
+        for page in (1, 2):
+            for x1, y1, x2, y2 in boxes:
+                anno = Anno(x1, y1, x2, y2, page, 'area', 'label')
+                expected = anno.browse(self.root)
+
+                assert anno.find_covered(self.index) == expected, (page, x1)
+
+    def test_merge_annotate_tag_reuses_the_boxes(self):
+        """Test merge_annotate_tag sets the same bbox with parsed boxes."""
+        textline = self.root.xpath('//textline')[0]
+        expected = get_border_of_elements(textline)
+        for element in list(textline):
+            annotate = etree.Element('Annotate', bbox=element.attrib['bbox'],
+                                     label='label')
+            self.index.boxes[annotate] = self.index.boxes[element]
+            textline.replace(element, annotate)
+            annotate.append(element)
+
+        merge_annotate_tag(textline, self.index.boxes)
+
+        assert len(textline) == 1
+        assert textline[0].attrib['bbox'] == expected, textline[0].attrib
@@ -17,7 +17,9 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 import json
 import datetime
-from default import with_context
+from contextlib import contextmanager
+from sqlalchemy import event
+from default import db, with_context
 from nose.tools import assert_equal, assert_raises
 from test_api import TestAPI
 from pybossa.core import project_repo
@@ -105,6 +107,91 @@ class TestApiCommon(TestAPI):
         data = json.loads(res.data)
         assert len(data) == 30, len(data)
 
+    @with_context
+    def test_stream_query(self):
+        """Test API GET stream returns JSON lines and a cursor"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(150, project=project)
+
+        res = self.app.get('/api/task?stream=true')
+        lines = [json.loads(line) for line in res.data.splitlines()]
+        assert res.mimetype == 'application/x-ndjson', res.mimetype
+        assert len(lines) == 151, len(lines)
+        assert [l['id'] for l in lines[:-1]] == [t.id for t in tasks]
+        assert lines[-1] == dict(cursor=None), lines[-1]
+
+        url = '/api/task?stream=1&limit=120&project_id=%s' % project.id
+        res = self.app.get(url)
+        lines = [json.loads(line) for line in res.data.splitlines()]
+        assert len(lines) == 121, len(lines)
+        cursor = lines[-1]['cursor']
+        assert cursor == dict(last_id=tasks[119].id), cursor
+
+        url = '/api/task?stream=1&limit=120&last_id=%s' % cursor['last_id']
+        res = self.app.get(url)
+        lines = [json.loads(line) for line in res.data.splitlines()]
+        assert [l['id'] for l in lines[:-1]] == [t.id for t in tasks[120:]]
+        assert lines[-1] == dict(cursor=None), lines[-1]
+
+    @with_context
+    def test_stream_query_errors(self):
+        """Test API GET stream only supports ordering by id"""
+        ProjectFactory.create()
+
+        res = self.app.get('/api/project?stream=1&orderby=created')
+        assert res.status_code == 400, res.status_code
+        error = json.loads(res.data)
+        assert error['exception_cls'] == 'BadRequest', error
+
+        res = self.app.get('/api/project?stream=1&fulltextsearch=1&info=a')
+        assert res.status_code == 400, res.status_code
+
+
+    @contextmanager
+    def _count_queries(self):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+    @with_context
+    def test_related_and_stats_queries_do_not_grow_with_page_size(self):
+        """Test API GET related and stats use a query per relation"""
+        projects = ProjectFactory.create_batch(20)
+        for project in projects:
+            task = TaskFactory.create(project=project, n_answers=2)
+            TaskRunFactory.create_batch(2, task=task)
+
+        for endpoint in ['task', 'taskrun', 'result']:
+            counts = []
+            for limit in [2, 20]:
+                url = '/api/%s?related=True&limit=%s' % (endpoint, limit)
+                with self._count_queries() as statements:
+                    res = self.app.get(url)
+                data = json.loads(res.data)
+                assert len(data) == limit, (endpoint, len(data))
+                counts.append(len(statements))
+            assert counts[0] == counts[1], (endpoint, counts)
+
+        data = json.loads(self.app.get('/api/task?related=True').data)
+        assert len(data[0]['task_runs']) == 2, data[0]
+        assert data[0]['result']['task_id'] == data[0]['id'], data[0]
+
+        counts = []
+        for limit in [2, 20]:
+            with self._count_queries() as statements:
+                res = self.app.get('/api/project?stats=True&limit=%s' % limit)
+            data = json.loads(res.data)
+            assert len(data) == limit, len(data)
+            assert 'stats' in data[0], data[0]
+            counts.append(len(statements))
+        assert counts[0] == counts[1], counts
 
     @with_context
     def test_get_query_with_api_key_and_all(self):
@@ -26,7 +26,8 @@ from factories import (ProjectFactory, TaskFactory, TaskRunFactory,
                        AnonymousTaskRunFactory, UserFactory)
 from pybossa.repositories import ProjectRepository, TaskRepository
 from pybossa.repositories import ResultRepository
-from pybossa.core import db, anonymizer
+from pybossa.core import db, anonymizer, sentinel
+from pybossa.contributions_guard import ContributionsGuard
 from pybossa.auth.errcodes import *
 from pybossa.model.task_run import TaskRun
 
@@ -1495,3 +1496,70 @@ class TestTaskrunAPI(TestAPI):
         data = json.loads(res.data)
         assert res.status_code == 400, data
         assert data['exception_msg'] == 'Reserved keys in payload', data
+
+    @with_context
+    @patch('pybossa.model.event_listeners.webhook_queue')
+    def test_taskrun_bulk_post(self, webhook_queue):
+        """Test API TaskRun bulk creation"""
+        user = UserFactory.create()
+        project = ProjectFactory.create(webhook='http://server.com')
+        tasks = TaskFactory.create_batch(3, project=project, n_answers=1)
+        other_task = TaskFactory.create()
+        guard = ContributionsGuard(sentinel.master)
+        contributor = dict(user_id=user.id, user_ip=None, external_uid=None)
+        for task in tasks[:2]:
+            guard.stamp(task, contributor)
+        data = [dict(task_id=tasks[0].id, info='answer 0'),
+                dict(project_id=project.id, task_id=tasks[1].id,
+                     info='answer 1'),
+                dict(task_id=tasks[2].id, info='not requested'),
+                dict(project_id=other_task.project_id,
+                     task_id=other_task.id, info='other project'),
+                dict(task_id=tasks[0].id, info='twice'),
+                dict(id=1, task_id=tasks[1].id, info='reserved')]
+        url = '/api/project/%s/taskrun/bulk?api_key=%s' % (project.id,
+                                                           user.api_key)
+
+        res = self.app.post(url, data=json.dumps(data))
+        statuses = json.loads(res.data)
+
+        assert res.status_code == 200, res.data
+        assert len(statuses) == 6, statuses
+        assert [s['status_code'] for s in statuses] == [200, 200, 403, 403,
+                                                        403, 400], statuses
+        for i in range(2):
+            taskrun = statuses[i]['taskrun']
+            assert taskrun['task_id'] == tasks[i].id, taskrun
+            assert taskrun['user_id'] == user.id, taskrun
+            assert task_repo.get_task_run(taskrun['id']) is not None
+        assert statuses[3]['exception_msg'] == 'Invalid project_id', statuses
+        assert task_repo.count_task_runs_with(project_id=project.id) == 2
+        assert len(result_repo.filter_by(project_id=project.id)) == 2
+        assert webhook_queue.enqueue.call_count == 2
+        assert guard.check_task_stamped(tasks[0], contributor) is False
+
+        res = self.app.post(url, data=json.dumps(data[:1]))
+        statuses = json.loads(res.data)
+        assert statuses[0]['status_code'] == 403, statuses
+
+    @with_context
+    def test_taskrun_bulk_post_errors(self):
+        """Test API TaskRun bulk creation rejects invalid payloads"""
+        project = ProjectFactory.create(allow_anonymous_contributors=False)
+        url = '/api/project/%s/taskrun/bulk' % project.id
+
+        res = self.app.post(url, data=json.dumps(dict(task_id=1)))
+        assert res.status_code == 400, res.data
+
+        with patch.dict(self.flask_app.config, {'TASK_RUN_BULK_MAX_SIZE': 1}):
+            res = self.app.post(url, data=json.dumps([{}, {}]))
+            assert res.status_code == 400, res.data
+
+        res = self.app.post(url, data=json.dumps([]))
+        err = json.loads(res.data)
+        assert res.status_code == 403, err
+        assert err['target'] == 'taskrun', err
+
+        res = self.app.post('/api/project/9999/taskrun/bulk',
+                            data=json.dumps([]))
+        assert res.status_code == 404, res.data
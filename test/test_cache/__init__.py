@@ -19,7 +19,12 @@
 import hashlib
 from mock import patch
 from pybossa.cache import (get_key_to_hash, get_hash_key, cache, memoize,
-                           delete_cached, delete_memoized)
+                           delete_cached, delete_memoized, get_cache_stats,
+                           local_cache, L1_CHANNEL, delete_memoized_project,
+                           get_tag_key, get_refresh_lock_key,
+                           get_memoized_many, _listener,
+                           _start_invalidation_listener)
+from pybossa.jobs import refresh_cached_function
 from pybossa.sentinel import Sentinel
 from settings_test import REDIS_SENTINEL, REDIS_KEYPREFIX
 
@@ -245,12 +250,13 @@ class TestCacheMemoizeFunctions(object):
         @memoize()
         def my_func(*args, **kwargs):
             return [args, kwargs]
+        key_pattern = "%s:%s_args:*" % (REDIS_KEYPREFIX, 'my_func')
         my_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(test_sentinel.master.keys(key_pattern)) == 1
 
         delete_succedeed = delete_memoized(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert test_sentinel.master.keys() == [], 'Key was not deleted!'
+        assert test_sentinel.master.keys(key_pattern) == [], 'Key was not deleted!'
 
 
     def test_delete_memoized_returns_false_when_delete_fails(self):
@@ -259,12 +265,13 @@ class TestCacheMemoizeFunctions(object):
         @memoize()
         def my_func(*args, **kwargs):
             return [args, kwargs]
+        key_pattern = "%s:%s_args:*" % (REDIS_KEYPREFIX, 'my_func')
         my_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(test_sentinel.master.keys(key_pattern)) == 1
 
         delete_succedeed = delete_memoized(my_func, 'badarg', kwarg='barkwarg')
         assert delete_succedeed is False, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1, 'Key was unexpectedly deleted'
+        assert len(test_sentinel.master.keys(key_pattern)) == 1, 'Key was unexpectedly deleted'
 
 
     def test_delete_memoized_deletes_only_requested(self):
@@ -274,13 +281,14 @@ class TestCacheMemoizeFunctions(object):
         @memoize()
         def my_func(*args, **kwargs):
             return [args, kwargs]
+        key_pattern = "%s:%s_args:*" % (REDIS_KEYPREFIX, 'my_func')
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
-        assert len(test_sentinel.master.keys()) == 2
+        assert len(test_sentinel.master.keys(key_pattern)) == 2
 
         delete_succedeed = delete_memoized(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1, 'Everything was deleted!'
+        assert len(test_sentinel.master.keys(key_pattern)) == 1, 'Everything was deleted!'
 
 
     def test_delete_memoized_deletes_all_function_calls(self):
@@ -296,8 +304,293 @@ class TestCacheMemoizeFunctions(object):
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
         my_other_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 3
+        key_pattern = "%s:*_args:*" % REDIS_KEYPREFIX
+        assert len(test_sentinel.master.keys(key_pattern)) == 3
 
         delete_succedeed = delete_memoized(my_func)
         assert delete_succedeed is True, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(test_sentinel.master.keys(key_pattern)) == 1
+
+
+    def test_memoize_tags_function_and_project(self):
+        """Test CACHE memoize indexes the keys in the function and project
+        tags"""
+
+        @memoize(tag_project=True)
+        def my_project_func(project_id):
+            return project_id
+        my_project_func(1)
+        my_project_func(project_id=2)
+        key_pattern = "%s:%s_args:*" % (REDIS_KEYPREFIX, 'my_project_func')
+        keys = test_sentinel.master.keys(key_pattern)
+
+        function_tag = get_tag_key('function', 'my_project_func')
+        assert sorted(test_sentinel.master.zrange(function_tag, 0, -1)) == sorted(keys)
+        assert test_sentinel.master.zcard(get_tag_key('project', 1)) == 1
+        assert test_sentinel.master.zcard(get_tag_key('project', 2)) == 1
+
+
+    def test_delete_memoized_project_deletes_only_the_project(self):
+        """Test CACHE delete_memoized_project deletes the values of every
+        tagged function of the project and leaves the rest untouched"""
+
+        @memoize(tag_project=True)
+        def my_project_func(project_id):
+            return project_id
+        @memoize(tag_project=True)
+        def my_other_project_func(project_id, arg=None):
+            return arg
+        @memoize()
+        def my_untagged_func(project_id):
+            return project_id
+        my_project_func(1)
+        my_other_project_func(1, arg='arg')
+        my_project_func(2)
+        my_untagged_func(1)
+        key_pattern = "%s:*_args:*" % REDIS_KEYPREFIX
+        assert len(test_sentinel.master.keys(key_pattern)) == 4
+
+        delete_succedeed = delete_memoized_project(1)
+
+        assert delete_succedeed is True, delete_succedeed
+        assert len(test_sentinel.master.keys(key_pattern)) == 2
+        assert not test_sentinel.master.exists(get_tag_key('project', 1))
+        assert delete_memoized_project(1) is False
+
+
+    def test_delete_memoized_does_not_lose_values_stored_meanwhile(self):
+        """Test CACHE delete_memoized of a function keeps indexing the values
+        stored after the deletion"""
+
+        @memoize()
+        def my_func(*args, **kwargs):
+            return [args, kwargs]
+        my_func('arg')
+        delete_memoized(my_func)
+        my_func('other')
+
+        assert delete_memoized(my_func) is True
+        key_pattern = "%s:%s_args:*" % (REDIS_KEYPREFIX, 'my_func')
+        assert test_sentinel.master.keys(key_pattern) == []
+
+
+    def test_memoize_serves_stale_value_while_refreshing(self):
+        """Test CACHE memoize with stale_timeout serves the stale value if
+        another worker is refreshing it"""
+
+        @memoize(timeout=60, stale_timeout=30)
+        def my_stale_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+        assert my_stale_func('arg') == 1
+        key = test_sentinel.master.keys("%s:my_stale_func_args:*" % REDIS_KEYPREFIX)[0]
+        assert test_sentinel.master.ttl(key) > 60
+        test_sentinel.master.expire(key, 10)
+        test_sentinel.master.set(get_refresh_lock_key(key), 1)
+
+        assert my_stale_func('arg') == 1
+        assert test_sentinel.master.ttl(key) <= 10
+
+
+    def test_memoize_refreshes_stale_value_once(self):
+        """Test CACHE memoize with stale_timeout recomputes a stale value
+        inline and releases the refresh lock"""
+
+        @memoize(timeout=60, stale_timeout=30)
+        def my_stale_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+        my_stale_func('arg')
+        key = test_sentinel.master.keys("%s:my_stale_func_args:*" % REDIS_KEYPREFIX)[0]
+        test_sentinel.master.expire(key, 10)
+
+        assert my_stale_func('arg') == 2
+        assert my_stale_func('arg') == 2
+        assert test_sentinel.master.ttl(key) > 60
+        assert not test_sentinel.master.exists(get_refresh_lock_key(key))
+        assert my_stale_func.cache_stats['refreshes'] == 1
+
+
+    @patch('pybossa.cache.settings.CACHE_REFRESH_IN_BACKGROUND', True, create=True)
+    @patch('pybossa.jobs.enqueue_job')
+    def test_memoize_refreshes_stale_value_in_background(self, enqueue):
+        """Test CACHE memoize with stale_timeout enqueues the refresh if
+        CACHE_REFRESH_IN_BACKGROUND is set"""
+
+        @memoize(timeout=60, stale_timeout=30)
+        def my_stale_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+        my_stale_func('arg')
+        key = test_sentinel.master.keys("%s:my_stale_func_args:*" % REDIS_KEYPREFIX)[0]
+        test_sentinel.master.expire(key, 10)
+
+        assert my_stale_func('arg') == 1
+        assert my_stale_func('arg') == 1
+        assert enqueue.call_count == 1
+        job = enqueue.call_args[0][0]
+        assert job['name'] == refresh_cached_function, job
+        assert job['args'][1:] == ['my_stale_func', ['arg'], {}], job
+
+        assert my_stale_func.refresh('arg') == 2
+        assert my_stale_func('arg') == 2
+        assert not test_sentinel.master.exists(get_refresh_lock_key(key))
+
+
+    @patch('pybossa.cache.REFRESH_MAX_WAIT', 0.2)
+    def test_memoize_waits_for_the_worker_computing_a_miss(self):
+        """Test CACHE memoize with stale_timeout waits for the value being
+        computed by another worker before computing it"""
+
+        @memoize(timeout=60, stale_timeout=30)
+        def my_stale_func(arg):
+            return arg
+        key = "%s:my_stale_func_args:" % REDIS_KEYPREFIX
+        key = get_hash_key(key, get_key_to_hash('arg'))
+        test_sentinel.master.set(get_refresh_lock_key(key), 1)
+
+        assert my_stale_func('arg') == 'arg'
+        assert my_stale_func.cache_stats['misses'] == 1
+
+    def test_get_memoized_many_reads_and_stores_all_the_calls(self):
+        """Test CACHE get_memoized_many gets the cached values and computes
+        the missing ones at once, storing them as the memoized function"""
+
+        @memoize(tag_project=True)
+        def my_project_func(project_id):
+            return project_id * 10
+        my_project_func(1)
+        computed = []
+        def compute(calls):
+            computed.append(sorted(calls))
+            return dict((call, call[1][0] * 100) for call in calls)
+        calls = [(my_project_func, (1,)), (my_project_func, (2,)),
+                 (my_project_func, (3,))]
+
+        values = get_memoized_many(calls, compute)
+
+        assert values == [10, 200, 300], values
+        assert computed == [calls[1:]], computed
+        assert my_project_func(2) == 200
+        assert test_sentinel.master.zcard(get_tag_key('project', 3)) == 1
+        assert get_memoized_many(calls, compute) == values
+        assert len(computed) == 1, computed
+
+
+@patch('pybossa.cache._start_invalidation_listener')
+@patch('pybossa.cache._listening', new=lambda: True)
+@patch('pybossa.cache.sentinel', new=test_sentinel)
+class TestCacheLocalLayer(object):
+
+    @classmethod
+    def setup_class(cls):
+        import os
+        cls.cache = os.environ.pop('PYBOSSA_REDIS_CACHE_DISABLED', None)
+
+    @classmethod
+    def teardown_class(cls):
+        if cls.cache:
+            import os
+            os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = cls.cache
+
+    def setUp(self):
+        test_sentinel.master.flushall()
+        local_cache.clear()
+
+    @patch('pybossa.cache.settings.CACHE_L1_ENABLED', True, create=True)
+    def test_memoize_serves_from_local_cache(self, listener):
+        """Test CACHE memoize with local_timeout skips Redis once cached"""
+
+        @memoize(local_timeout=60)
+        def my_local_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+        assert my_local_func('arg') == 1
+        test_sentinel.master.flushall()
+
+        assert my_local_func('arg') == 1
+        assert my_local_func.cache_stats['local_hits'] == 1
+        assert my_local_func.cache_stats['misses'] == 1
+        assert listener.called
+
+    @patch('pybossa.cache.settings.CACHE_L1_ENABLED', True, create=True)
+    def test_local_cache_returns_copies(self, listener):
+        """Test CACHE local cache values can be modified by the caller"""
+
+        @cache(key_prefix='my_local_cached_func', local_timeout=60)
+        def my_func():
+            return dict(count=1)
+        my_func()['count'] = 2
+
+        assert my_func() == dict(count=1)
+
+    @patch('pybossa.cache.settings.CACHE_L1_ENABLED', True, create=True)
+    def test_delete_memoized_invalidates_local_cache(self, listener):
+        """Test CACHE delete_memoized removes local values and broadcasts"""
+
+        @memoize(local_timeout=60)
+        def my_local_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+        pubsub = test_sentinel.master.pubsub()
+        pubsub.subscribe(L1_CHANNEL)
+        messages = pubsub.listen()
+        next(messages)
+        my_local_func('arg')
+        my_local_func('other')
+
+        delete_memoized(my_local_func)
+
+        assert len(local_cache) == 0
+        assert my_local_func('arg') == 3
+        message = next(messages)
+        assert message['data'].startswith('prefix '), message
+
+    @patch('pybossa.cache.settings.CACHE_L1_ENABLED', True, create=True)
+    def test_delete_cached_invalidates_local_cache(self, listener):
+        """Test CACHE delete_cached removes the local value"""
+
+        @cache(key_prefix='my_local_cached_func', local_timeout=60)
+        def my_func(call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+        my_func()
+
+        delete_cached('my_local_cached_func')
+
+        assert my_func() == 2
+
+    @patch('pybossa.cache.settings.CACHE_L1_ENABLED', True, create=True)
+    def test_local_cache_waits_for_the_listener(self, listener):
+        """Test CACHE local values are not stored until the invalidations
+        are listened to"""
+
+        @memoize(local_timeout=60)
+        def my_local_func(arg):
+            return arg
+        with patch('pybossa.cache._listening', return_value=False):
+            my_local_func('arg')
+            my_local_func('arg')
+
+        assert len(local_cache) == 0
+        assert my_local_func.cache_stats['local_hits'] == 0
+
+    def test_listener_is_subscribed_when_started(self, listener):
+        """Test CACHE invalidation listener returns once subscribed"""
+        with patch.dict(_listener, pid=None):
+            _start_invalidation_listener()
+
+            assert _listener['subscribed'].is_set()
+
+    def test_local_cache_disabled_by_default(self, listener):
+        """Test CACHE local layer is not used unless enabled"""
+
+        @memoize(local_timeout=60)
+        def my_func(arg):
+            return arg
+        my_func('arg')
+        my_func('arg')
+
+        assert len(local_cache) == 0
+        assert not listener.called
+        assert get_cache_stats()['my_func']['hits'] >= 1
@@ -24,6 +24,7 @@ from mock import patch
 import datetime
 from pybossa.core import result_repo
 from pybossa.model.project import Project
+from pybossa.util import pretty_date
 from pybossa.cache.project_stats import update_stats
 
 
@@ -428,6 +429,45 @@ class TestProjectsCache(Test):
         # And it does not go over 1 (that is 100%!!)
         assert cached_task.get('pct_status') == 1.0, cached_task.get('pct_status')
 
+    @with_context
+    @patch('pybossa.cache.projects.BROWSE_TASKS_WINDOW', 3)
+    def test_browse_tasks_pages_through_windows(self):
+        """Test CACHE PROJECTS browse_tasks pages by offset and by last_id"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(8, project=project)
+        task_ids = [task.id for task in tasks]
+
+        windows = cached_projects.browse_tasks_windows(project.id)
+        assert windows['n_tasks'] == 8, windows
+        assert windows['first_ids'] == task_ids[::3], windows
+        for offset in range(9):
+            page = cached_projects.browse_tasks(project.id, limit=4,
+                                                offset=offset)
+            assert [t['id'] for t in page] == task_ids[offset:offset + 4]
+        page = cached_projects.browse_tasks(project.id, limit=4,
+                                            last_id=task_ids[2])
+        assert [t['id'] for t in page] == task_ids[3:7], page
+
+    @with_context
+    def test_browse_tasks_filters_by_state_and_completion(self):
+        """Test CACHE PROJECTS browse_tasks filters by state and by the
+        completion of the tasks"""
+        project = ProjectFactory.create()
+        empty, half, completed = TaskFactory.create_batch(3, project=project,
+                                                          n_answers=2)
+        TaskRunFactory.create(task=half)
+        TaskRunFactory.create_batch(2, task=completed)
+
+        def browse(**filters):
+            return [t['id'] for t in
+                    cached_projects.browse_tasks(project.id, **filters)]
+
+        assert browse(state='completed') == [completed.id]
+        assert browse(state='ongoing') == [empty.id, half.id]
+        assert browse(min_pct=0.5) == [half.id, completed.id]
+        assert browse(min_pct=0.1, max_pct=0.9) == [half.id]
+        assert browse(max_pct=0) == [empty.id]
+
 
     @with_context
     def test_n_featured_returns_nothing(self):
@@ -586,6 +626,28 @@ class TestProjectsCache(Test):
         assert activity == last_task_run.finish_time, last_task_run
 
 
+    @with_context
+    def test_get_stats_returns_the_stats_of_every_project(self):
+        project = self.create_project_with_contributors(anonymous=2,
+                                                        registered=1)
+        TaskFactory.create(project=project, state='completed')
+        empty_project = ProjectFactory.create()
+        project_ids = [project.id, empty_project.id]
+
+        stats = cached_projects.get_stats(project_ids)
+
+        for project_id in project_ids:
+            activity = cached_projects.last_activity(project_id)
+            expected = dict(last_activity=pretty_date(activity),
+                            last_activity_raw=activity,
+                            overall_progress=cached_projects.overall_progress(project_id),
+                            n_tasks=cached_projects.n_tasks(project_id),
+                            n_volunteers=cached_projects.n_volunteers(project_id))
+            assert stats[project_id] == expected, stats[project_id]
+        assert stats[project.id]['n_volunteers'] == 3, stats
+        assert stats[project.id]['overall_progress'] == 50, stats
+
+
     @with_context
     def test_n_published_counts_published_projects(self):
         published_project = ProjectFactory.create_batch(2, published=True)
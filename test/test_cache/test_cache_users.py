@@ -16,7 +16,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
-from default import Test, with_context
+from mock import patch
+from default import Test, db, with_context
 from pybossa.cache import users as cached_users
 from pybossa.model.user import User
 from pybossa.leaderboard.jobs import leaderboard as update_leaderboard
@@ -524,3 +525,40 @@ class TestUsersCache(Test):
         for field in fields:
             assert field in users[0].keys(), field
         assert len(users[0].keys()) == len(fields)
+
+    @with_context
+    def test_get_user_by_api_key(self):
+        user = UserFactory.create()
+
+        cached = cached_users.get_user_by_api_key(user.api_key)
+
+        assert cached is user, cached
+        assert cached_users.get_user_by_api_key('nokey') is None
+
+    @with_context
+    def test_get_user_by_api_key_attaches_cached_user(self):
+        user = UserFactory.create()
+        data = cached_users.user_by_api_key_cached(user.api_key)
+        db.session.expunge_all()
+
+        with patch.object(cached_users, 'user_by_api_key_cached',
+                          return_value=data):
+            with patch.object(db.session, 'query') as query:
+                cached = cached_users.get_user_by_api_key(user.api_key)
+
+        assert not query.called
+        assert cached in db.session, cached
+        assert cached.id == user.id, cached
+        assert cached.name == user.name, cached
+        assert cached.projects == [], cached
+        assert cached.api_key == user.api_key, cached
+
+    @with_context
+    def test_user_by_api_key_cached_leaves_out_secrets(self):
+        user = UserFactory.create()
+
+        data = cached_users.user_by_api_key_cached(user.api_key)
+
+        assert data['id'] == user.id, data
+        for column in ('passwd_hash', 'email_addr', 'api_key', 'ckan_api'):
+            assert column not in data, data
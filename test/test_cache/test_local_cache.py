@@ -0,0 +1,75 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from pybossa.cache.local_cache import LocalCache
+
+
+class TestLocalCache(object):
+
+    def test_get_set(self):
+        """Test LocalCache stores and returns values"""
+        cache = LocalCache()
+        cache.set('key', 'value', 10)
+
+        assert cache.get('key') == 'value'
+        assert cache.get('missing') is None
+
+    @patch('pybossa.cache.local_cache.time')
+    def test_expired_values_are_dropped(self, time):
+        """Test LocalCache does not return expired values"""
+        time.return_value = 100
+        cache = LocalCache()
+        cache.set('key', 'value', 10)
+        time.return_value = 111
+
+        assert cache.get('key') is None
+        assert cache.size == 0
+
+    def test_evicts_least_recently_used_items(self):
+        """Test LocalCache evicts the least recently used key"""
+        cache = LocalCache(max_items=2)
+        cache.set('a', '1', 10)
+        cache.set('b', '2', 10)
+        cache.get('a')
+        cache.set('c', '3', 10)
+
+        assert cache.get('b') is None
+        assert cache.get('a') == '1'
+        assert cache.get('c') == '3'
+
+    def test_evicts_to_fit_max_bytes(self):
+        """Test LocalCache keeps the stored bytes under max_bytes"""
+        cache = LocalCache(max_bytes=10)
+        cache.set('a', 'x' * 6, 10)
+        cache.set('b', 'y' * 6, 10)
+
+        assert cache.get('a') is None
+        assert cache.size == 6
+        assert cache.set('c', 'z' * 11, 10) is False
+
+    def test_delete_prefix(self):
+        """Test LocalCache deletes every key with a prefix"""
+        cache = LocalCache()
+        cache.set('prefix:a', '1', 10)
+        cache.set('prefix:b', '2', 10)
+        cache.set('other', '3', 10)
+
+        assert cache.delete_prefix('prefix:') == 2
+        assert len(cache) == 1
+        assert cache.size == 1
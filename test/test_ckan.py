@@ -25,6 +25,7 @@ from default import Test, db, with_context
 from pybossa.model.user import User
 from pybossa.model.project import Project
 from helper import web as web_helper
+from helper.ckan_server import CkanServer
 from pybossa.ckan import Ckan
 
 
@@ -230,7 +231,7 @@ class TestCkanModule(Test, object):
 
     # Tests
 
-    @patch('pybossa.ckan.requests.get')
+    @patch('pybossa.ckan.requests.Session.get')
     def test_00_package_exists_returns_false(self, Mock):
         """Test CKAN get_resource_id works"""
         html_request = FakeRequest(json.dumps(self.pkg_json_not_found), 200,
@@ -266,7 +267,7 @@ class TestCkanModule(Test, object):
                 assert status_code == 200, "status_code should be 200"
                 assert type == "CKAN: JSON not valid"
 
-    @patch('pybossa.ckan.requests.get')
+    @patch('pybossa.ckan.requests.Session.get')
     def test_01_package_exists_returns_pkg(self, Mock):
         """Test CKAN get_resource_id works"""
         html_request = FakeRequest(json.dumps(self.pkg_json_found), 200,
@@ -279,7 +280,7 @@ class TestCkanModule(Test, object):
             err_msg = "The pkg id should be the same"
             assert out['id'] == self.pkg_json_found['result']['id'], err_msg
 
-    @patch('pybossa.ckan.requests.get')
+    @patch('pybossa.ckan.requests.Session.get')
     def test_02_get_resource_id(self, Mock):
         """Test CKAN get_resource_id works"""
         html_request = FakeRequest(json.dumps(self.pkg_json_found), 200,
@@ -302,7 +303,7 @@ class TestCkanModule(Test, object):
             out = self.ckan.get_resource_id(name='non-existant')
             assert out is False, err_msg
 
-    @patch('pybossa.ckan.requests.post')
+    @patch('pybossa.ckan.requests.Session.post')
     def test_03_package_create(self, Mock):
         """Test CKAN package_create works"""
         # It should return self.pkg_json_found with an empty Resources list
@@ -327,7 +328,7 @@ class TestCkanModule(Test, object):
                 assert 500 == status_code, status_code
                 assert "CKAN: the remote site failed! package_create failed" == type, type
 
-    @patch('pybossa.ckan.requests.post')
+    @patch('pybossa.ckan.requests.Session.post')
     def test_05_resource_create(self, Mock):
         """Test CKAN resource_create works"""
         pkg_request = FakeRequest(json.dumps(self.pkg_json_found), 200,
@@ -356,7 +357,7 @@ class TestCkanModule(Test, object):
                 assert 500 == status_code, status_code
                 assert "CKAN: the remote site failed! resource_create failed" == type, type
 
-    @patch('pybossa.ckan.requests.post')
+    @patch('pybossa.ckan.requests.Session.post')
     def test_05_datastore_create_without_resource_id(self, Mock):
         """Test CKAN datastore_create without resource_id works"""
         html_request = FakeRequest(json.dumps(self.task_datastore), 200,
@@ -379,7 +380,7 @@ class TestCkanModule(Test, object):
                 assert 500 == status_code, status_code
                 assert "CKAN: the remote site failed! datastore_create failed" == type, type
 
-    @patch('pybossa.ckan.requests.post')
+    @patch('pybossa.ckan.requests.Session.post')
     def test_05_datastore_create(self, Mock):
         """Test CKAN datastore_create works"""
         html_request = FakeRequest(json.dumps(self.task_datastore), 200,
@@ -402,7 +403,7 @@ class TestCkanModule(Test, object):
                 assert 500 == status_code, status_code
                 assert "CKAN: the remote site failed! datastore_create failed" == type, type
 
-    @patch('pybossa.ckan.requests.post')
+    @patch('pybossa.ckan.requests.Session.post')
     def test_06_datastore_upsert_without_resource_id(self, Mock):
         """Test CKAN datastore_upsert without resourece_id works"""
         html_request = FakeRequest(json.dumps(self.task_upsert), 200,
@@ -429,7 +430,7 @@ class TestCkanModule(Test, object):
                 assert "CKAN: the remote site failed! datastore_upsert failed" == type, type
 
 
-    @patch('pybossa.ckan.requests.post')
+    @patch('pybossa.ckan.requests.Session.post')
     def test_06_datastore_upsert(self, Mock):
         """Test CKAN datastore_upsert works"""
         html_request = FakeRequest(json.dumps(self.task_upsert), 200,
@@ -455,7 +456,7 @@ class TestCkanModule(Test, object):
                 assert 500 == status_code, status_code
                 assert "CKAN: the remote site failed! datastore_upsert failed" == type, type
 
-    @patch('pybossa.ckan.requests.post')
+    @patch('pybossa.ckan.requests.Session.post')
     def test_07_datastore_delete(self, Mock):
         """Test CKAN datastore_delete works"""
         html_request = FakeRequest(json.dumps({}), 200,
@@ -478,7 +479,7 @@ class TestCkanModule(Test, object):
                 assert 500 == status_code, status_code
                 assert "CKAN: the remote site failed! datastore_delete failed" == type, type
 
-    @patch('pybossa.ckan.requests.post')
+    @patch('pybossa.ckan.requests.Session.post')
     def test_08_package_update(self, Mock):
         """Test CKAN package_update works"""
         html_request = FakeRequest(json.dumps(self.pkg_json_found), 200,
@@ -505,3 +506,84 @@ class TestCkanModule(Test, object):
                 assert "Server Error" in msg, msg
                 assert 500 == status_code, status_code
                 assert "CKAN: the remote site failed! package_update failed" == type, type
+
+
+class TestCkanUpsert(object):
+
+    def setUp(self):
+        self.server = CkanServer()
+        self.server.start()
+        self.ckan = Ckan(url=self.server.url, api_key="fake-api-key")
+        self.ckan.backoff = 0
+        self.records = [dict(id=i, info=dict(foo=i)) for i in range(1, 251)]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_datastore_upsert_streams_chunks(self):
+        """Test CKAN datastore_upsert sends an iterator of records in chunks"""
+        self.ckan.chunk_size = 20
+        self.ckan.target_time = 0
+
+        out = self.ckan.datastore_upsert(name='task',
+                                         records=iter(self.records),
+                                         resource_id='resource')
+
+        assert out is True, out
+        ids = sorted(record['id'] for record in self.server.records)
+        assert ids == range(1, 251), ids
+        assert len(self.server.chunks) > 1, self.server.chunks
+        assert max(self.server.chunks) <= 20, self.server.chunks
+
+    def test_datastore_upsert_adapts_chunk_size(self):
+        """Test CKAN datastore_upsert grows the chunks if CKAN is fast"""
+        self.ckan.chunk_size = 20
+        self.ckan.workers = 1
+
+        self.ckan.datastore_upsert(name='task', records=self.records,
+                                   resource_id='resource')
+
+        assert self.server.chunks[0] == 20, self.server.chunks
+        assert max(self.server.chunks) > 20, self.server.chunks
+        assert sum(self.server.chunks) == 250, self.server.chunks
+
+    def test_datastore_upsert_retries(self):
+        """Test CKAN datastore_upsert retries when CKAN is unavailable"""
+        self.server.failures = 2
+
+        out = self.ckan.datastore_upsert(name='task', records=self.records,
+                                         resource_id='resource')
+
+        assert out is True, out
+        assert len(self.server.records) == 250, len(self.server.records)
+        assert len(self.server.requests) == len(self.server.chunks) + 2
+        # Retried chunks are upserted, in case the failed request stored them
+        assert 1 <= self.server.methods.count('upsert') <= 2, self.server.methods
+        assert self.server.methods.count('insert') >= len(self.server.chunks) - 2
+
+    def test_datastore_upsert_retries_hung_requests(self):
+        """Test CKAN datastore_upsert times out and retries hung requests"""
+        self.server.hangs = 1
+        self.ckan.timeout = (1, 0.2)
+        self.ckan.workers = 1
+
+        out = self.ckan.datastore_upsert(name='task', records=self.records,
+                                         resource_id='resource')
+
+        assert out is True, out
+        assert len(self.server.records) == 250, len(self.server.records)
+        assert self.server.methods[0] == 'upsert', self.server.methods
+
+    def test_datastore_upsert_gives_up(self):
+        """Test CKAN datastore_upsert raises when the retries run out"""
+        self.server.failures = self.ckan.retries + 1
+        self.ckan.workers = 1
+
+        try:
+            self.ckan.datastore_upsert(name='task', records=self.records,
+                                       resource_id='resource')
+            raise AssertionError("It should raise an exception")
+        except Exception as out:
+            type, msg, status_code = out.args
+            assert 503 == status_code, status_code
+            assert "CKAN: the remote site failed! datastore_upsert failed" == type, type
@@ -16,7 +16,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 from mock import patch, Mock
-from pybossa.importers import Importer
+from nose.tools import assert_raises
+from pybossa.importers import Importer, BulkImportException
 
 from default import Test, with_context
 from factories import ProjectFactory, TaskFactory
@@ -79,6 +80,43 @@ class TestImporterPublicMethods(Test):
         assert result.message == 'It looks like there were no new records to import', result
         importer_factory.assert_called_with(**form_data)
 
+    @with_context
+    @patch('pybossa.importers.importer.IMPORT_BATCH_SIZE', 2)
+    @patch('pybossa.cache.projects.clean_project')
+    def test_create_tasks_in_batches(self, clean_project, importer_factory):
+        mock_importer = Mock()
+        mock_importer.tasks.return_value = [{'info': {'question': i % 4}}
+                                            for i in range(5)]
+        importer_factory.return_value = mock_importer
+        project = ProjectFactory.create()
+        form_data = dict(type='csv', csv_url='http://fakecsv.com')
+
+        result = self.importer.create_tasks(task_repo, project.id, **form_data)
+        tasks = task_repo.filter_tasks_by(project_id=project.id)
+
+        assert len(tasks) == 4, len(tasks)
+        assert result.total == 4, result.total
+        clean_project.assert_called_once_with(project.id)
+
+    @with_context
+    @patch('pybossa.importers.importer.IMPORT_BATCH_SIZE', 2)
+    def test_create_tasks_imports_nothing_if_the_source_fails(self, importer_factory):
+        def tasks():
+            for i in range(3):
+                yield {'info': {'question': i}}
+            raise BulkImportException('Malformed row')
+        mock_importer = Mock()
+        mock_importer.tasks.return_value = tasks()
+        importer_factory.return_value = mock_importer
+        project = ProjectFactory.create()
+        form_data = dict(type='csv', csv_url='http://fakecsv.com')
+
+        assert_raises(BulkImportException, self.importer.create_tasks,
+                      task_repo, project.id, **form_data)
+        tasks = task_repo.filter_tasks_by(project_id=project.id)
+
+        assert len(tasks) == 0, len(tasks)
+
     @with_context
     def test_create_tasks_returns_task_report(self, importer_factory):
         mock_importer = Mock()
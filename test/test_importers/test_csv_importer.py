@@ -199,3 +199,18 @@ class TestBulkTaskCSVImport(object):
         task = tasks.next()
 
         assert csv_file.encoding == 'utf-8'
+
+    @patch('pybossa.importers.csv.CHUNK_SIZE', 3)
+    def test_tasks_are_streamed_in_chunks(self, request):
+        csv_file = FakeResponse(text=u'Foo,Bar\r\n"a\nb",M\xfcnchen\n1,2',
+                                status_code=200,
+                                headers={'content-type': 'text/plain'},
+                                encoding='utf-8')
+        request.return_value = csv_file
+
+        tasks = list(self.importer.tasks())
+
+        request.assert_called_with('http://myfakecsvurl.com', stream=True)
+        assert tasks == [{'info': {u'Foo': u'a\nb', u'Bar': u'M\xfcnchen'}},
+                         {'info': {u'Foo': u'1', u'Bar': u'2'}}], tasks
+        assert self.importer.count_tasks() == 2
@@ -48,3 +48,10 @@ class TestBulkTaskLocalCSVImport(object):
         with patch('pybossa.importers.csv.io.open', mock_open(read_data=u'Foo,Bar\n1,2\naaa,bbb\n'), create=True):
             number_of_tasks = self.importer.count_tasks()
             assert number_of_tasks is 2, number_of_tasks
+
+    def test_tasks_reads_the_file_lazily(self):
+        with patch('pybossa.importers.csv.io.open', mock_open(read_data=u'Foo,Bar\n1,2\naaa,bbb\n'), create=True) as m:
+            tasks = self.importer.tasks()
+            assert tasks.next() == {'info': {u'Foo': u'1', u'Bar': u'2'}}
+            assert not m.return_value.read.called
+            assert tasks.next() == {'info': {u'Foo': u'aaa', u'Bar': u'bbb'}}
@@ -0,0 +1,79 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+from pybossa.jobs import compact_counters, get_counter_compaction_jobs
+from pybossa.model.counter import Counter
+from pybossa.sched import get_breadth_first_task
+from default import Test, with_context, db
+from factories import ProjectFactory, TaskFactory, TaskRunFactory
+
+
+class TestCompactCounters(Test):
+
+    def _counters(self, project_id):
+        return db.session.query(Counter.task_id, Counter.n_task_runs)\
+                 .filter_by(project_id=project_id)\
+                 .order_by(Counter.task_id).all()
+
+    @with_context
+    def test_compact_counters_folds_deltas(self):
+        """Test JOB compact_counters keeps one row per task."""
+        project = ProjectFactory.create()
+        task_1, task_2 = TaskFactory.create_batch(2, project=project)
+        TaskRunFactory.create_batch(3, task=task_1)
+        task_run = TaskRunFactory.create(task=task_2)
+        db.session.delete(task_run)
+        db.session.commit()
+        other = TaskFactory.create()
+        TaskRunFactory.create(task=other)
+
+        res = compact_counters(project.id)
+
+        assert res == "Counters of 2 tasks of project %s compacted" % project.id
+        counters = self._counters(project.id)
+        assert counters == [(task_1.id, 3), (task_2.id, 0)], counters
+        assert len(self._counters(other.project_id)) == 2
+
+    @with_context
+    def test_breadth_first_after_compaction(self):
+        """Test JOB compact_counters keeps the breadth first order."""
+        project = ProjectFactory.create(info=dict(sched='breadth_first'))
+        task_1, task_2 = TaskFactory.create_batch(2, project=project)
+        TaskRunFactory.create_batch(2, task=task_1)
+        TaskRunFactory.create(task=task_2)
+        compact_counters(project.id)
+        TaskRunFactory.create_batch(2, task=task_2)
+
+        tasks = get_breadth_first_task(project.id, user_ip='127.0.0.2')
+
+        assert tasks[0].id == task_1.id, tasks
+
+    @with_context
+    def test_get_counter_compaction_jobs(self):
+        """Test JOB get_counter_compaction_jobs returns the flagged projects."""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        TaskFactory.create()
+        TaskRunFactory.create(task=task)
+
+        jobs = list(get_counter_compaction_jobs())
+
+        assert [job['args'] for job in jobs] == [[project.id]], jobs
+        assert jobs[0]['name'] == compact_counters
+        assert jobs[0]['queue'] == 'low'
+        assert list(get_counter_compaction_jobs()) == []
@@ -17,7 +17,7 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 from default import Test, with_context, flask_app
 from factories import ProjectFactory, UserFactory
-from pybossa.jobs import get_export_task_jobs, project_export
+from pybossa.jobs import get_export_task_jobs, project_export, project_export_table
 from mock import patch
 
 class TestExport(Test):
@@ -79,6 +79,32 @@ class TestExport(Test):
         msg = "The job should be enqueued in high priority."
         assert job['queue'] == 'high', msg
 
+    @with_context
+    @patch.dict(flask_app.config, {'PRO_FEATURES': {'updated_exports': False},
+                                   'EXPORT_JOBS_PER_TABLE': True})
+    def test_get_export_task_jobs_per_table(self):
+        """Test JOB export task jobs returns a job per table and format."""
+        project = ProjectFactory.create()
+        jobs = list(get_export_task_jobs(queue='low'))
+
+        assert len(jobs) == 6, len(jobs)
+        for job in jobs:
+            assert job['name'] == project_export_table, job
+            assert job['args'][0] == project.id, job
+        args = [tuple(job['args'][1:]) for job in jobs]
+        assert ('task_run', 'csv') in args, args
+        assert ('result', 'json') in args, args
+
+    @with_context
+    @patch('pybossa.core.json_exporter')
+    @patch('pybossa.core.csv_exporter')
+    def test_project_export_table(self, csv_exporter, json_exporter):
+        """Test JOB project_export_table exports one table."""
+        project = ProjectFactory.create()
+        project_export_table(project.id, 'task_run', 'csv')
+        csv_exporter._make_zip.assert_called_once_with(project, 'task_run')
+        assert not json_exporter._make_zip.called
+
     @with_context
     @patch('pybossa.core.json_exporter')
     @patch('pybossa.core.csv_exporter')
@@ -89,6 +115,19 @@ class TestExport(Test):
         csv_exporter.pregenerate_zip_files.assert_called_once_with(project)
         json_exporter.pregenerate_zip_files.assert_called_once_with(project)
 
+    @with_context
+    @patch.dict(flask_app.config, {'EXPORT_INCREMENTAL': True})
+    @patch('pybossa.core.json_exporter')
+    @patch('pybossa.core.csv_exporter')
+    def test_project_export_incremental(self, csv_exporter, json_exporter):
+        """Test JOB project_export appends to the incremental ZIPs."""
+        project = ProjectFactory.create()
+        project_export(project.id)
+        csv_exporter.pregenerate_incremental_zip_files.assert_called_once_with(project)
+        json_exporter.pregenerate_incremental_zip_files.assert_called_once_with(project)
+        assert not csv_exporter.pregenerate_zip_files.called
+        assert not json_exporter.pregenerate_zip_files.called
+
     @with_context
     @patch('pybossa.core.json_exporter')
     @patch('pybossa.core.csv_exporter')
@@ -18,7 +18,8 @@
 
 import json
 import requests
-from pybossa.jobs import webhook
+from pybossa.jobs import webhook, dispatch_webhooks
+from pybossa import webhook_dispatcher
 from default import Test, with_context, FakeResponse, db
 from factories import ProjectFactory
 from factories import TaskFactory
@@ -26,7 +27,9 @@ from factories import TaskRunFactory
 from factories import WebhookFactory
 from factories import UserFactory
 from mock import patch, MagicMock
+from nose.tools import assert_raises
 from datetime import datetime
+from pybossa.model.webhook import Webhook
 from pybossa.repositories import ResultRepository, WebhookRepository
 from pybossa.core import sentinel
 
@@ -49,7 +52,7 @@ class TestWebHooks(Test):
                                     project_short_name=self.project.short_name)
 
     @with_context
-    @patch('pybossa.jobs.requests.post')
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
     def test_webhooks(self, mock):
         """Test WEBHOOK works."""
         mock.return_value = FakeResponse(text=json.dumps(dict(foo='bar')),
@@ -61,11 +64,11 @@ class TestWebHooks(Test):
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
         mock.assert_called_with('url', params=dict(),
                                 data=json.dumps(self.webhook_payload),
-                                headers=headers)
+                                headers=headers, timeout=10)
 
 
     @with_context
-    @patch('pybossa.jobs.requests.post')
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
     def test_webhooks_rerun(self, mock):
         """Test WEBHOOK rerun works."""
         mock.return_value = FakeResponse(text=json.dumps(dict(foo='bar')),
@@ -76,10 +79,10 @@ class TestWebHooks(Test):
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
         mock.assert_called_with('url', params=dict(rerun=True),
                                 data=json.dumps(self.webhook_payload),
-                                headers=headers)
+                                headers=headers, timeout=10)
 
     @with_context
-    @patch('pybossa.jobs.requests.post')
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
     def test_webhooks_connection_error(self, mock):
         """Test WEBHOOK with connection error works."""
         import requests
@@ -94,7 +97,7 @@ class TestWebHooks(Test):
         assert wh.response_status_code == res.response_status_code, err_msg
 
     @with_context
-    @patch('pybossa.jobs.requests.post')
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
     def test_webhooks_without_url(self, mock):
         """Test WEBHOOK without url works."""
         mock.post.return_value = True
@@ -170,7 +173,7 @@ class TestWebHooks(Test):
 
     @with_context
     @patch('pybossa.jobs.send_mail')
-    @patch('pybossa.jobs.requests.post')
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
     def test_trigger_fails_webhook_with_url(self, mock_post, mock_send_mail):
         """Test WEBHOOK fails and sends email is triggered."""
         response = MagicMock()
@@ -189,7 +192,7 @@ class TestWebHooks(Test):
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
         mock_post.assert_called_with('url', data=json.dumps(payload),
                                      headers=headers,
-                                     params={})
+                                     params={}, timeout=10)
         subject = "Broken: %s webhook failed" % project.name
         body = 'Sorry, but the webhook failed'
         mail_dict = dict(recipients=self.flask_app.config.get('ADMINS'),
@@ -198,7 +201,7 @@ class TestWebHooks(Test):
 
     @with_context
     @patch('pybossa.jobs.send_mail')
-    @patch('pybossa.jobs.requests.post')
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
     def test_trigger_fails_webhook_with_no_url(self, mock_post, mock_send_mail):
         """Test WEBHOOK fails and sends email is triggered when no URL or failed connection."""
         mock_post.side_effect = requests.exceptions.ConnectionError('Not URL')
@@ -221,7 +224,7 @@ class TestWebHooks(Test):
 
     @with_context
     @patch('pybossa.jobs.send_mail')
-    @patch('pybossa.jobs.requests.post', side_effect=requests.exceptions.ConnectionError())
+    @patch('pybossa.webhook_dispatcher.requests.Session.post', side_effect=requests.exceptions.ConnectionError())
     def test_trigger_fails_webhook_with_url_connection_error(self, mock_post, mock_send_mail):
         """Test WEBHOOK fails and sends email is triggered when there is a connection error."""
         project = ProjectFactory.create(published=True)
@@ -236,9 +239,109 @@ class TestWebHooks(Test):
         headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
         mock_post.assert_called_with('url', data=json.dumps(payload),
                                      headers=headers,
-                                     params={})
+                                     params={}, timeout=10)
         subject = "Broken: %s webhook failed" % project.name
         body = 'Sorry, but the webhook failed'
         mail_dict = dict(recipients=self.flask_app.config.get('ADMINS'),
                          subject=subject, body=body, html=tmp.response)
         mock_send_mail.assert_called_with(mail_dict)
+
+    @with_context
+    @patch('pybossa.jobs.publish_channel')
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
+    def test_dispatch_webhooks(self, mock, publish):
+        """Test WEBHOOK dispatch delivers the pending webhooks."""
+        mock.return_value = FakeResponse(text='ok', status_code=200)
+        payloads = [dict(self.webhook_payload, task_id=i) for i in range(5)]
+        for payload in payloads:
+            webhook_dispatcher.push(self.project.id, 'url', payload,
+                                    self.connection)
+
+        with patch.dict(self.flask_app.config, {'SSE': True}):
+            dispatch_webhooks(self.project.id)
+
+        assert mock.call_count == 5, mock.call_count
+        webhooks = db.session.query(Webhook).order_by(Webhook.id).all()
+        assert [wh.payload for wh in webhooks] == payloads, webhooks
+        assert all(wh.response == 'ok' for wh in webhooks)
+        assert all(wh.response_status_code == 200 for wh in webhooks)
+        published = [call[1]['data']['id'] for call in publish.call_args_list]
+        assert published == [wh.id for wh in webhooks], published
+        assert self.connection.keys('pybossa:webhooks:*') == [], \
+            self.connection.keys('pybossa:webhooks:*')
+
+    @with_context
+    @patch('pybossa.core.webhook_repo.save_many', side_effect=Exception)
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
+    def test_dispatch_webhooks_keeps_unsaved_payloads(self, mock, save_many):
+        """Test WEBHOOK dispatch keeps the payloads until they are saved."""
+        mock.return_value = FakeResponse(text='ok', status_code=200)
+        payloads = [dict(self.webhook_payload, task_id=i) for i in range(3)]
+        for payload in payloads:
+            webhook_dispatcher.push(self.project.id, 'url', payload,
+                                    self.connection)
+
+        assert_raises(Exception, dispatch_webhooks, self.project.id)
+
+        pending = webhook_dispatcher.get_pending_key(self.project.id)
+        assert self.connection.llen(pending) == 0
+        processing = webhook_dispatcher.claim(self.project.id,
+                                              self.connection, stale=0)
+        assert self.connection.llen(pending) == 3
+        items = webhook_dispatcher.pop(self.project.id, self.connection, 10,
+                                       processing)
+        assert [item['payload'] for item in items] == payloads, items
+
+    @with_context
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
+    def test_dispatch_webhooks_batches(self, mock):
+        """Test WEBHOOK dispatch posts batches of payloads."""
+        mock.return_value = FakeResponse(text='ok', status_code=200)
+        payloads = [dict(self.webhook_payload, task_id=i) for i in range(5)]
+        for payload in payloads:
+            webhook_dispatcher.push(self.project.id, 'url', payload,
+                                    self.connection)
+
+        with patch.dict(self.flask_app.config, {'WEBHOOK_BATCH_SIZE': 2}):
+            dispatch_webhooks(self.project.id)
+
+        posted = [json.loads(call[1]['data']) for call in mock.call_args_list]
+        assert sorted(len(batch) for batch in posted) == [1, 2, 2], posted
+        assert sorted(sum(posted, []), key=lambda p: p['task_id']) == payloads
+        assert db.session.query(Webhook).count() == 5
+
+    @with_context
+    @patch('pybossa.webhook_dispatcher.time.sleep')
+    @patch('pybossa.webhook_dispatcher.requests.Session.post')
+    def test_dispatch_webhooks_retries(self, mock, sleep):
+        """Test WEBHOOK dispatch retries unavailable endpoints."""
+        mock.side_effect = [requests.exceptions.Timeout(),
+                            FakeResponse(text='busy', status_code=503),
+                            FakeResponse(text='x' * 5000, status_code=200)]
+        webhook_dispatcher.push(self.project.id, 'url', self.webhook_payload,
+                                self.connection)
+
+        with patch.dict(self.flask_app.config, {'WEBHOOK_BACKOFF': 1}):
+            dispatch_webhooks(self.project.id)
+
+        assert mock.call_count == 3, mock.call_count
+        assert [call[0][0] for call in sleep.call_args_list] == [1, 2]
+        wh = db.session.query(Webhook).one()
+        assert wh.response_status_code == 200, wh.response_status_code
+        assert len(wh.response) == 4096, len(wh.response)
+
+    @with_context
+    def test_push_webhook_enqueues_one_dispatch(self):
+        """Test WEBHOOK push only asks for a dispatch job if none is pending."""
+        push = webhook_dispatcher.push
+        project_id = self.project.id
+
+        assert push(project_id, 'url', dict(task_id=1), self.connection)
+        assert not push(project_id, 'url', dict(task_id=2), self.connection)
+        webhook_dispatcher.unschedule(project_id, self.connection)
+        assert push(project_id, 'url', dict(task_id=3), self.connection)
+
+        processing = webhook_dispatcher.claim(project_id, self.connection)
+        items = webhook_dispatcher.pop(project_id, self.connection, 2,
+                                       processing)
+        assert [item['payload']['task_id'] for item in items] == [1, 2]
@@ -22,13 +22,17 @@ from factories import TaskFactory, ProjectFactory, UserFactory
 from pybossa.sched import (
     get_task_users_key,
     acquire_lock,
+    acquire_locks,
+    release_lock,
     has_lock,
+    has_locks,
     get_locked_task
 )
 from pybossa.core import sentinel
 from pybossa.contributions_guard import ContributionsGuard
 from default import with_context
 import json
+import time
 
 from mock import patch
 
@@ -255,3 +259,56 @@ class TestLockedSched(sched.Helper):
         timeout = 100
         acquire_lock(task_id, user_id, limit, timeout)
         assert has_lock(task_id, user_id, limit)
+
+    @with_context
+    def test_acquire_locks_returns_first_available(self):
+        acquire_lock(1, 'other', 1, 100)
+        locked = acquire_locks([1, 2, 3], 'user', [1, 1, 1], 100)
+        assert locked == [2], locked
+        assert has_lock(2, 'user', 100)
+        assert not has_lock(3, 'user', 100)
+
+    @with_context
+    def test_acquire_locks_count(self):
+        locked = acquire_locks([1, 2, 3], 'user', [1, 1, 1], 100, count=2)
+        assert locked == [1, 2], locked
+        assert not has_lock(3, 'user', 100)
+
+    @with_context
+    def test_acquire_locks_keeps_lock_already_held(self):
+        acquire_lock(1, 'user', 1, 100)
+        locked = acquire_locks([1, 2], 'user', [1, 1], 100)
+        assert locked == [1], locked
+        assert not has_lock(2, 'user', 100)
+
+    @with_context
+    def test_has_locks(self):
+        acquire_locks([1, 2], 'user', [1, 1], 100, count=2)
+        acquire_lock(3, 'other', 1, 100)
+        sentinel.master.hset(get_task_users_key(4), 'user', time.time() - 10)
+        assert has_locks([1, 2, 3, 4, 5], 'user', 100) == [1, 2]
+
+    @with_context
+    def test_lock_scripts_are_registered_once(self):
+        with patch.object(sentinel.master, 'register_script',
+                          wraps=sentinel.master.register_script) as register:
+            acquire_lock(1, 'user', 1, 100)
+            has_lock(1, 'user', 100)
+            release_lock(1, 'user', 100)
+            acquire_lock(2, 'user', 1, 100)
+        assert register.call_count <= 1, register.call_args_list
+
+    @with_context
+    def test_acquire_locks_releases_expired_locks(self):
+        key = get_task_users_key(1)
+        sentinel.master.hset(key, 'other', time.time() - 10)
+        locked = acquire_locks([1], 'user', [1], 100)
+        assert locked == [1], locked
+        assert sentinel.master.hget(key, 'other') is None
+
+    @with_context
+    def test_release_lock(self):
+        acquire_lock(1, 'user', 1, 100)
+        release_lock(1, 'user', 100)
+        expiration = float(sentinel.master.hget(get_task_users_key(1), 'user'))
+        assert expiration <= time.time() + 5
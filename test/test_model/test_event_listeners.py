@@ -50,9 +50,7 @@ class TestModelEventListeners(Test):
                                               blog_id=target.id,
                                               project_id=target.project_id)
         assert mock_update_feed.called
-        obj = tmp.to_public_json()
-        obj['action_updated'] = 'Blog'
-        mock_update_feed.assert_called_with(obj)
+        mock_update_feed.assert_called_with('Blog', project_id=1)
         assert mock_webpush.called
 
     @with_context
@@ -73,9 +71,7 @@ class TestModelEventListeners(Test):
             add_blog_event(None, conn, target)
             assert mock_queue.enqueue.called is False
             assert mock_update_feed.called
-            obj = tmp.to_public_json()
-            obj['action_updated'] = 'Blog'
-            mock_update_feed.assert_called_with(obj)
+            mock_update_feed.assert_called_with('Blog', project_id=1)
             assert mock_webpush.called is False
 
 
@@ -96,11 +92,7 @@ class TestModelEventListeners(Test):
         conn.execute.return_value = [tmp]
         add_project_event(None, conn, target)
         assert mock_update_feed.called
-        obj = tmp.to_public_json()
-        obj['action_updated'] = 'Project'
-        mock_update_feed.assert_called_with(obj)
-
-        mock_update_feed.assert_called_with(obj)
+        mock_update_feed.assert_called_with('Project', project_id=1)
 
     @with_context
     @patch('pybossa.model.event_listeners.update_feed')
@@ -115,23 +107,17 @@ class TestModelEventListeners(Test):
         conn.execute.return_value = [tmp]
         add_task_event(None, conn, target)
         assert mock_update_feed.called
-        obj = tmp.to_public_json()
-        obj['action_updated'] = 'Task'
-        mock_update_feed.assert_called_with(obj)
+        mock_update_feed.assert_called_with('Task', project_id=1)
 
     @with_context
     @patch('pybossa.model.event_listeners.sched.after_save')
     @patch('pybossa.model.event_listeners.push_webhook')
-    @patch('pybossa.model.event_listeners.create_result', return_value=1)
-    @patch('pybossa.model.event_listeners.update_task_state')
-    @patch('pybossa.model.event_listeners.is_task_completed', return_value=True)
+    @patch('pybossa.model.event_listeners.submit_task_runs')
     @patch('pybossa.model.event_listeners.add_user_contributed_to_feed')
     @patch('pybossa.model.event_listeners.update_feed')
     def test_on_taskrun_submit_event(self, mock_update_feed,
                                      mock_add_user,
-                                     mock_is_task,
-                                     mock_update_task,
-                                     mock_create_result,
+                                     mock_submit,
                                      mock_push,
                                      mock_sched_after_save):
         """Test on_taskrun_submit is called."""
@@ -146,30 +132,96 @@ class TestModelEventListeners(Test):
                       published=True,
                       webhook='http://localhost.com')
         conn.execute.return_value = [tmp]
+        user = dict(id=3, name='name', fullname='fullname', info={})
+        mock_submit.return_value = ({2: 1}, user)
         on_taskrun_submit(None, conn, target)
         obj = tmp.to_public_json()
-        obj['action_updated'] = 'TaskCompleted'
-        mock_add_user.assert_called_with(conn, target.user_id, obj)
-        mock_update_task.assert_called_with(conn, target.task_id)
-        mock_update_feed.assert_called_once_with(obj)
-        mock_sched_after_save.assert_called_once_with(target, conn)
+        mock_submit.assert_called_with(conn, 1, [2], 3)
+        mock_add_user.assert_called_with(user, obj)
+        mock_update_feed.assert_called_once_with('TaskCompleted',
+                                                 project_id=1)
+        mock_sched_after_save.assert_called_once_with(target, conn, 'default')
         obj_with_webhook = tmp.to_public_json()
         obj_with_webhook['webhook'] = tmp.webhook
-        obj_with_webhook['action_updated'] = 'TaskCompleted'
         mock_push.assert_called_with(obj_with_webhook, target.task_id, 1)
 
+    @with_context
+    @patch('pybossa.model.event_listeners.sched.after_save')
+    @patch('pybossa.model.event_listeners.push_webhook')
+    @patch('pybossa.model.event_listeners.submit_task_runs',
+           return_value=({}, None))
+    @patch('pybossa.model.event_listeners.update_feed')
+    def test_on_taskrun_submit_event_not_completed(self, mock_update_feed,
+                                                   mock_submit,
+                                                   mock_push,
+                                                   mock_sched_after_save):
+        """Test on_taskrun_submit does nothing else if not completed."""
+        conn = MagicMock()
+        target = MagicMock()
+        target.project_id = 1
+        tmp = Project(id=1, name='name', short_name='short_name', info={})
+        conn.execute.return_value = [tmp]
+        on_taskrun_submit(None, conn, target)
+        assert not mock_update_feed.called
+        assert not mock_push.called
+
+    @with_context
+    def test_get_project_is_cached_per_request(self):
+        """Test get_project looks the project up once per request."""
+        conn = MagicMock()
+        tmp = Project(id=1, name='name', short_name='short_name', info={})
+        conn.execute.return_value = [tmp]
+
+        assert get_project(conn, 1)['short_name'] == 'short_name'
+        assert get_project(conn, 1)['short_name'] == 'short_name'
+        assert conn.execute.call_count == 1
+
+        forget_project(None, conn, tmp)
+        get_project(conn, 1)
+        assert conn.execute.call_count == 2
+
+    @with_context
+    def test_submit_task_runs_creates_result(self):
+        """Test submit_task_runs completes the task and versions results."""
+        task = TaskFactory.create(n_answers=1)
+        task_run = TaskRunFactory.create(task=task)
+        result = result_repo.filter_by(project_id=task.project_id,
+                                       task_id=task.id,
+                                       last_version=True)
+        assert len(result) == 1, len(result)
+        assert result[0].task_run_ids == [task_run.id], result[0]
+        assert task_repo.get_task(task.id).state == 'completed'
+
+        task.n_answers = 2
+        task.state = 'ongoing'
+        task_repo.update(task)
+        TaskRunFactory.create(task=task)
+        result = result_repo.filter_by(project_id=task.project_id,
+                                       task_id=task.id)
+        assert len(result) == 2, len(result)
+        last = [r for r in result if r.last_version]
+        assert len(last) == 1, last
+        assert len(last[0].task_run_ids) == 2, last[0]
+
+    @with_context
+    def test_submit_task_runs_not_completed(self):
+        """Test submit_task_runs does not create results before n_answers."""
+        task = TaskFactory.create(n_answers=2)
+        TaskRunFactory.create(task=task)
+        result = result_repo.filter_by(project_id=task.project_id,
+                                       task_id=task.id)
+        assert result == [], result
+        assert task_repo.get_task(task.id).state == 'ongoing'
 
     @with_context
     @patch('pybossa.model.event_listeners.update_feed')
     def test_add_user_event(self, mock_update_feed):
         """Test add_user_event is called."""
         conn = MagicMock()
-        user = User(name="John", fullname="John")
+        user = User(id=1, name="John", fullname="John")
         add_user_event(None, conn, user)
         assert mock_update_feed.called
-        obj = user.to_public_json()
-        obj['action_updated'] = 'User'
-        mock_update_feed.assert_called_with(obj)
+        mock_update_feed.assert_called_with('User', user_id=1)
 
     @with_context
     @patch('pybossa.model.event_listeners.create_result')
@@ -285,3 +337,19 @@ class TestModelEventListeners(Test):
         assert len(counters) == 1, counters
         counter = counters[0]
         assert counter[2] == 0, counter
+
+    @with_context
+    def test_task_n_task_runs_follows_task_runs(self):
+        """Test event listeners keep the n_task_runs of the task."""
+        task = TaskFactory.create(n_answers=2)
+        task_id = task.id
+        TaskRunFactory.create(task=task)
+        task_run = TaskRunFactory.create(task=task)
+
+        sql = 'SELECT n_task_runs, state FROM task WHERE id=%s' % task_id
+        assert tuple(db.session.execute(sql).first()) == (2, 'completed')
+
+        db.session.delete(task_run)
+        db.session.commit()
+
+        assert db.session.execute(sql).first().n_task_runs == 1
@@ -133,3 +133,24 @@ class TestAPI(object):
 
         url = '/api/project/1/userprogress'
         self.check_limit(url, 'get', 'project')
+
+    @patch.dict('pybossa.ratelimit.ratelimits', {'BACKEND': 'gcra'})
+    def test_06_gcra_get(self):
+        """Test API GET rate limit with GCRA."""
+        self.check_limit('/api/', 'get', 'project')
+        res = self.app.get('/api/')
+        assert res.status_code == 429, res.status_code
+        assert res.headers['X-RateLimit-Remaining'] == '0', res.headers
+
+    @patch.dict('pybossa.ratelimit.ratelimits', {'BACKEND': 'gcra',
+                                                 'LEASE': 10})
+    @patch('pybossa.ratelimit._leases', {})
+    def test_07_gcra_lease_get(self):
+        """Test API GET rate limit with GCRA leasing requests."""
+        with patch('pybossa.ratelimit.sentinel.master.evalsha',
+                   wraps=sentinel.master.evalsha) as evalsha:
+            self.check_limit('/api/', 'get', 'project')
+            res = self.app.get('/api/')
+
+        assert res.status_code == 429, res.status_code
+        assert evalsha.call_count == 4, evalsha.call_count
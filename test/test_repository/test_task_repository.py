@@ -22,7 +22,7 @@ from nose.tools import assert_raises
 from factories import TaskFactory, TaskRunFactory, ProjectFactory
 from pybossa.repositories import TaskRepository, ProjectRepository
 from pybossa.exc import WrongObjectError, DBIntegrityError
-from pybossa.model.task import Task
+from pybossa.model.task import Task, hash_info
 
 project_repo = ProjectRepository(db)
 
@@ -308,6 +308,17 @@ class TestTaskRepositoryForTaskQueries(Test):
         assert first_two == all_tasks[:2]
         assert last_two == all_tasks[2:]
 
+    @with_context
+    def test_filter_tasks_id_range(self):
+        """Test that filter_tasks_by supports last_id and max_id options"""
+
+        tasks = TaskFactory.create_batch(4)
+
+        retrieved = self.task_repo.filter_tasks_by(last_id=tasks[0].id,
+                                                   max_id=tasks[2].id)
+
+        assert retrieved == tasks[1:3], retrieved
+
 
     @with_context
     def test_count_tasks_with_no_matches(self):
@@ -588,6 +599,32 @@ class TestTaskRepositorySaveDeleteUpdate(Test):
         assert self.task_repo.get_task_run(taskrun.id) == taskrun, "TaskRun not saved"
 
 
+    @with_context
+    def test_import_tasks_skips_duplicated_tasks(self):
+        """Test import_tasks only inserts tasks with a new info"""
+        project = ProjectFactory.create()
+        existing = TaskFactory.create(project=project, info={'a': 1, 'b': 2})
+        tasks = [Task(info={'b': 2, 'a': 1}), Task(info={'a': 2}),
+                 Task(info={'a': 2}), Task(info={'a': 3}, n_answers=5)]
+
+        imported = self.task_repo.import_tasks(project.id, tasks)
+
+        assert [t.info for t in imported] == [{'a': 2}, {'a': 3}], imported
+        saved = self.task_repo.filter_tasks_by(project_id=project.id)
+        assert len(saved) == 3, saved
+        task = self.task_repo.get_task(imported[1].id)
+        assert task.n_answers == 5, task.n_answers
+        assert task.state == 'ongoing', task.state
+        assert task.info_hash == hash_info({'a': 3}), task.info_hash
+        assert existing.info_hash == hash_info({'b': 2, 'a': 1})
+        counters = db.session.execute(
+            'SELECT task_id FROM counter WHERE project_id=%s' % project.id)
+        assert sorted(row.task_id for row in counters) == sorted(
+            [existing.id] + [t.id for t in imported])
+
+        assert self.task_repo.import_tasks(project.id, tasks) == []
+
+
     @with_context
     def test_save_fails_if_integrity_error(self):
         """Test save raises a DBIntegrityError if the instance to be saved lacks
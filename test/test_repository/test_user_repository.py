@@ -19,6 +19,7 @@
 
 from default import Test, db, with_context
 from nose.tools import assert_raises
+from mock import patch, call
 from factories import UserFactory, TaskRunFactory
 from pybossa.repositories import UserRepository, TaskRepository
 from pybossa.exc import WrongObjectError, DBIntegrityError
@@ -290,6 +291,33 @@ class TestUserRepository(Test):
         assert updated_user.locale == 'it', updated_user
 
 
+    @with_context
+    @patch('pybossa.repositories.user_repository.cached_users')
+    def test_update_cleans_cached_api_keys(self, cached_users):
+        """Test update drops from cache the old and the new API keys"""
+
+        user = UserFactory.create(api_key='old-key')
+        user.api_key = 'new-key'
+
+        self.user_repo.update(user)
+
+        calls = sorted(cached_users.delete_user_by_api_key.call_args_list)
+        assert calls == [call('new-key'), call('old-key')], calls
+
+
+    @with_context
+    @patch('pybossa.repositories.user_repository.cached_users')
+    def test_delete_cleans_cached_api_key(self, cached_users):
+        """Test delete drops from cache the API key of the user"""
+
+        user = UserFactory.create(api_key='deleted-key')
+
+        self.user_repo.delete(user)
+
+        cached_users.delete_user_by_api_key.assert_called_once_with(
+            'deleted-key')
+
+
     @with_context
     def test_update_fails_if_integrity_error(self):
         """Test update raises a DBIntegrityError if the instance to be updated
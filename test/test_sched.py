@@ -1133,6 +1133,53 @@ class TestSched(sched.Helper):
             assert t['id'] == tasks[i].id, (err_msg, t, tasks[i].id)
             i += 1
 
+    @with_context
+    def test_has_available_task_user(self):
+        """Test SCHED has_available_task skips the tasks answered by the user"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project, n_answers=2)
+        TaskFactory.create(project=project, state='completed')
+        user = UserFactory.create()
+
+        assert pybossa.sched.has_available_task(project.id, 'default', user.id)
+
+        TaskRunFactory.create(task=task, user=user)
+
+        assert not pybossa.sched.has_available_task(project.id, 'default',
+                                                    user.id)
+        assert pybossa.sched.has_available_task(project.id, 'default',
+                                                user_ip='10.0.0.1')
+        assert pybossa.sched.has_available_task(project.id, 'depth_first_all',
+                                                user.id)
+
+    @with_context
+    def test_has_available_task_does_not_lock(self):
+        """Test SCHED has_available_task does not lock tasks"""
+        project = ProjectFactory.create(info=dict(sched='locked'))
+        task = TaskFactory.create(project=project)
+
+        assert pybossa.sched.has_available_task(project.id, 'locked')
+        conn = pybossa.sched.sentinel.master
+        assert pybossa.sched.get_active_user_count(project.id, conn) == 0
+        assert not conn.exists(pybossa.sched.get_task_users_key(task.id))
+
+    @with_context
+    def test_has_available_task_locked_by_others(self):
+        """Test SCHED has_available_task skips tasks locked by other users"""
+        project = ProjectFactory.create(info=dict(sched='locked'))
+        user = UserFactory.create()
+        task = TaskFactory.create(project=project, n_answers=1)
+        pybossa.sched.acquire_lock(task.id, 'other', 1, 100)
+
+        assert not pybossa.sched.has_available_task(project.id, 'locked',
+                                                    user.id)
+
+        pybossa.sched.acquire_lock(task.id, user.id, 2, 100)
+        assert pybossa.sched.has_available_task(project.id, 'locked',
+                                                user.id)
+        TaskFactory.create(project=project, n_answers=1)
+        assert pybossa.sched.has_available_task(project.id, 'locked')
+
 
 class TestGetBreadthFirst(Test):
 
@@ -0,0 +1,191 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+
+from helper import sched
+from default import db, with_context
+from pybossa.core import sentinel, task_repo
+from pybossa.sched import get_depth_first_queue_task
+from pybossa.jobs import reconcile_task_queue
+from pybossa import redis_task_queue
+from factories import TaskFactory, ProjectFactory, TaskRunFactory, UserFactory
+
+
+class TestSchedDepthFirstQueue(sched.Helper):
+
+    def _create_project(self):
+        return ProjectFactory.create(info=dict(sched='depth_first_queue'))
+
+    @with_context
+    @patch('pybossa.jobs.enqueue_job')
+    def test_queue_not_built_falls_back_to_db(self, enqueue):
+        """Test SCHED queue serves from the DB and asks for a rebuild."""
+        project = self._create_project()
+        task = TaskFactory.create(project=project)
+        user = UserFactory.create()
+
+        tasks = get_depth_first_queue_task(project.id, user.id)
+
+        assert [t.id for t in tasks] == [task.id], tasks
+        assert enqueue.call_count == 1
+        job = enqueue.call_args[0][0]
+        assert job['name'] == reconcile_task_queue, job
+        assert job['args'] == [project.id], job
+        get_depth_first_queue_task(project.id, user.id)
+        assert enqueue.call_count == 1
+
+    @with_context
+    def test_queue_orders_by_priority_and_id(self):
+        """Test SCHED queue serves priority_0 DESC, id ASC."""
+        project = self._create_project()
+        low = TaskFactory.create(project=project, priority_0=0.1)
+        high = TaskFactory.create(project=project, priority_0=0.9)
+        low_2 = TaskFactory.create(project=project, priority_0=0.1)
+        user = UserFactory.create()
+        reconcile_task_queue(project.id)
+
+        tasks = get_depth_first_queue_task(project.id, user.id, limit=3)
+
+        assert [t.id for t in tasks] == [high.id, low.id, low_2.id], tasks
+        tasks = get_depth_first_queue_task(project.id, user.id, offset=1)
+        assert [t.id for t in tasks] == [low.id], tasks
+
+    @with_context
+    def test_queue_skips_tasks_answered_by_the_user(self):
+        """Test SCHED queue does not serve tasks the user has answered."""
+        project = self._create_project()
+        task_1, task_2, task_3 = TaskFactory.create_batch(3, project=project)
+        user = UserFactory.create()
+        TaskRunFactory.create(task=task_1, user=user)
+        reconcile_task_queue(project.id)
+
+        tasks = get_depth_first_queue_task(project.id, user.id)
+        assert tasks[0].id == task_2.id, tasks
+
+        TaskRunFactory.create(task=task_2, user=user)
+        tasks = get_depth_first_queue_task(project.id, user.id)
+        assert tasks[0].id == task_3.id, tasks
+
+        other = UserFactory.create()
+        tasks = get_depth_first_queue_task(project.id, other.id)
+        assert tasks[0].id == task_1.id, tasks
+
+    @with_context
+    def test_queue_is_refilled_and_drained_by_listeners(self):
+        """Test SCHED queue adds new tasks and drops completed ones."""
+        project = self._create_project()
+        reconcile_task_queue(project.id)
+        task = TaskFactory.create(project=project, n_answers=1)
+        key = redis_task_queue.get_ready_key(project.id)
+
+        assert sentinel.master.zcard(key) == 1
+
+        TaskRunFactory.create(task=task)
+
+        assert sentinel.master.zcard(key) == 0
+        user = UserFactory.create()
+        assert get_depth_first_queue_task(project.id, user.id) == []
+
+    @with_context
+    def test_queue_drops_stale_tasks(self):
+        """Test SCHED queue drops tasks completed behind its back."""
+        project = self._create_project()
+        task_1, task_2 = TaskFactory.create_batch(2, project=project)
+        reconcile_task_queue(project.id)
+        db.session.execute("UPDATE task SET state='completed' WHERE id=%s"
+                           % task_1.id)
+        db.session.commit()
+        user = UserFactory.create()
+
+        tasks = get_depth_first_queue_task(project.id, user.id)
+
+        assert tasks[0].id == task_2.id, tasks
+        key = redis_task_queue.get_ready_key(project.id)
+        assert sentinel.master.zcard(key) == 1
+
+    @with_context
+    def test_queue_follows_task_updates(self):
+        """Test SCHED queue is updated when a task changes."""
+        project = self._create_project()
+        task_1, task_2 = TaskFactory.create_batch(2, project=project)
+        reconcile_task_queue(project.id)
+        user = UserFactory.create()
+
+        task_2.priority_0 = 1
+        task_repo.update(task_2)
+        tasks = get_depth_first_queue_task(project.id, user.id)
+        assert tasks[0].id == task_2.id, tasks
+
+        task_repo.delete(task_2)
+        tasks = get_depth_first_queue_task(project.id, user.id)
+        assert tasks[0].id == task_1.id, tasks
+
+    @with_context
+    @patch('pybossa.model.event_listeners.redis_task_queue')
+    def test_other_schedulers_skip_the_queue(self, queue):
+        """Test SCHED queue is not touched by projects of other schedulers."""
+        project = ProjectFactory.create(info=dict(sched='default'))
+        task = TaskFactory.create(project=project)
+
+        task.priority_0 = 1
+        task_repo.update(task)
+        task_repo.delete(task)
+
+        assert not queue.push.called, queue.push.call_args_list
+        assert not queue.remove.called, queue.remove.call_args_list
+
+    @with_context
+    def test_rebuild_keeps_the_tasks_pushed_meanwhile(self):
+        """Test SCHED queue rebuild merges the tasks pushed while it runs."""
+        project = self._create_project()
+        task = TaskFactory.create(project=project)
+        key = redis_task_queue.get_ready_key(project.id)
+        execute = db.session.execute
+
+        for pushed_id in (1000, 1001):
+            def push_and_execute(*args, **kwargs):
+                rows = execute(*args, **kwargs)
+                redis_task_queue.push(project.id, pushed_id, 0,
+                                      sentinel.master)
+                return rows
+            with patch.object(db.session, 'execute',
+                              side_effect=push_and_execute):
+                redis_task_queue.rebuild(project.id, sentinel.master,
+                                         db.session)
+
+            ids = [int(member) for member in sentinel.master.zrange(key, 0, -1)]
+            assert ids == [task.id, pushed_id], ids
+
+    @with_context
+    def test_seen_bitmaps_are_sized_by_the_project_tasks(self):
+        """Test SCHED queue bitmaps do not depend on the task ids."""
+        project = self._create_project()
+        task_1 = TaskFactory.create(project=project, id=1)
+        task_2 = TaskFactory.create(project=project, id=1000000)
+        task_3 = TaskFactory.create(project=project, id=1000001)
+        user = UserFactory.create()
+        TaskRunFactory.create(task=task_2, user=user)
+        reconcile_task_queue(project.id)
+
+        tasks = get_depth_first_queue_task(project.id, user.id, limit=3)
+
+        assert [t.id for t in tasks] == [task_1.id, task_3.id], tasks
+        keys = sentinel.master.keys('pybossa:sched:queue:seen:*')
+        assert len(keys) == 1, keys
+        assert sentinel.master.strlen(keys[0]) == 1
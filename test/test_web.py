@@ -5141,6 +5141,113 @@ class TestWeb(web.Helper):
 
         assert is_empty
 
+    @with_context
+    def test_export_task_csv_rows_with_different_keys(self):
+        """Test WEB export Tasks to CSV includes the keys of every row"""
+        project = ProjectFactory.create()
+        self.clear_temp_container(project.owner_id)
+        TaskFactory.create(project=project, info={'a': 1})
+        TaskFactory.create(project=project, info={'b': None})
+        uri = "/project/%s/tasks/export?type=task&format=csv" % project.short_name
+        res = self.app.get(uri, follow_redirects=True)
+        zip = zipfile.ZipFile(StringIO(res.data))
+
+        csv_content = StringIO(zip.read(zip.namelist()[0]))
+        rows = list(unicode_csv_reader(csv_content))
+        assert len(rows) == 3, rows
+        keys = rows[0]
+        assert keys == sorted(keys), keys
+        assert rows[1][keys.index('info_a')] == u'1', rows
+        assert rows[1][keys.index('info_b')] == u'', rows
+        assert rows[2][keys.index('info_a')] == u'', rows
+
+        csv_content = StringIO(zip.read(zip.namelist()[1]))
+        rows = list(unicode_csv_reader(csv_content))
+        assert rows[0] == ['a', 'b', 'task_id'], rows
+        assert len(rows) == 3, rows
+
+    @with_context
+    def test_export_task_json_incremental(self):
+        """Test WEB incremental export appends the new tasks as segments"""
+        from pybossa.core import json_exporter as e
+        project = ProjectFactory.create()
+        self.clear_temp_container(project.owner_id)
+        tasks = TaskFactory.create_batch(2, project=project)
+        path = os.path.join('/tmp', 'user_%d' % project.owner_id,
+                            e.incremental_download_name(project, 'task'))
+
+        e._make_incremental_zip(project, 'task')
+        zip = zipfile.ZipFile(path)
+        assert zip.namelist() == ['project1_task_0001.json'], zip.namelist()
+        exported = json.loads(zip.read('project1_task_0001.json'))
+        assert [t['id'] for t in exported] == [t.id for t in tasks]
+        manifest = json.loads(zip.comment)
+        assert manifest == dict(last_id=tasks[1].id, segments=1), manifest
+
+        e._make_incremental_zip(project, 'task')
+        assert len(zipfile.ZipFile(path).namelist()) == 1
+
+        task = TaskFactory.create(project=project)
+        with patch.dict(self.flask_app.config,
+                        {'EXPORT_INCREMENTAL_LAG': 3600}):
+            e._make_incremental_zip(project, 'task')
+        assert len(zipfile.ZipFile(path).namelist()) == 1
+
+        inode = os.stat(path).st_ino
+        e._make_incremental_zip(project, 'task')
+        assert os.stat(path).st_ino == inode
+        zip = zipfile.ZipFile(path)
+        assert len(zip.namelist()) == 2, zip.namelist()
+        exported = json.loads(zip.read('project1_task_0002.json'))
+        assert [t['id'] for t in exported] == [task.id], exported
+        manifest = json.loads(zip.comment)
+        assert manifest == dict(last_id=task.id, segments=2), manifest
+
+        with patch.dict(self.flask_app.config, {'EXPORT_INCREMENTAL': True}):
+            uri = "/project/%s/tasks/export?type=task&format=json" % project.short_name
+            res = self.app.get(uri, follow_redirects=True)
+        content_disposition = ('attachment; filename=%d_project1_task_json_incremental.zip'
+                               % project.id)
+        assert res.headers.get('Content-Disposition') == content_disposition, res.headers
+
+    @with_context
+    def test_export_task_sharded(self):
+        """Test WEB export merges the shards and reports their progress"""
+        from pybossa.core import json_exporter, csv_exporter
+        from pybossa.exporter import get_export_progress
+        project = ProjectFactory.create()
+        self.clear_temp_container(project.owner_id)
+        tasks = TaskFactory.create_batch(5, project=project, info={'n': 1})
+        TaskFactory.create(info={'n': 1})
+
+        with patch.dict(self.flask_app.config, {'EXPORT_SHARD_SIZE': 2}):
+            json_exporter._make_zip(project, 'task')
+            csv_exporter._make_zip(project, 'task')
+
+        progress = get_export_progress(project.id)
+        for fmt in ('json', 'csv'):
+            for shard, total in enumerate([2, 2, 1]):
+                field = 'task:%s:%d' % (fmt, shard)
+                assert progress[field] == dict(rows=total, total=total,
+                                               done=True), progress
+        assert len(progress) == 6, progress
+
+        path = os.path.join('/tmp', 'user_%d' % project.owner_id)
+        zip = zipfile.ZipFile(os.path.join(
+            path, json_exporter.download_name(project, 'task')))
+        exported = json.loads(zip.read(zip.namelist()[0]))
+        assert [t['id'] for t in exported] == [t.id for t in tasks], exported
+
+        zip = zipfile.ZipFile(os.path.join(
+            path, csv_exporter.download_name(project, 'task')))
+        rows = list(unicode_csv_reader(StringIO(zip.read(zip.namelist()[0]))))
+        assert len(rows) == 6, rows
+        ids = [int(row[rows[0].index('id')]) for row in rows[1:]]
+        assert ids == [t.id for t in tasks], ids
+        rows = list(unicode_csv_reader(StringIO(zip.read(zip.namelist()[1]))))
+        assert rows[0] == ['n', 'task_id'], rows
+        assert len(rows) == 6, rows
+
     @with_context
     def test_53_export_task_runs_csv(self):
         """Test WEB export Task Runs to CSV works"""
@@ -5354,6 +5461,40 @@ class TestWeb(web.Helper):
             err_msg = "Tasks should be exported to CKAN"
             assert msg in res.data, err_msg
 
+    @with_context
+    @patch('pybossa.view.projects.set_last_synced_id')
+    @patch('pybossa.view.projects.get_last_synced_id', return_value=5)
+    @patch('pybossa.view.projects.Ckan', autospec=True)
+    def test_task_export_tasks_ckan_incremental(self, mock1, get_last, set_last):
+        """Test WEB Export CKAN Tasks only upserts new rows if incremental."""
+        resource = dict(name='task', id=1)
+        package = dict(id=3, resources=[resource])
+        mocks = [Mock(), Mock()]
+        for ckan in mocks:
+            ckan.package_exists.return_value = (package, None)
+            ckan.package_update.return_value = package
+        mock1.side_effect = mocks
+
+        Fixtures.create()
+        user = db.session.query(User).filter_by(name=Fixtures.name).first()
+        project = db.session.query(Project).first()
+        user.ckan_api = 'ckan-api-key'
+        project.owner_id = user.id
+        db.session.add(user)
+        db.session.add(project)
+        db.session.commit()
+
+        self.signin(email=user.email_addr, password=Fixtures.password)
+        uri = "/project/%s/tasks/export?type=task&format=ckan" % Fixtures.project_short_name
+        with patch.dict(self.flask_app.config, {'CKAN_URL': 'http://ckan.com'}):
+            self.app.get(uri + '&incremental=0', follow_redirects=True)
+            self.app.get(uri + '&incremental=1', follow_redirects=True)
+
+        assert mocks[0].datastore_delete.called
+        assert not mocks[1].datastore_delete.called
+        kwargs = mocks[1].datastore_upsert.call_args[1]
+        assert kwargs['method'] == 'upsert', kwargs
+
     @with_context
     @patch('pybossa.view.projects.Ckan', autospec=True)
     def test_task_export_tasks_ckan_second_time(self, mock1):